@@ -1,21 +1,39 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException, Query
+from fastapi import FastAPI, File, UploadFile, HTTPException, Query, Header, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import Response
+from fastapi.responses import Response, StreamingResponse, FileResponse, JSONResponse
 import numpy as np
 import cv2
 import io
-from PIL import Image
+from PIL import Image, ImageOps
 import base64
+import json
 import uvicorn
-from typing import List, Optional
+from typing import List, Literal, Optional
 import gc
 import sys
 import traceback
 import math
 import asyncio
 import os
-from dataclasses import asdict
+import contextvars
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from dataclasses import asdict, dataclass, field
 import rawpy
+from feature_store import FeatureStore, FeatureEntry
+import stitch_new
+import matching
+import deepzoom
+from stitch_pool import StitchWorkerPool, StitchError, StitchCancelledError, StitchQueueFullError, STITCH_RETRY_AFTER_SECONDS
+from stitch_cancel import CancelRegistry, STITCH_DISCONNECT_POLL_SECONDS, check_cancelled, reset_cancel_token, set_cancel_token
+from stitch_jobs import JobStore, report_progress, set_progress_reporter, reset_progress_reporter
+from result_cache import ResultCache, content_digest, source_version, stitch_cache_key
+from memory_planner import MemoryBudgetError, images_nbytes, plan_blend
+from deepzoom import (DEEPZOOM_CANVAS_BYTES_PER_PIXEL, DEEPZOOM_TILE_SIZES, DeepZoomImage, DeepZoomSettings, DeepZoomWriter, PyramidStore,
+                      TILE_FORMATS, aligned_tile_size)
+from detector_stats import DetectorStats, image_bucket
+from stitch_timing import StageHistograms, current_timings, reset_timings, server_timing_header, span, start_timings
 
 app = FastAPI()
 
@@ -26,6 +44,8 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "X-Stitch-Cache", "X-Stitch-Width", "X-Stitch-Height", "X-Stitch-Queue-Wait-Ms",
+                    "Server-Timing", "Content-Disposition"],
 )
 
 # 添加健康检查接口
@@ -33,13 +53,26 @@ app.add_middleware(
 async def health_check():
     return {"status": "ok", "message": "服务正常运行"}
 
-def safe_create_detector(detector_type='sift'):
+# 每个线程复用自己的检测器：OpenCV 检测器对象不能跨线程并发调用，但同一线程内无需反复创建
+_thread_detectors = threading.local()
+
+def get_detector(detector_type='sift', nfeatures=2000):
+    """返回当前线程缓存的检测器，首次使用时创建"""
+    detectors = getattr(_thread_detectors, 'detectors', None)
+    if detectors is None:
+        detectors = _thread_detectors.detectors = {}
+    key = (detector_type, nfeatures)
+    if key not in detectors:
+        detectors[key] = safe_create_detector(detector_type, nfeatures)
+    return detectors[key]
+
+def safe_create_detector(detector_type='sift', nfeatures=2000):
     """安全创建特征检测器"""
     try:
         if detector_type == 'sift':
-            return cv2.SIFT_create(nfeatures=2000)  # 增加特征点数量
+            return cv2.SIFT_create(nfeatures=nfeatures)  # 增加特征点数量
         elif detector_type == 'orb':
-            return cv2.ORB_create(nfeatures=2000)
+            return cv2.ORB_create(nfeatures=nfeatures)
         elif detector_type == 'akaze':
             return cv2.AKAZE_create()
         elif detector_type == 'brisk':
@@ -108,76 +141,265 @@ def enhance_image_for_detection(image):
         print(f"图像增强失败: {e}")
         return image
 
+def to_gray(image):
+    """转换为灰度图（已是灰度图则原样返回）"""
+    return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if len(image.shape) == 3 else image
+
+def preprocess_for_detection(image):
+    """轻度锐化 + CLAHE 后转灰度（advanced_feature_matching 使用）"""
+    return to_gray(enhance_image_for_detection(image))
+
+def preprocess_for_matching(img):
+    """CLAHE 增强对比度 + 轻度高斯模糊去噪（improved_feature_matching 使用）"""
+    gray = to_gray(img)
+
+    # 应用CLAHE增强对比度
+    clahe = cv2.createCLAHE(clipLimit=3.0, tileGridSize=(8,8))
+    enhanced = clahe.apply(gray)
+
+    # 轻度高斯模糊去噪
+    return cv2.GaussianBlur(enhanced, (3, 3), 0)
+
+def enhance_for_overlap_detection(img):
+    """直方图均衡化 + CLAHE + 锐化（robust_feature_matching_for_overlap 使用）"""
+    gray = to_gray(img)
+
+    # 直方图均衡化
+    equalized = cv2.equalizeHist(gray)
+
+    # CLAHE增强对比度
+    clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
+    enhanced = clahe.apply(equalized)
+
+    # 轻度锐化
+    kernel = np.array([[-1,-1,-1], [-1,9,-1], [-1,-1,-1]])
+    return cv2.filter2D(enhanced, -1, kernel)
+
+# 预处理配置名 -> 预处理函数，配置名是特征缓存键的一部分
+PREPROCESS_PROFILES = {
+    'gray': to_gray,
+    'detect': preprocess_for_detection,
+    'improved': preprocess_for_matching,
+    'overlap': enhance_for_overlap_detection,
+}
+
+# 进程内共享的特征缓存，同一请求的各拼接策略以及重复提交的请求都会命中
+feature_store = FeatureStore()
+
+# 配准分辨率（百万像素）：在缩小的代理图上检测匹配，再把 H 换算回原分辨率；<=0 表示原分辨率
+DEFAULT_WORK_MEGAPIX = float(os.getenv("STITCH_WORK_MEGAPIX", "0"))
+
+# 两图拼接的检测器级联方式：sequential 依次尝试，race 并发取第一个通过校验的，best 等全部完成取质量最高的
+DETECTOR_MODES = ('sequential', 'race', 'best')
+DEFAULT_DETECTOR_MODE = os.getenv("STITCH_DETECTOR_MODE", "sequential")
+# 上传图像解码时的像素上限（百万像素），超出时解码阶段直接降采样，0 表示不限制
+DEFAULT_MAX_INPUT_MEGAPIX = float(os.getenv("STITCH_MAX_INPUT_MEGAPIX", "0"))
+
+@dataclass(frozen=True)
+class RegistrationSettings:
+    work_megapix: float = DEFAULT_WORK_MEGAPIX
+    refine_full_res: bool = True  # 换算后用少量原分辨率内点微调 H
+    detector_mode: str = DEFAULT_DETECTOR_MODE
+    max_input_megapix: float = DEFAULT_MAX_INPUT_MEGAPIX
+    match_window: int = 0  # >0 时按上传顺序只匹配后面 k 张（顺序拍摄），并检查首尾闭环
+
+# 全局签名预筛选：多图时每张图只与最相似的 k 张做完整匹配，0 表示匹配全部图像对
+STITCH_PAIR_TOP_K = int(os.getenv("STITCH_PAIR_TOP_K", "8"))
+
+def select_candidate_pairs(images, detector_type, profile, nfeatures=2000, top_k=None):
+    """返回需要完整匹配的图像对 [(i, j), ...]：顺序匹配模式按上传顺序取窗口，否则用已缓存的描述子计算全局签名预筛选"""
+    n = len(images)
+    match_window = registration_settings.get().match_window
+    if match_window > 0:
+        pairs = stitch_new.window_pairs(n, match_window)
+        print(f"顺序匹配: 窗口 {match_window}，{len(pairs)}/{n*(n-1)//2} 对图像进入完整匹配")
+        return pairs
+
+    top_k = STITCH_PAIR_TOP_K if top_k is None else top_k
+    if top_k <= 0 or n <= top_k + 1:
+        return [(i, j) for i in range(n) for j in range(i+1, n)]
+
+    des_list = []
+    for img in images:
+        feats = extract_features(img, detector_type, profile, nfeatures)
+        des_list.append(feats.descriptors if feats is not None else None)
+    pairs = stitch_new.select_candidate_pairs(des_list, top_k=top_k)
+    print(f"全局签名预筛选: {len(pairs)}/{n*(n-1)//2} 对图像进入完整匹配")
+    return pairs
+
+# 图像数达到该值时，关系分析改用全局描述子索引（每张图查询一次）得到候选图像对和匹配，0 表示关闭
+STITCH_GLOBAL_INDEX_MIN_IMAGES = int(os.getenv("STITCH_GLOBAL_INDEX_MIN_IMAGES", "8"))
+
+def global_index_matches(images, detector_type='orb', profile='detect'):
+    """所有图像的描述子放进一个近邻索引，返回 {(i, j): 图i -> 图j 的匹配}；图像较少或顺序匹配模式下返回 None"""
+    n = len(images)
+    if (STITCH_GLOBAL_INDEX_MIN_IMAGES <= 0 or n < STITCH_GLOBAL_INDEX_MIN_IMAGES
+            or registration_settings.get().match_window > 0):
+        return None
+
+    des_list = []
+    for img in images:
+        feats = extract_features(img, detector_type, profile)
+        des_list.append(feats.descriptors if feats is not None else None)
+    fast = matching.MATCH_PROFILES['fast']
+    pairs = matching.global_correspondences(des_list, ratio=fast.ratio, flann_checks=fast.flann_checks,
+                                            min_matches=fast.min_matches)
+    print(f"全局描述子索引: {n} 次查询得到 {len(pairs)}/{n*(n-1)//2} 对候选图像")
+    return pairs
+
+# 当前请求的配准设置，由 /stitch 按请求参数设置，各匹配函数直接读取而不必逐层传参
+registration_settings = contextvars.ContextVar('registration_settings', default=RegistrationSettings())
+
+def extract_features(image, detector_type='sift', profile='gray', nfeatures=2000):
+    """提取图像特征，按 (内容哈希, 检测器, 预处理配置, 配准分辨率) 缓存"""
+    detector_key = f"{detector_type}:{nfeatures}"
+    scale = stitch_new.compute_work_scale(image.shape, registration_settings.get().work_megapix)
+    profile_key = profile if scale >= 1.0 else f"{profile}@{scale:.4f}"
+
+    def compute(img):
+        detector = get_detector(detector_type, nfeatures)
+        if detector is None:
+            return None
+        with span("preprocess"):
+            gray = PREPROCESS_PROFILES[profile](stitch_new.resize_to_work(img, scale))
+        with span("detect"):
+            kps, des = detector.detectAndCompute(gray, None)
+        return FeatureEntry(gray=gray, points=matching.keypoint_array(kps), descriptors=des, scale=scale)
+
+    return feature_store.get_or_compute(image, detector_key, profile_key, compute)
+
+def feature_index(feats):
+    """图像描述子的近邻索引（LSH / KD 树），随特征缓存条目保存，每张图只构建一次，供所有配对图像查询"""
+    return feats.descriptor_index()
+
+def to_full_res_homography(H, from_feats, to_feats, from_pts, mask, from_img, to_img):
+    """把配准分辨率下估计的 H（from -> to）换算回原分辨率，并按设置用原分辨率内点微调"""
+    if from_feats.scale >= 1.0 and to_feats.scale >= 1.0:
+        return H
+
+    H_full = stitch_new.lift_homography(H, from_feats.scale, to_feats.scale)
+    if registration_settings.get().refine_full_res and mask is not None:
+        inlier_pts = from_pts.reshape(-1, 2)[mask.ravel() > 0] / from_feats.scale
+        H_full = stitch_new.refine_homography_full_res(
+            H_full, inlier_pts, from_img, to_img,
+            search_radius=int(math.ceil(2.0 / to_feats.scale)) + 2,
+        )
+    return H_full
+
+# 检测器并发执行的线程池（OpenCV 检测/匹配时释放 GIL）
+detector_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("STITCH_DETECTOR_WORKERS", "4")),
+    thread_name_prefix="detector",
+)
+
+# 各检测器在不同图像类型下的成功率和耗时，用于调整级联顺序
+detector_stats = DetectorStats()
+
+def recorded_matcher(matcher, bucket):
+    """包装 matcher，记录每次调用的检测器、是否成功和耗时；请求已取消时不再开始新的尝试"""
+    def run(img1, img2, detector_type):
+        check_cancelled('detect')
+        started = time.perf_counter()
+        result = matcher(img1, img2, detector_type)
+        detector_stats.record(bucket, detector_type, result is not None, time.perf_counter() - started)
+        return result
+    return run
+
+def iter_detector_results(img1, img2, matcher, detectors, mode=None):
+    """按级联方式运行 matcher(img1, img2, detector_type)，依次产出 (detector_type, result)
+
+    检测器顺序按该类图像（分辨率 × 纹理）的历史成功率和耗时调整，传入的 detectors 为冷启动时的默认顺序。
+    调用方拿到可用结果后直接结束迭代即可：race 模式会取消尚未开始的任务，已在运行的结果被忽略。
+    """
+    mode = mode or registration_settings.get().detector_mode
+    bucket = image_bucket(img1, img2)
+    ordered = detector_stats.order(detectors, bucket)
+    if ordered != list(detectors):
+        print(f"检测器顺序按统计调整({bucket}): {', '.join(ordered)}")
+    detectors = ordered
+    matcher = recorded_matcher(matcher, bucket)
+
+    if mode not in ('race', 'best'):
+        for detector_type in detectors:
+            print(f"尝试使用{detector_type}检测器...")
+            yield detector_type, matcher(img1, img2, detector_type)
+        return
+
+    print(f"并发尝试检测器({mode}): {', '.join(detectors)}")
+    # 每个任务复制一份上下文，保证线程内能读到当前请求的配准设置
+    futures = {
+        detector_executor.submit(contextvars.copy_context().run, matcher, img1, img2, detector_type): detector_type
+        for detector_type in detectors
+    }
+    try:
+        if mode == 'race':
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+        else:
+            wait(futures)
+            # 质量 = 匹配点数 × 内点比例，与 analyze_image_relationships 一致；失败的排在最后
+            ranked = sorted(
+                ((futures[f], f.result()) for f in futures),
+                key=lambda item: item[1][1] * item[1][2] if item[1] is not None else -1,
+                reverse=True,
+            )
+            yield from ranked
+    finally:
+        for future in futures:
+            future.cancel()
+
 def advanced_feature_matching(img1, img2, detector_type='sift'):
     """简化但稳定的特征匹配算法"""
     try:
         print(f"使用{detector_type}进行特征匹配...")
 
-        # 轻度增强用于特征检测
-        enhanced_img1 = enhance_image_for_detection(img1)
-        enhanced_img2 = enhance_image_for_detection(img2)
-
-        # 转换为灰度图
-        gray1 = cv2.cvtColor(enhanced_img1, cv2.COLOR_BGR2GRAY) if len(enhanced_img1.shape) == 3 else enhanced_img1
-        gray2 = cv2.cvtColor(enhanced_img2, cv2.COLOR_BGR2GRAY) if len(enhanced_img2.shape) == 3 else enhanced_img2
-
-        # 创建检测器
-        detector = safe_create_detector(detector_type)
-        if detector is None:
+        # 轻度增强后检测特征点（结果缓存）
+        feats1 = extract_features(img1, detector_type, 'detect')
+        feats2 = extract_features(img2, detector_type, 'detect')
+        if feats1 is None or feats2 is None:
             return None
 
-        # 检测特征点
-        kp1, des1 = detector.detectAndCompute(gray1, None)
-        kp2, des2 = detector.detectAndCompute(gray2, None)
+        kp1, des1 = feats1.points, feats1.descriptors
+        kp2, des2 = feats2.points, feats2.descriptors
 
         if des1 is None or des2 is None or len(kp1) < 10 or len(kp2) < 10:
-            print(f"特征点不足: img1={len(kp1) if kp1 else 0}, img2={len(kp2) if kp2 else 0}")
+            print(f"特征点不足: img1={len(kp1)}, img2={len(kp2)}")
             return None
 
         print(f"找到特征点: img1={len(kp1)}, img2={len(kp2)}")
 
-        # 特征匹配
-        if detector_type in ['sift', 'akaze']:
-            # 使用FLANN匹配器
-            FLANN_INDEX_KDTREE = 1
-            index_params = dict(algorithm=FLANN_INDEX_KDTREE, trees=5)
-            search_params = dict(checks=50)
-            flann = cv2.FlannBasedMatcher(index_params, search_params)
-            matches = flann.knnMatch(des1, des2, k=2)
-        else:
-            # 使用BF匹配器
-            bf = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=False)
-            matches = bf.knnMatch(des1, des2, k=2)
-
-        # Lowe's ratio test
-        good_matches = []
-        for match_pair in matches:
-            if len(match_pair) == 2:
-                m, n = match_pair
-                if m.distance < 0.7 * n.distance:
-                    good_matches.append(m)
+        # 特征匹配 + Lowe's ratio test
+        profile = matching.MATCH_PROFILES['fast']
+        good_matches = matching.match_with_profile(des1, des2, profile, feature_index(feats2))
+        return homography_from_matches(img1, img2, feats1, feats2, good_matches)
 
+    except Exception as e:
+        print(f"特征匹配失败: {e}")
+        return None
+
+def homography_from_matches(img1, img2, feats1, feats2, good_matches):
+    """由图1 -> 图2 的匹配估计把图2映射到图1的 H，返回 (H, matches_count, inlier_ratio)，质量不佳时返回 None"""
+    try:
+        profile = matching.MATCH_PROFILES['fast']
         print(f"找到{len(good_matches)}个好的匹配点")
 
-        if len(good_matches) < 10:
+        if len(good_matches) < profile.min_matches:
             print("匹配点不足")
             return None
 
         # 提取匹配点坐标
-        src_pts = np.float32([kp1[m.queryIdx].pt for m in good_matches]).reshape(-1, 1, 2)
-        dst_pts = np.float32([kp2[m.trainIdx].pt for m in good_matches]).reshape(-1, 1, 2)
+        src_pts, dst_pts = good_matches.points(feats1.points, feats2.points)
 
         # 使用单应性矩阵
-        H, mask = cv2.findHomography(dst_pts, src_pts,
-                                   cv2.RANSAC,
-                                   ransacReprojThreshold=5.0,
-                                   maxIters=5000,
-                                   confidence=0.995)
+        H, mask = matching.estimate_homography(dst_pts, src_pts, profile)
 
         if H is None:
             print("无法计算单应性矩阵")
             return None
 
+        # 配准分辨率下的 H 换算回原分辨率
+        H = to_full_res_homography(H, feats2, feats1, dst_pts, mask, img2, img1)
+
         # 验证单应性矩阵的质量
         inliers = np.sum(mask)
         inlier_ratio = inliers / len(good_matches)
@@ -185,7 +407,7 @@ def advanced_feature_matching(img1, img2, detector_type='sift'):
 
         print(f"内点数量: {inliers}, 内点比例: {inlier_ratio:.2f}")
 
-        if inlier_ratio < 0.3:
+        if inlier_ratio < profile.min_inlier_ratio:
             print("单应性矩阵质量不佳")
             return None
 
@@ -217,69 +439,196 @@ def multi_detector_stitch(img1, img2):
 
     return None
 
-def stitch_with_homography(img1, img2, H):
-    """使用单应性矩阵进行拼接（回到稳定版本）"""
-    try:
-        h1, w1 = img1.shape[:2]
-        h2, w2 = img2.shape[:2]
+def pair_canvas_layout(img1, img2, H, max_size=20000):
+    """两图拼接的画布布局：返回 (宽, 高, 图1偏移 (x, y), 平移后的 H)，尺寸不合理时返回 None"""
+    h1, w1 = img1.shape[:2]
+    h2, w2 = img2.shape[:2]
 
-        # 计算变换后的角点
-        corners2 = np.float32([[0, 0], [w2, 0], [w2, h2], [0, h2]]).reshape(-1, 1, 2)
-        corners2_transformed = cv2.perspectiveTransform(corners2, H)
+    # 计算变换后的角点
+    corners2 = np.float32([[0, 0], [w2, 0], [w2, h2], [0, h2]]).reshape(-1, 1, 2)
+    corners2_transformed = cv2.perspectiveTransform(corners2, H)
 
-        # 计算输出图像的边界
-        corners1 = np.float32([[0, 0], [w1, 0], [w1, h1], [0, h1]]).reshape(-1, 1, 2)
-        all_corners = np.concatenate([corners1, corners2_transformed], axis=0)
+    # 计算输出图像的边界
+    corners1 = np.float32([[0, 0], [w1, 0], [w1, h1], [0, h1]]).reshape(-1, 1, 2)
+    all_corners = np.concatenate([corners1, corners2_transformed], axis=0)
 
-        min_x = int(np.min(all_corners[:, 0, 0]))
-        max_x = int(np.max(all_corners[:, 0, 0]))
-        min_y = int(np.min(all_corners[:, 0, 1]))
-        max_y = int(np.max(all_corners[:, 0, 1]))
+    min_x = int(np.min(all_corners[:, 0, 0]))
+    max_x = int(np.max(all_corners[:, 0, 0]))
+    min_y = int(np.min(all_corners[:, 0, 1]))
+    max_y = int(np.max(all_corners[:, 0, 1]))
 
-        output_width = max_x - min_x
-        output_height = max_y - min_y
+    output_width = max_x - min_x
+    output_height = max_y - min_y
 
-        print(f"输出图像尺寸: {output_width}x{output_height}")
+    print(f"输出图像尺寸: {output_width}x{output_height}")
+
+    # 检查输出尺寸是否合理
+    if output_width <= 0 or output_height <= 0 or output_width > max_size or output_height > max_size:
+        print("输出图像尺寸不合理")
+        return None
 
-        # 检查输出尺寸是否合理
-        if output_width <= 0 or output_height <= 0 or output_width > 20000 or output_height > 20000:
-            print("输出图像尺寸不合理")
+    # 调整变换矩阵
+    translation_matrix = np.array([[1, 0, -min_x], [0, 1, -min_y], [0, 0, 1]])
+    H_adjusted = translation_matrix @ H
+    return output_width, output_height, (-min_x, -min_y), H_adjusted
+
+def projected_roi(img2, H_adjusted, canvas_size, pad=1):
+    """图2插值支撑区域（pixel_quad）投影的外接框，向外取整并留 pad 像素后裁剪到画布，
+    返回 (x0, y0, x1, y1)，框为空时返回 None
+
+    框外不会有非零的插值结果，框内未被画布裁掉的外圈一定为零，在框内做变换和距离变换都与整幅画布上的结果一致
+    """
+    canvas_w, canvas_h = canvas_size
+    h2, w2 = img2.shape[:2]
+    projected = cv2.perspectiveTransform(pixel_quad(w2, h2), H_adjusted).reshape(-1, 2)
+
+    x0 = max(0, int(np.floor(projected[:, 0].min())) - pad)
+    y0 = max(0, int(np.floor(projected[:, 1].min())) - pad)
+    x1 = min(canvas_w, int(np.ceil(projected[:, 0].max())) + pad)
+    y1 = min(canvas_h, int(np.ceil(projected[:, 1].max())) + pad)
+    if x1 <= x0 or y1 <= y0:
+        return None
+    return x0, y0, x1, y1
+
+def warp_to_roi(img2, H_adjusted, canvas_size, with_alpha=True):
+    """只在图2投影的外接框（裁剪到画布）内做透视变换
+
+    返回 (x0, y0, 变换后的图2, alpha 掩码)，with_alpha=False 时掩码为 None，框为空时返回 None
+    """
+    roi = projected_roi(img2, H_adjusted, canvas_size)
+    if roi is None:
+        return None
+    x0, y0, x1, y1 = roi
+    h2, w2 = img2.shape[:2]
+
+    H_roi = np.array([[1, 0, -x0], [0, 1, -y0], [0, 0, 1]], dtype=np.float64) @ H_adjusted
+    roi_size = (x1 - x0, y1 - y0)
+    with span("warp"):
+        warped = cv2.warpPerspective(img2, H_roi, roi_size)
+        alpha = cv2.warpPerspective(np.full((h2, w2), 255, dtype=np.uint8), H_roi, roi_size) if with_alpha else None
+    return x0, y0, warped, alpha
+
+def plan_pair_blend(img1, img2, H_adjusted, canvas_size, offset):
+    """分配画布之前按内存预算选择两图的融合方式"""
+    roi = projected_roi(img2, H_adjusted, canvas_size) or (0, 0, 0, 0)
+    h1, w1 = img1.shape[:2]
+    overlap_w = max(0, min(roi[2], offset[0] + w1) - max(roi[0], offset[0]))
+    overlap_h = max(0, min(roi[3], offset[1] + h1) - max(roi[1], offset[1]))
+
+    plan = plan_blend(canvas_size, input_bytes=images_nbytes((img1, img2)),
+                      roi_size=(roi[2] - roi[0], roi[3] - roi[1]), overlap_size=(overlap_w, overlap_h))
+    print(f"融合方案: {plan.describe()}")
+    return plan
+
+def blend_pair_tiled(img1, img2, H_adjusted, offset, plan):
+    """画布超出整图融合的内存预算时改用分块融合（可同时缩小输出）"""
+    S = np.diag([plan.scale, plan.scale, 1.0])
+    M_final = {
+        0: S @ np.array([[1, 0, offset[0]], [0, 1, offset[1]], [0, 0, 1]], dtype=np.float64),
+        1: S @ H_adjusted,
+    }
+    return stitch_new.tiled_blend_parallel({0: img1, 1: img2}, M_final, plan.canvas_size,
+                                           tile_size=plan.tile_size, workers=plan.workers,
+                                           blend_method='distance', fill_value=0)
+
+def rect_mask(shape, rect):
+    """在 shape 大小的区域内生成矩形 rect=(x0, y0, x1, y1) 的掩码（自动裁剪）"""
+    mask = np.zeros(shape[:2], dtype=np.uint8)
+    x0, y0, x1, y1 = rect
+    mask[max(0, y0):max(0, y1), max(0, x0):max(0, x1)] = 255
+    return mask
+
+def pixel_quad(w, h):
+    """w x h 图像掩码的零值边界四边形（与掩码上做距离变换的像素距离一致）"""
+    return np.float32([[-1, -1], [w, -1], [w, h], [-1, h]]).reshape(-1, 1, 2)
+
+def convex_edge_distance(corners, xs, ys, canvas_size):
+    """凸四边形内像素到其边界的距离，即到各条边所在直线距离的最小值
+
+    落在画布外侧的边不算边界，与在整幅画布上做 distanceTransform 的结果一致，
+    但只需计算 xs x ys 网格，不必为整幅画布分配掩码和距离图
+    """
+    canvas_w, canvas_h = canvas_size
+    corners = corners.reshape(-1, 2)
+    dist = np.full((len(ys), len(xs)), 1e9, dtype=np.float32)
+    for k in range(len(corners)):
+        (ax, ay), (bx, by) = corners[k], corners[(k + 1) % len(corners)]
+        if ((ax < 0 and bx < 0) or (ay < 0 and by < 0) or
+                (ax > canvas_w - 1 and bx > canvas_w - 1) or (ay > canvas_h - 1 and by > canvas_h - 1)):
+            continue
+        nx, ny = by - ay, ax - bx
+        norm = math.hypot(nx, ny)
+        if norm == 0:
+            continue
+        edge_dist = np.abs((xs[None, :] - ax) * (nx / norm) + (ys[:, None] - ay) * (ny / norm)).astype(np.float32)
+        np.minimum(dist, edge_dist, out=dist)
+    return dist
+
+def overlap_distance_weights(quad1, mask2, overlap, origin, canvas_size):
+    """只在重叠区外接框内计算两图的距离权重
+
+    quad1 为图1在画布坐标下的边界矩形，轴对齐矩形的 distanceTransform 距离即到各边的距离，直接按边计算；
+    图2的距离在其投影 ROI 的掩码 mask2 上做 distanceTransform（ROI 外圈为零，与整幅画布上的结果一致）。
+    origin 为 ROI 左上角的画布坐标，返回 ((y0, y1, x0, x1), 图1权重)，权重为 dist1 / (dist1 + dist2)
+    """
+    ys, xs = np.nonzero(overlap)
+    y0, y1 = ys.min(), ys.max() + 1
+    x0, x1 = xs.min(), xs.max() + 1
+    grid_x = np.arange(x0, x1, dtype=np.float32) + origin[0]
+    grid_y = np.arange(y0, y1, dtype=np.float32) + origin[1]
+
+    dist1 = convex_edge_distance(quad1, grid_x, grid_y, canvas_size)
+    dist2 = cv2.distanceTransform(mask2, cv2.DIST_L2, 5)[y0:y1, x0:x1]
+    total_dist = dist1 + dist2
+    total_dist[total_dist == 0] = 1  # 避免除零
+    return (y0, y1, x0, x1), dist1 / total_dist
+
+def stitch_with_homography(img1, img2, H):
+    """使用单应性矩阵进行拼接（回到稳定版本）"""
+    try:
+        h1, w1 = img1.shape[:2]
+        layout = pair_canvas_layout(img1, img2, H)
+        if layout is None:
             return None
+        output_width, output_height, (x1_start, y1_start), H_adjusted = layout
 
-        # 调整变换矩阵
-        translation_matrix = np.array([[1, 0, -min_x], [0, 1, -min_y], [0, 0, 1]])
-        H_adjusted = translation_matrix @ H
+        plan = plan_pair_blend(img1, img2, H_adjusted, (output_width, output_height), (x1_start, y1_start))
+        if plan.mode != 'memory':
+            return blend_pair_tiled(img1, img2, H_adjusted, (x1_start, y1_start), plan)
 
-        # 创建输出图像
+        # 创建输出图像，放置第一张图像
         result = np.zeros((output_height, output_width, 3), dtype=np.uint8)
+        result[y1_start:y1_start + h1, x1_start:x1_start + w1] = img1
 
-        # 放置第一张图像
-        y1_start = -min_y
-        y1_end = y1_start + h1
-        x1_start = -min_x
-        x1_end = x1_start + w1
-        result[y1_start:y1_end, x1_start:x1_end] = img1
-
-        # 变换并放置第二张图像
-        warped_img2 = cv2.warpPerspective(img2, H_adjusted, (output_width, output_height))
+        # 只在图2的投影范围内变换，框外变换结果为零，掩码（像素和，与原有逻辑一致）也只需在框内计算
+        warp = warp_to_roi(img2, H_adjusted, (output_width, output_height), with_alpha=False)
+        if warp is None:
+            # 图2投影为空，只有图1
+            print("拼接完成")
+            return result
+        rx, ry, warped_img2, _ = warp
+        rh, rw = warped_img2.shape[:2]
+        roi = result[ry:ry + rh, rx:rx + rw]
 
-        # 简化的图像融合（回到原有逻辑）
-        mask2 = (warped_img2.sum(axis=2) > 0)
-        mask1 = (result.sum(axis=2) > 0)
-        overlap = mask1 & mask2
+        with span("blend"):
+            mask2 = warped_img2.sum(axis=2) > 0
+            mask1 = roi.sum(axis=2) > 0
+            overlap = mask1 & mask2
 
-        # 在重叠区域进行简单加权融合
-        if np.any(overlap):
-            alpha = 0.5  # 简单的50-50融合
-            result[overlap] = (alpha * result[overlap] + (1-alpha) * warped_img2[overlap]).astype(np.uint8)
+            # 在重叠区域进行简单加权融合
+            if np.any(overlap):
+                alpha = 0.5  # 简单的50-50融合
+                roi[overlap] = (alpha * roi[overlap] + (1-alpha) * warped_img2[overlap]).astype(np.uint8)
 
-        # 非重叠区域直接复制
-        non_overlap_mask2 = mask2 & ~overlap
-        result[non_overlap_mask2] = warped_img2[non_overlap_mask2]
+            # 非重叠区域直接复制
+            non_overlap_mask2 = mask2 & ~overlap
+            roi[non_overlap_mask2] = warped_img2[non_overlap_mask2]
 
         print("拼接完成")
         return result
 
+    except MemoryBudgetError:
+        raise
     except Exception as e:
         print(f"拼接过程出错: {e}")
         traceback.print_exc()
@@ -289,89 +638,59 @@ def enhanced_stitch_with_perspective(img1, img2, H):
     """增强的透视变换拼接，优化重叠区域处理"""
     try:
         h1, w1 = img1.shape[:2]
-        h2, w2 = img2.shape[:2]
-
-        # 计算变换后的角点
-        corners2 = np.float32([[0, 0], [w2, 0], [w2, h2], [0, h2]]).reshape(-1, 1, 2)
-        corners2_transformed = cv2.perspectiveTransform(corners2, H)
-
-        # 计算输出图像的边界
-        corners1 = np.float32([[0, 0], [w1, 0], [w1, h1], [0, h1]]).reshape(-1, 1, 2)
-        all_corners = np.concatenate([corners1, corners2_transformed], axis=0)
-
-        min_x = int(np.min(all_corners[:, 0, 0]))
-        max_x = int(np.max(all_corners[:, 0, 0]))
-        min_y = int(np.min(all_corners[:, 0, 1]))
-        max_y = int(np.max(all_corners[:, 0, 1]))
-
-        output_width = max_x - min_x
-        output_height = max_y - min_y
-
-        print(f"输出图像尺寸: {output_width}x{output_height}")
-
-        # 检查输出尺寸是否合理
-        if output_width <= 0 or output_height <= 0 or output_width > 20000 or output_height > 20000:
-            print("输出图像尺寸不合理")
+        layout = pair_canvas_layout(img1, img2, H)
+        if layout is None:
             return None
+        output_width, output_height, (x1_start, y1_start), H_adjusted = layout
 
-        # 调整变换矩阵
-        translation_matrix = np.array([[1, 0, -min_x], [0, 1, -min_y], [0, 0, 1]])
-        H_adjusted = translation_matrix @ H
+        plan = plan_pair_blend(img1, img2, H_adjusted, (output_width, output_height), (x1_start, y1_start))
+        if plan.mode != 'memory':
+            return blend_pair_tiled(img1, img2, H_adjusted, (x1_start, y1_start), plan)
 
-        # 创建输出图像和掩码
+        # 创建输出图像，放置第一张图像
         result = np.zeros((output_height, output_width, 3), dtype=np.uint8)
-        mask1 = np.zeros((output_height, output_width), dtype=np.uint8)
-        mask2 = np.zeros((output_height, output_width), dtype=np.uint8)
-
-        # 放置第一张图像
-        y1_start = -min_y
-        y1_end = y1_start + h1
-        x1_start = -min_x
-        x1_end = x1_start + w1
-
-        result[y1_start:y1_end, x1_start:x1_end] = img1
-        mask1[y1_start:y1_end, x1_start:x1_end] = 255
-
-        # 变换第二张图像
-        warped_img2 = cv2.warpPerspective(img2, H_adjusted, (output_width, output_height))
-
-        # 创建第二张图像的掩码
-        temp_mask = np.ones((h2, w2), dtype=np.uint8) * 255
-        warped_mask2 = cv2.warpPerspective(temp_mask, H_adjusted, (output_width, output_height))
-        mask2 = warped_mask2
-
-        # 找到重叠区域
-        overlap_mask = (mask1 > 0) & (mask2 > 0)
-
-        if np.any(overlap_mask):
-            print(f"检测到重叠区域，像素数: {np.sum(overlap_mask)}")
-
-            # 使用距离变换进行渐变融合
-            # 计算到边界的距离
-            dist1 = cv2.distanceTransform(mask1, cv2.DIST_L2, 5)
-            dist2 = cv2.distanceTransform(mask2, cv2.DIST_L2, 5)
-
-            # 在重叠区域计算权重
-            total_dist = dist1 + dist2
-            total_dist[total_dist == 0] = 1  # 避免除零
+        result[y1_start:y1_start + h1, x1_start:x1_start + w1] = img1
 
-            weight1 = dist1 / total_dist
-            weight2 = dist2 / total_dist
-
-            # 应用加权融合
-            for c in range(3):  # 对每个颜色通道
-                result[overlap_mask, c] = (
-                    weight1[overlap_mask] * result[overlap_mask, c] +
-                    weight2[overlap_mask] * warped_img2[overlap_mask, c]
-                ).astype(np.uint8)
-
-        # 非重叠区域直接复制第二张图像
-        non_overlap_mask2 = (mask2 > 0) & (mask1 == 0)
-        result[non_overlap_mask2] = warped_img2[non_overlap_mask2]
+        # 变换第二张图像（只在其投影范围内），掩码为同一变换下的 alpha
+        warp = warp_to_roi(img2, H_adjusted, (output_width, output_height))
+        if warp is None:
+            # 图2投影为空，只有图1
+            print("增强透视拼接完成")
+            return result
+        rx, ry, warped_img2, mask2 = warp
+        rh, rw = mask2.shape
+        roi = result[ry:ry + rh, rx:rx + rw]
+        with span("blend"):
+            mask1 = rect_mask(mask2.shape, (x1_start - rx, y1_start - ry, x1_start - rx + w1, y1_start - ry + h1))
+
+            # 找到重叠区域
+            overlap_mask = (mask1 > 0) & (mask2 > 0)
+
+            if np.any(overlap_mask):
+                print(f"检测到重叠区域，像素数: {np.sum(overlap_mask)}")
+
+                # 按到两图边界的距离渐变融合，只在重叠区外接框内计算
+                quad1 = pixel_quad(w1, h1) + np.float32([x1_start, y1_start])
+                (oy0, oy1, ox0, ox1), weight1 = overlap_distance_weights(
+                    quad1, mask2, overlap_mask, (rx, ry), (output_width, output_height))
+                box_overlap = overlap_mask[oy0:oy1, ox0:ox1]
+                box_result = roi[oy0:oy1, ox0:ox1]
+                box_warped = warped_img2[oy0:oy1, ox0:ox1]
+
+                alpha1 = weight1[..., None]
+                alpha2 = 1 - alpha1
+                blended = (alpha1 * box_result + alpha2 * box_warped).astype(np.uint8)
+                box_result[box_overlap] = blended[box_overlap]
+
+            # 非重叠区域直接复制第二张图像
+            non_overlap_mask2 = (mask2 > 0) & (mask1 == 0)
+            roi[non_overlap_mask2] = warped_img2[non_overlap_mask2]
 
         print("增强透视拼接完成")
         return result
 
+    except MemoryBudgetError:
+        raise
     except Exception as e:
         print(f"增强透视拼接失败: {e}")
         traceback.print_exc()
@@ -382,84 +701,44 @@ def improved_feature_matching(img1, img2, detector_type='sift'):
     try:
         print(f"使用{detector_type}进行改进特征匹配...")
 
-        # 图像预处理 - 增强对比度和锐化
-        def preprocess_for_matching(img):
-            # 转换为灰度图
-            if len(img.shape) == 3:
-                gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-            else:
-                gray = img.copy()
-
-            # 应用CLAHE增强对比度
-            clahe = cv2.createCLAHE(clipLimit=3.0, tileGridSize=(8,8))
-            enhanced = clahe.apply(gray)
-
-            # 轻度高斯模糊去噪
-            denoised = cv2.GaussianBlur(enhanced, (3, 3), 0)
-
-            return denoised
-
-        gray1 = preprocess_for_matching(img1)
-        gray2 = preprocess_for_matching(img2)
-
-        # 创建检测器
-        detector = safe_create_detector(detector_type)
-        if detector is None:
+        # CLAHE + 去噪后检测特征点（结果缓存）
+        feats1 = extract_features(img1, detector_type, 'improved')
+        feats2 = extract_features(img2, detector_type, 'improved')
+        if feats1 is None or feats2 is None:
             return None
 
-        # 检测特征点
-        kp1, des1 = detector.detectAndCompute(gray1, None)
-        kp2, des2 = detector.detectAndCompute(gray2, None)
+        kp1, des1 = feats1.points, feats1.descriptors
+        kp2, des2 = feats2.points, feats2.descriptors
 
         if des1 is None or des2 is None or len(kp1) < 15 or len(kp2) < 15:
-            print(f"特征点不足: img1={len(kp1) if kp1 else 0}, img2={len(kp2) if kp2 else 0}")
+            print(f"特征点不足: img1={len(kp1)}, img2={len(kp2)}")
             return None
 
         print(f"找到特征点: img1={len(kp1)}, img2={len(kp2)}")
 
-        # 特征匹配
-        if detector_type in ['sift', 'akaze']:
-            # 使用FLANN匹配器
-            FLANN_INDEX_KDTREE = 1
-            index_params = dict(algorithm=FLANN_INDEX_KDTREE, trees=5)
-            search_params = dict(checks=50)
-            flann = cv2.FlannBasedMatcher(index_params, search_params)
-            matches = flann.knnMatch(des1, des2, k=2)
-        else:
-            # 使用BF匹配器
-            bf = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=False)
-            matches = bf.knnMatch(des1, des2, k=2)
-
-        # 改进的Lowe's ratio test
-        good_matches = []
-        for match_pair in matches:
-            if len(match_pair) == 2:
-                m, n = match_pair
-                # 使用更严格的比例测试
-                if m.distance < 0.65 * n.distance:  # 从0.7降到0.65
-                    good_matches.append(m)
+        # 特征匹配 + 更严格的 ratio test（strict：0.65，至少 15 个匹配点）
+        profile = matching.MATCH_PROFILES['strict']
+        good_matches = matching.match_with_profile(des1, des2, profile, feature_index(feats2))
 
         print(f"找到{len(good_matches)}个好的匹配点")
 
-        if len(good_matches) < 15:  # 提高最小匹配点要求
+        if len(good_matches) < profile.min_matches:
             print("匹配点不足")
             return None
 
         # 提取匹配点坐标
-        src_pts = np.float32([kp1[m.queryIdx].pt for m in good_matches]).reshape(-1, 1, 2)
-        dst_pts = np.float32([kp2[m.trainIdx].pt for m in good_matches]).reshape(-1, 1, 2)
+        src_pts, dst_pts = good_matches.points(kp1, kp2)
 
-        # 使用更严格的RANSAC参数计算单应性矩阵
-        H, mask = cv2.findHomography(dst_pts, src_pts,
-                                   cv2.RANSAC,
-                                   ransacReprojThreshold=3.0,  # 从5.0降到3.0
-                                   maxIters=10000,  # 增加迭代次数
-                                   confidence=0.999)  # 提高置信度
+        # 使用更严格的RANSAC参数计算单应性矩阵（阈值 3.0，10000 次迭代，置信度 0.999）
+        H, mask = matching.estimate_homography(dst_pts, src_pts, profile)
 
         if H is None:
             print("无法计算单应性矩阵")
             return None
 
+        # 配准分辨率下的 H 换算回原分辨率
+        H = to_full_res_homography(H, feats2, feats1, dst_pts, mask, img2, img1)
+
         # 验证单应性矩阵的质量
         inliers = np.sum(mask)
         inlier_ratio = inliers / len(good_matches)
@@ -468,7 +747,7 @@ def improved_feature_matching(img1, img2, detector_type='sift'):
         print(f"内点数量: {inliers}, 内点比例: {inlier_ratio:.2f}")
 
         # 提高质量要求
-        if inlier_ratio < 0.4 or inliers < 10:  # 提高内点比例要求
+        if inlier_ratio < profile.min_inlier_ratio or inliers < profile.min_inliers:
             print("单应性矩阵质量不佳")
             return None
 
@@ -496,10 +775,7 @@ def enhanced_simple_stitch_two_images(img1, img2):
         # 尝试多种检测器进行改进的特征匹配
         detectors = ['sift', 'akaze', 'orb', 'brisk']
 
-        for detector_type in detectors:
-            print(f"尝试使用{detector_type}检测器...")
-            result = improved_feature_matching(img1, img2, detector_type)
-
+        for detector_type, result in iter_detector_results(img1, img2, improved_feature_matching, detectors):
             if result is not None:
                 H, matches_count, inlier_ratio = result
                 print(f"{detector_type}检测器成功找到匹配，匹配点数：{matches_count}，内点比例：{inlier_ratio:.2f}")
@@ -548,6 +824,8 @@ def enhanced_simple_stitch_two_images(img1, img2):
         print("无法进行拼接")
         return None
 
+    except MemoryBudgetError:
+        raise
     except Exception as e:
         print(f"增强拼接过程出错: {e}")
         traceback.print_exc()
@@ -618,91 +896,51 @@ def robust_feature_matching_for_overlap(img1, img2, detector_type='sift'):
     try:
         print(f"使用{detector_type}进行重叠图片特征匹配...")
 
-        # 增强图像预处理
-        def enhance_for_overlap_detection(img):
-            if len(img.shape) == 3:
-                gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-            else:
-                gray = img.copy()
-
-            # 直方图均衡化
-            equalized = cv2.equalizeHist(gray)
-
-            # CLAHE增强对比度
-            clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
-            enhanced = clahe.apply(equalized)
-
-            # 轻度锐化
-            kernel = np.array([[-1,-1,-1], [-1,9,-1], [-1,-1,-1]])
-            sharpened = cv2.filter2D(enhanced, -1, kernel)
-
-            return sharpened
-
-        gray1 = enhance_for_overlap_detection(img1)
-        gray2 = enhance_for_overlap_detection(img2)
-
-        # 创建检测器
-        detector = safe_create_detector(detector_type)
-        if detector is None:
+        # 均衡化 + CLAHE + 锐化后检测特征点（结果缓存）
+        feats1 = extract_features(img1, detector_type, 'overlap')
+        feats2 = extract_features(img2, detector_type, 'overlap')
+        if feats1 is None or feats2 is None:
             return None
 
-        # 检测特征点
-        kp1, des1 = detector.detectAndCompute(gray1, None)
-        kp2, des2 = detector.detectAndCompute(gray2, None)
+        kp1, des1 = feats1.points, feats1.descriptors
+        kp2, des2 = feats2.points, feats2.descriptors
 
         if des1 is None or des2 is None or len(kp1) < 20 or len(kp2) < 20:
-            print(f"特征点不足: img1={len(kp1) if kp1 else 0}, img2={len(kp2) if kp2 else 0}")
+            print(f"特征点不足: img1={len(kp1)}, img2={len(kp2)}")
             return None
 
         print(f"找到特征点: img1={len(kp1)}, img2={len(kp2)}")
 
-        # 特征匹配
-        if detector_type in ['sift', 'akaze']:
-            FLANN_INDEX_KDTREE = 1
-            index_params = dict(algorithm=FLANN_INDEX_KDTREE, trees=5)
-            search_params = dict(checks=100)  # 增加搜索精度
-            flann = cv2.FlannBasedMatcher(index_params, search_params)
-            matches = flann.knnMatch(des1, des2, k=2)
-        else:
-            bf = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=False)
-            matches = bf.knnMatch(des1, des2, k=2)
-
-        # 更严格的Lowe's ratio test
-        good_matches = []
-        for match_pair in matches:
-            if len(match_pair) == 2:
-                m, n = match_pair
-                if m.distance < 0.6 * n.distance:  # 更严格的比例
-                    good_matches.append(m)
+        # 特征匹配 + 最严格的 ratio test（overlap：0.6，KD 树搜索精度 100）
+        profile = matching.MATCH_PROFILES['overlap']
+        good_matches = matching.match_with_profile(des1, des2, profile, feature_index(feats2))
 
         print(f"找到{len(good_matches)}个好的匹配点")
 
-        if len(good_matches) < 20:  # 提高最小匹配点要求
+        if len(good_matches) < profile.min_matches:
             print("匹配点不足")
             return None
 
         # 提取匹配点坐标
-        src_pts = np.float32([kp1[m.queryIdx].pt for m in good_matches]).reshape(-1, 1, 2)
-        dst_pts = np.float32([kp2[m.trainIdx].pt for m in good_matches]).reshape(-1, 1, 2)
+        src_pts, dst_pts = good_matches.points(kp1, kp2)
 
-        # 使用更严格的RANSAC参数
-        H, mask = cv2.findHomography(dst_pts, src_pts,
-                                   cv2.RANSAC,
-                                   ransacReprojThreshold=2.0,  # 更严格的阈值
-                                   maxIters=15000,
-                                   confidence=0.999)
+        # 使用更严格的RANSAC参数（阈值 2.0）
+        H, mask = matching.estimate_homography(dst_pts, src_pts, profile)
 
         if H is None:
             print("无法计算单应性矩阵")
             return None
 
+        # 配准分辨率下的 H 换算回原分辨率
+        H = to_full_res_homography(H, feats2, feats1, dst_pts, mask, img2, img1)
+
         # 验证单应性矩阵质量
         inliers = np.sum(mask)
         inlier_ratio = inliers / len(good_matches)
 
         print(f"内点数量: {inliers}, 内点比例: {inlier_ratio:.2f}")
 
-        if inlier_ratio < 0.5 or inliers < 15:  # 更严格的质量要求
+        if inlier_ratio < profile.min_inlier_ratio or inliers < profile.min_inliers:
             print("单应性矩阵质量不佳")
             return None
 
@@ -760,16 +998,16 @@ def simple_stitch_two_images(img1, img2):
 
         # 尝试多种检测器进行鲁棒特征匹配
         detectors = ['sift', 'akaze', 'orb']
+        report_progress('detect', 10)
 
-        for detector_type in detectors:
-            print(f"尝试使用{detector_type}检测器...")
-            result = robust_feature_matching_for_overlap(img1, img2, detector_type)
-
+        for detector_type, result in iter_detector_results(img1, img2, robust_feature_matching_for_overlap, detectors):
+            report_progress('match', 50)
             if result is not None:
                 H, matches_count, inlier_ratio = result
                 print(f"{detector_type}检测器成功，匹配点数：{matches_count}，内点比例：{inlier_ratio:.2f}")
 
                 # 使用验证过的单应性矩阵进行拼接
+                report_progress('warp', 60)
                 stitched = stitch_with_homography(img1, img2, H)
                 if stitched is not None:
                     return stitched
@@ -780,6 +1018,8 @@ def simple_stitch_two_images(img1, img2):
         print("特征匹配失败，尝试简单拼接...")
         return fallback_simple_stitch(img1, img2)
 
+    except MemoryBudgetError:
+        raise
     except Exception as e:
         print(f"拼接过程出错: {e}")
         return fallback_simple_stitch(img1, img2)
@@ -794,51 +1034,33 @@ def find_best_stitch_order(images):
         if n <= 2:
             return list(range(n))
 
-        # 计算图像间的相似度矩阵
+        # 计算图像间的相似度矩阵（未通过全局签名预筛选的图像对相似度为 0）
         similarity_matrix = np.zeros((n, n))
 
-        for i in range(n):
-            for j in range(i+1, n):
-                # 使用SIFT特征计算相似度
-                try:
-                    detector = cv2.SIFT_create(nfeatures=500)
-
-                    # 转换为灰度图
-                    gray1 = cv2.cvtColor(images[i], cv2.COLOR_BGR2GRAY) if len(images[i].shape) == 3 else images[i]
-                    gray2 = cv2.cvtColor(images[j], cv2.COLOR_BGR2GRAY) if len(images[j].shape) == 3 else images[j]
-
-                    # 检测特征点
-                    kp1, des1 = detector.detectAndCompute(gray1, None)
-                    kp2, des2 = detector.detectAndCompute(gray2, None)
-
-                    if des1 is not None and des2 is not None and len(des1) > 10 and len(des2) > 10:
-                        # 使用FLANN匹配器
-                        FLANN_INDEX_KDTREE = 1
-                        index_params = dict(algorithm=FLANN_INDEX_KDTREE, trees=5)
-                        search_params = dict(checks=50)
-                        flann = cv2.FlannBasedMatcher(index_params, search_params)
-
-                        matches = flann.knnMatch(des1, des2, k=2)
-
-                        # Lowe's ratio test
-                        good_matches = []
-                        for match_pair in matches:
-                            if len(match_pair) == 2:
-                                m, n = match_pair
-                                if m.distance < 0.7 * n.distance:
-                                    good_matches.append(m)
-
-                        # 相似度基于好的匹配点数量
-                        similarity = len(good_matches)
-                        similarity_matrix[i][j] = similarity
-                        similarity_matrix[j][i] = similarity
-
-                        print(f"图像{i+1}和图像{j+1}的匹配点数: {similarity}")
-
-                except Exception as e:
-                    print(f"计算图像{i+1}和{j+1}相似度失败: {e}")
-                    similarity_matrix[i][j] = 0
-                    similarity_matrix[j][i] = 0
+        for i, j in select_candidate_pairs(images, 'sift', 'gray', nfeatures=500):
+            # 使用SIFT特征计算相似度
+            try:
+                # 检测特征点（每张图只检测一次，结果缓存）
+                feats1 = extract_features(images[i], 'sift', 'gray', nfeatures=500)
+                feats2 = extract_features(images[j], 'sift', 'gray', nfeatures=500)
+                des1 = feats1.descriptors if feats1 is not None else None
+                des2 = feats2.descriptors if feats2 is not None else None
+
+                if des1 is not None and des2 is not None and len(des1) > 10 and len(des2) > 10:
+                    good_matches = matching.match_with_profile(des1, des2, matching.MATCH_PROFILES['fast'],
+                                                               feature_index(feats2))
+
+                    # 相似度基于好的匹配点数量
+                    similarity = len(good_matches)
+                    similarity_matrix[i][j] = similarity
+                    similarity_matrix[j][i] = similarity
+
+                    print(f"图像{i+1}和图像{j+1}的匹配点数: {similarity}")
+
+            except Exception as e:
+                print(f"计算图像{i+1}和{j+1}相似度失败: {e}")
+                similarity_matrix[i][j] = 0
+                similarity_matrix[j][i] = 0
 
         # 使用贪心算法找到最佳拼接顺序
         visited = [False] * n
@@ -899,59 +1121,68 @@ def analyze_image_relationships(images):
         n = len(images)
         relationships = {}
 
-        # 为每对图像计算变换关系
-        for i in range(n):
-            for j in range(i+1, n):
-                print(f"分析图像{i+1}和图像{j+1}的关系...")
-
-                # 使用多检测器策略，而不是只用SIFT
-                detectors = ['orb', 'akaze', 'sift', 'brisk']  # ORB优先，因为在你的测试中表现最好
-                result = None
-
-                for detector_type in detectors:
-                    print(f"尝试使用{detector_type}检测器...")
-                    result = advanced_feature_matching(images[i], images[j], detector_type)
+        # 为每对候选图像计算变换关系（ORB 描述子与下面 advanced_feature_matching 共用特征缓存）
+        # 图像较多时由全局描述子索引直接给出候选图像对及其 ORB 匹配
+        global_matches = global_index_matches(images)
+        pairs = sorted(global_matches) if global_matches is not None else select_candidate_pairs(images, 'orb', 'detect')
+        for i, j in pairs:
+            print(f"分析图像{i+1}和图像{j+1}的关系...")
+
+            # 使用多检测器策略，而不是只用SIFT；实际顺序由 detector_stats 按历史结果调整
+            detectors = ['orb', 'akaze', 'sift', 'brisk']
+            result = None
+
+            if global_matches is not None:
+                result = homography_from_matches(images[i], images[j],
+                                                 extract_features(images[i], 'orb', 'detect'),
+                                                 extract_features(images[j], 'orb', 'detect'),
+                                                 global_matches[(i, j)])
+                if result is not None:
+                    print("全局索引匹配成功")
 
+            if result is None:
+                for detector_type, result in iter_detector_results(images[i], images[j], advanced_feature_matching,
+                                                                   detectors, mode='sequential'):
                     if result is not None:
                         print(f"{detector_type}检测器成功找到匹配")
                         break
                     else:
                         print(f"{detector_type}检测器匹配失败")
 
-                if result is not None:
-                    H, matches_count, inlier_ratio = result
-
-                    # 分析变换类型和质量
-                    if matches_count > 4 and inlier_ratio > 0.15:  # 使用更宽松的阈值
-                        # 计算变换的方向和重叠程度
-                        h1, w1 = images[i].shape[:2]
-                        h2, w2 = images[j].shape[:2]
-
-                        # 计算图像j相对于图像i的位置
-                        corners_j = np.float32([[0, 0], [w2, 0], [w2, h2], [0, h2]]).reshape(-1, 1, 2)
-                        transformed_corners = cv2.perspectiveTransform(corners_j, H)
-
-                        # 计算重心偏移
-                        center_j_original = np.array([w2/2, h2/2])
-                        center_j_transformed = cv2.perspectiveTransform(
-                            center_j_original.reshape(1, 1, 2), H
-                        )[0, 0]
-
-                        offset_x = center_j_transformed[0] - w1/2
-                        offset_y = center_j_transformed[1] - h1/2
-
-                        relationships[(i, j)] = {
-                            'homography': H,
-                            'matches': matches_count,
-                            'inlier_ratio': inlier_ratio,
-                            'offset_x': offset_x,
-                            'offset_y': offset_y,
-                            'quality': matches_count * inlier_ratio
-                        }
-
-                        print(f"图像{i+1}→{j+1}: 匹配点{matches_count}, 内点比例{inlier_ratio:.2f}, 偏移({offset_x:.1f}, {offset_y:.1f})")
-                else:
-                    print(f"图像{i+1}和图像{j+1}无法建立匹配关系")
+            if result is not None:
+                H, matches_count, inlier_ratio = result
+
+                # 分析变换类型和质量
+                if matches_count > 4 and inlier_ratio > 0.15:  # 使用更宽松的阈值
+                    # 计算变换的方向和重叠程度
+                    h1, w1 = images[i].shape[:2]
+                    h2, w2 = images[j].shape[:2]
+
+                    # 计算图像j相对于图像i的位置
+                    corners_j = np.float32([[0, 0], [w2, 0], [w2, h2], [0, h2]]).reshape(-1, 1, 2)
+                    transformed_corners = cv2.perspectiveTransform(corners_j, H)
+
+                    # 计算重心偏移
+                    center_j_original = np.array([w2/2, h2/2])
+                    center_j_transformed = cv2.perspectiveTransform(
+                        center_j_original.reshape(1, 1, 2), H
+                    )[0, 0]
+
+                    offset_x = center_j_transformed[0] - w1/2
+                    offset_y = center_j_transformed[1] - h1/2
+
+                    relationships[(i, j)] = {
+                        'homography': H,
+                        'matches': matches_count,
+                        'inlier_ratio': inlier_ratio,
+                        'offset_x': offset_x,
+                        'offset_y': offset_y,
+                        'quality': matches_count * inlier_ratio
+                    }
+
+                    print(f"图像{i+1}→{j+1}: 匹配点{matches_count}, 内点比例{inlier_ratio:.2f}, 偏移({offset_x:.1f}, {offset_y:.1f})")
+            else:
+                print(f"图像{i+1}和图像{j+1}无法建立匹配关系")
 
         return relationships
 
@@ -1067,6 +1298,7 @@ def smart_multi_image_stitch(images):
         stitcher_modes = [cv2.Stitcher_PANORAMA, cv2.Stitcher_SCANS]
 
         for mode in stitcher_modes:
+            check_cancelled('match')
             try:
                 print(f"尝试OpenCV拼接模式: {mode}")
                 stitcher = cv2.Stitcher_create(mode)
@@ -1086,22 +1318,23 @@ def smart_multi_image_stitch(images):
         # OpenCV失败，使用基于关系的渐进拼接
         print("使用基于关系的渐进拼接...")
 
-        # 从中心图像开始
+        # 从中心图像开始，各图只与已放置的原图配准，最后一次性渲染
         center_idx = layout_order[0]
-        result = processed_images[center_idx]
+        accumulator = TransformAccumulator(processed_images, reference_idx=center_idx)
         stitched_indices = {center_idx}
+        failed_indices = set()
 
         print(f"从中心图像{center_idx+1}开始拼接")
 
         # 逐步添加最相关的图像
-        while len(stitched_indices) < len(processed_images):
+        while len(stitched_indices) + len(failed_indices) < len(processed_images):
             best_candidate = None
             best_quality = 0
             best_relationship = None
 
             # 找到与已拼接图像最相关的候选图像
             for candidate in range(len(processed_images)):
-                if candidate in stitched_indices:
+                if candidate in stitched_indices or candidate in failed_indices:
                     continue
 
                 for stitched_idx in stitched_indices:
@@ -1119,28 +1352,27 @@ def smart_multi_image_stitch(images):
                 print("无法找到更多可拼接的图像")
                 break
 
-            # 尝试拼接最佳候选图像
+            # 尝试拼接最佳候选图像，按关系质量从高到低选择已放置的锚点图像
             print(f"尝试拼接图像{best_candidate+1}，质量分数: {best_quality:.1f}")
 
-            candidate_img = processed_images[best_candidate]
-            temp_result = simple_stitch_two_images(result, candidate_img)
-
-            if temp_result is None:
-                # 尝试反向拼接
-                temp_result = simple_stitch_two_images(candidate_img, result)
-
-            if temp_result is not None:
-                result = temp_result
+            anchors = sorted(
+                stitched_indices,
+                key=lambda idx: relationships.get((min(best_candidate, idx), max(best_candidate, idx)), {}).get('quality', 0),
+                reverse=True,
+            )
+            if accumulator.add(best_candidate, anchors):
                 stitched_indices.add(best_candidate)
                 print(f"成功拼接图像{best_candidate+1}")
             else:
                 print(f"无法拼接图像{best_candidate+1}，跳过")
                 # 从候选列表中移除，避免无限循环
-                break
+                failed_indices.add(best_candidate)
 
         print(f"完成拼接，共处理{len(stitched_indices)}张图像")
-        return result
+        return accumulator.render()
 
+    except MemoryBudgetError:
+        raise
     except Exception as e:
         print(f"智能多图拼接失败: {e}")
         traceback.print_exc()
@@ -1157,31 +1389,20 @@ def simple_multi_image_stitch(images):
         if len(images) == 2:
             return simple_stitch_two_images(images[0], images[1])
 
-        # 从第一张图开始
-        result = images[0]
-        print(f"以图像1作为基础图像，尺寸: {result.shape}")
+        # 以第一张图为参考，逐一把后续图像配准到已放置的原图上
+        print(f"以图像1作为参考图像，尺寸: {images[0].shape}")
+        accumulator = TransformAccumulator(images, reference_idx=0)
 
-        # 逐一拼接后续图像
         for i in range(1, len(images)):
-            print(f"正在拼接第{i+1}张图像...")
-
-            # 尝试正向拼接
-            temp_result = simple_stitch_two_images(result, images[i])
-
-            if temp_result is None:
-                # 尝试反向拼接
-                print(f"正向拼接失败，尝试反向拼接第{i+1}张图像...")
-                temp_result = simple_stitch_two_images(images[i], result)
+            print(f"正在配准第{i+1}张图像...")
+            if not accumulator.add(i):
+                print(f"无法配准第{i+1}张图像，跳过该图像")
 
-            if temp_result is not None:
-                result = temp_result
-                print(f"成功拼接第{i+1}张图像，当前结果尺寸: {result.shape}")
-            else:
-                print(f"无法拼接第{i+1}张图像，跳过该图像")
-                continue
-
-        return result
+        # 全部配准后一次性渲染
+        return accumulator.render()
 
+    except MemoryBudgetError:
+        raise
     except Exception as e:
         print(f"简化多图拼接失败: {e}")
         traceback.print_exc()
@@ -1205,6 +1426,7 @@ def smart_order_multi_stitch(images):
         # 尝试不同的起始图像对
         for i in range(len(images)):
             for j in range(i+1, len(images)):
+                check_cancelled('match')
                 print(f"尝试以图像{i+1}和图像{j+1}作为起始对...")
 
                 # 尝试拼接起始对
@@ -1237,6 +1459,8 @@ def smart_order_multi_stitch(images):
 
         return best_result
 
+    except MemoryBudgetError:
+        raise
     except Exception as e:
         print(f"智能排序多图拼接失败: {e}")
         traceback.print_exc()
@@ -1256,6 +1480,7 @@ def advanced_multi_image_stitch(images):
             print(f"预处理图像{i+1}完成")
 
         # 首先尝试简化的循环拼接
+        check_cancelled('match')
         print("尝试简化循环拼接...")
         result = simple_multi_image_stitch(processed_images)
         if result is not None:
@@ -1263,6 +1488,7 @@ def advanced_multi_image_stitch(images):
             return result
 
         # 尝试智能排序拼接
+        check_cancelled('match')
         print("尝试智能排序拼接...")
         result = smart_order_multi_stitch(processed_images)
         if result is not None:
@@ -1270,6 +1496,7 @@ def advanced_multi_image_stitch(images):
             return result
 
         # 回退到原有的复杂方法
+        check_cancelled('match')
         print("回退到智能拼接方法...")
         result = smart_multi_image_stitch(processed_images)
         if result is not None:
@@ -1280,6 +1507,7 @@ def advanced_multi_image_stitch(images):
         stitcher_modes = [cv2.Stitcher_PANORAMA, cv2.Stitcher_SCANS]
 
         for mode in stitcher_modes:
+            check_cancelled('match')
             try:
                 print(f"尝试拼接模式: {mode}")
                 stitcher = cv2.Stitcher_create(mode)
@@ -1300,11 +1528,231 @@ def advanced_multi_image_stitch(images):
         print("所有拼接方法都失败了")
         return None
 
+    except MemoryBudgetError:
+        raise
     except Exception as e:
         print(f"多图拼接失败: {e}")
         traceback.print_exc()
         return None
 
+def is_plausible_homography(H, src_shape, dst_shape, max_ratio=5.0):
+    """检查单应性矩阵是否退化（尺度、凸性、投影面积），不受平移量影响"""
+    det = np.linalg.det(H[:2, :2])
+    if not (0.1 < det < 10):
+        return False
+
+    h, w = src_shape[:2]
+    corners = np.float32([[0, 0], [w, 0], [w, h], [0, h]]).reshape(-1, 1, 2)
+    projected = cv2.perspectiveTransform(corners, H)
+    if not cv2.isContourConvex(projected):
+        return False
+
+    area = cv2.contourArea(projected)
+    dst_area = dst_shape[0] * dst_shape[1]
+    return dst_area / max_ratio < area < dst_area * max_ratio
+
+def match_pair_for_registration(img1, img2, feats1, feats2, detector_type, min_inliers=20):
+    """两图特征匹配 + RANSAC，返回把图1坐标映射到图2坐标的 H 及匹配信息"""
+    des1, des2 = feats1.descriptors, feats2.descriptors
+    if des1 is None or des2 is None or len(des1) < min_inliers or len(des2) < min_inliers:
+        return None
+
+    profile = matching.MATCH_PROFILES['registration']
+    good_matches = matching.match_with_profile(des1, des2, profile, feature_index(feats2))
+    if len(good_matches) < min_inliers:
+        return None
+
+    src_pts, dst_pts = good_matches.points(feats1.points, feats2.points)
+    H, mask = matching.estimate_homography(src_pts, dst_pts, profile)
+    if H is None or mask is None:
+        return None
+
+    inliers = int(mask.sum())
+    if inliers < min_inliers:
+        return None
+
+    H = to_full_res_homography(H, feats1, feats2, src_pts, mask, img1, img2)
+    inlier_src, inlier_dst = stitch_new.inlier_points(src_pts, dst_pts, mask, feats1.scale, feats2.scale)
+    return stitch_new.make_edge(H, inlier_src, inlier_dst, detector_type.upper())
+
+def register_image_pair(img1, img2, detectors=('sift', 'orb'), min_inliers=20):
+    """按检测器顺序匹配两张原图，返回第一个可信的匹配（H 把图1坐标映射到图2），都失败时返回 None"""
+    for detector_type in detectors:
+        check_cancelled('match')
+        # 每张图每种检测器只检测一次（特征缓存），这里只做匹配
+        feats1 = extract_features(img1, detector_type, 'overlap')
+        feats2 = extract_features(img2, detector_type, 'overlap')
+        if feats1 is None or feats2 is None:
+            continue
+
+        edge = match_pair_for_registration(img1, img2, feats1, feats2, detector_type, min_inliers=min_inliers)
+        if edge is not None and is_plausible_homography(edge['H'], img1.shape, img2.shape):
+            return edge
+    return None
+
+def build_registration_edges(images, detectors=('sift', 'orb'), min_inliers=20):
+    """对所有图像对各匹配一次，构建 stitch_new 格式的匹配图 edges[(i, j)]"""
+    n = len(images)
+    edges = {}
+
+    # 先用首选检测器逐张检测，结果进入特征缓存，配对阶段只做匹配
+    for idx, img in enumerate(images):
+        check_cancelled('detect')
+        extract_features(img, detectors[0], 'overlap')
+        report_progress('detect', 10 + 25 * (idx + 1) / n)
+
+    pairs = select_candidate_pairs(images, detectors[0], 'overlap')
+    for done_pairs, (i, j) in enumerate(pairs, start=1):
+        report_progress('match', 35 + 25 * done_pairs / len(pairs))
+        edge = register_image_pair(images[i], images[j], detectors, min_inliers)
+        if edge is None:
+            print(f"图像{i+1}和图像{j+1}无可靠匹配")
+            continue
+
+        print(f"图像{i+1}↔{j+1}: {edge['method']} 内点{edge['inliers']}")
+        stitch_new.add_edge(edges, i, j, edge)
+
+    if registration_settings.get().match_window > 0:
+        drift = stitch_new.verify_loop_closure(edges, n, images[0].shape)
+        if drift is not None:
+            print(f"首尾闭环偏差 {drift:.1f}px，{'保留首尾连接' if (0, n-1) in edges else '偏差过大，丢弃首尾匹配'}")
+
+    return edges
+
+# DeepZoom 输出：金字塔不需要整张画布，允许更大的输出尺寸
+STITCH_DEEPZOOM_MAX_CANVAS_SIZE = int(os.getenv("STITCH_DEEPZOOM_MAX_CANVAS_SIZE", "65536"))
+
+# 当前拼接的 DeepZoom 输出设置（format=deepzoom 时由 run_stitch_pipeline 设置）
+deepzoom_output = contextvars.ContextVar('deepzoom_output', default=None)
+
+def write_deepzoom_image(image, dz_settings):
+    """把整张结果图写成金字塔（两图拼接等不经过分块融合的结果）"""
+    h, w = image.shape[:2]
+    writer = DeepZoomWriter(dz_settings, (w, h))
+    try:
+        writer.write_image(image)
+        return writer.finish()
+    except BaseException:
+        writer.abandon()
+        raise
+
+def render_registered_images(images, H_to_ref, max_canvas_size=20000):
+    """按各图到参考图的单应一次性计算画布并用分块融合渲染，H_to_ref 之外的图像不参与
+
+    设置了 DeepZoom 输出时分块结果直接写成瓦片金字塔，返回 DeepZoomImage 而不是图像数组
+    """
+    check_cancelled('warp')
+    report_progress('warp', 60)
+    dz_settings = deepzoom_output.get()
+    if dz_settings is not None:
+        max_canvas_size = max(max_canvas_size, STITCH_DEEPZOOM_MAX_CANVAS_SIZE)
+    canvas_w, canvas_h, M_final, _ = stitch_new.compute_canvas_and_transforms(images, H_to_ref)
+    print(f"输出图像尺寸: {canvas_w}x{canvas_h}")
+
+    if canvas_w <= 0 or canvas_h <= 0 or canvas_w > max_canvas_size or canvas_h > max_canvas_size:
+        print("输出图像尺寸不合理")
+        return None
+
+    images_dict = {i: images[i] for i in H_to_ref}
+    if dz_settings is not None:
+        # 不分配输出画布，只有半分辨率画布
+        plan = plan_blend((canvas_w, canvas_h), input_bytes=images_nbytes(images_dict.values()),
+                          images_per_tile=min(3, len(images_dict)),
+                          canvas_bytes_per_pixel=DEEPZOOM_CANVAS_BYTES_PER_PIXEL)
+    else:
+        plan = plan_blend((canvas_w, canvas_h), input_bytes=images_nbytes(images_dict.values()),
+                          images_per_tile=min(3, len(images_dict)))
+    print(f"融合方案: {plan.describe()}")
+    if plan.scale < 1.0:
+        S = np.diag([plan.scale, plan.scale, 1.0])
+        M_final = {i: S @ M for i, M in M_final.items()}
+
+    blend_progress = lambda done, total: report_progress('blend', 70 + 20 * done / total)
+    if dz_settings is None:
+        return stitch_new.tiled_blend_parallel(images_dict, M_final, plan.canvas_size,
+                                               tile_size=plan.tile_size, workers=plan.workers,
+                                               blend_method='distance', fill_value=0, progress=blend_progress)
+
+    writer = DeepZoomWriter(dz_settings, plan.canvas_size)
+    try:
+        stitch_new.tiled_blend_parallel(images_dict, M_final, plan.canvas_size,
+                                        tile_size=aligned_tile_size(plan.tile_size, dz_settings.tile_size),
+                                        workers=plan.workers, blend_method='distance', fill_value=0,
+                                        progress=blend_progress, tile_sink=writer.write_region)
+        return writer.finish()
+    except BaseException:
+        writer.abandon()
+        raise
+
+class TransformAccumulator:
+    """顺序拼接的全局变换累积器
+
+    记录每张已放置图像到参考图的单应 H_to_ref，新图像只与已放置的原图匹配（而不是与不断变大的拼接结果），
+    全部放置后一次性渲染，每步的代价与单张图像大小相关而与全景图大小无关
+    """
+
+    def __init__(self, images, reference_idx=0, detectors=('sift', 'orb'), min_inliers=20):
+        self.images = images
+        self.reference_idx = reference_idx
+        self.detectors = detectors
+        self.min_inliers = min_inliers
+        self.H_to_ref = {reference_idx: np.eye(3, dtype=np.float64)}
+        self.placed = [reference_idx]  # 放置顺序
+
+    def add(self, idx, anchors=None):
+        """把图像 idx 与已放置的原图依次匹配（默认最近放置的优先），成功时记录其全局变换并返回 True"""
+        if idx in self.H_to_ref:
+            return True
+        if anchors is None:
+            anchors = reversed(self.placed)
+
+        for anchor in anchors:
+            if anchor not in self.H_to_ref:
+                continue
+            edge = register_image_pair(self.images[idx], self.images[anchor], self.detectors, self.min_inliers)
+            if edge is None:
+                continue
+            # edge['H'] 把 idx 映射到 anchor，再经 anchor 的全局变换到参考图
+            self.H_to_ref[idx] = self.H_to_ref[anchor] @ edge['H']
+            self.placed.append(idx)
+            print(f"图像{idx+1}经图像{anchor+1}配准: {edge['method']} 内点{edge['inliers']}")
+            return True
+        return False
+
+    def render(self, max_canvas_size=20000):
+        if len(self.H_to_ref) == 1:
+            return self.images[self.reference_idx]
+        return render_registered_images(self.images, self.H_to_ref, max_canvas_size)
+
+def global_registration_stitch(images, max_canvas_size=20000):
+    """单次全局配准的多图拼接：检测一次、两两匹配一次、最短路径合成到参考图的单应、一次融合"""
+    try:
+        print("开始全局配准拼接...")
+        n = len(images)
+        if n < 2:
+            return None
+
+        edges = build_registration_edges(images)
+        if not edges:
+            print("没有任何可靠的图像对")
+            return None
+
+        ref_idx, _ = stitch_new.choose_reference(edges, n)
+        H_to_ref, _, _ = stitch_new.dijkstra_paths(edges, n, ref_idx)
+        print(f"参考图像: {ref_idx+1}，连通图像: {len(H_to_ref)}/{n}")
+
+        if len(H_to_ref) < 2:
+            return None
+
+        return render_registered_images(images, H_to_ref, max_canvas_size)
+
+    except MemoryBudgetError:
+        raise
+    except Exception as e:
+        print(f"全局配准拼接失败: {e}")
+        traceback.print_exc()
+        return None
+
 # ─── Museum API Endpoints ────────────────────────────────
 
 from museum_scraper import (
@@ -1562,50 +2010,164 @@ async def decode_raw(file: UploadFile = File(...)):
         },
     }
 
-@app.post("/stitch")
-async def stitch_images(files: List[UploadFile] = File(...)):
-    print(f"收到拼接请求，图像数量: {len(files)}")
+# 解码时缩小倍数 -> imdecode 标志（JPEG 在 DCT 阶段直接缩小，不生成原尺寸中间图）
+REDUCED_DECODE_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
 
-    if len(files) < 2:
-        raise HTTPException(status_code=400, detail="至少需要两张图片")
+def read_image_size(contents):
+    """只解析文件头获取 (宽, 高)，失败时返回 None"""
+    try:
+        with Image.open(io.BytesIO(contents)) as pil_image:
+            return pil_image.size
+    except Exception:
+        return None
 
+def choose_decode_reduction(size, max_megapix):
+    """选择解码缩小倍数：缩小后仍不低于像素上限的最大倍数，剩余部分由 cap_megapix 精确缩小"""
+    if not size or max_megapix <= 0:
+        return 1
+    pixels = size[0] * size[1]
+    best = 1
+    for factor in (2, 4, 8):
+        if pixels / (factor * factor) >= max_megapix * 1e6:
+            best = factor
+    return best
+
+def cap_megapix(image, max_megapix):
+    """解码缩小后仍超过上限时再按面积插值缩小"""
+    if max_megapix <= 0:
+        return image
+    h, w = image.shape[:2]
+    scale = math.sqrt(max_megapix * 1e6 / (w * h))
+    if scale >= 1.0:
+        return image
+    return cv2.resize(image, (max(1, int(w * scale)), max(1, int(h * scale))), interpolation=cv2.INTER_AREA)
+
+def decode_upload_image_pil(contents, max_megapix=0):
+    """OpenCV 不支持的格式回退到 PIL 解码"""
+    with Image.open(io.BytesIO(contents)) as pil_image:
+        if max_megapix > 0:
+            # JPEG 的 draft 模式同样在解码阶段缩小
+            w, h = pil_image.size
+            scale = math.sqrt(max_megapix * 1e6 / (w * h))
+            if scale < 1.0:
+                pil_image.draft('RGB', (int(w * scale), int(h * scale)))
+        pil_image = ImageOps.exif_transpose(pil_image).convert('RGB')
+        image = np.asarray(pil_image)
+    return cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+
+def decode_upload_image(contents, index, max_megapix=0):
+    """把上传的图像字节解码为 BGR 数组
+
+    直接在上传缓冲区上 cv2.imdecode（按 EXIF 方向旋转、统一为 8 位三通道），
+    设置 max_megapix 时用 IMREAD_REDUCED_* 在解码阶段缩小，避免生成原尺寸中间图
+    """
     try:
-        print("开始读取图像...")
+        size = read_image_size(contents)
+        factor = choose_decode_reduction(size, max_megapix)
+        image = cv2.imdecode(np.frombuffer(contents, dtype=np.uint8), REDUCED_DECODE_FLAGS[factor])
+        if image is None:
+            image = decode_upload_image_pil(contents, max_megapix)
+
+        # 验证图像有效性
+        if image is None or image.size == 0:
+            raise StitchError(400, f"图像{index+1}无效")
+
+        image = cap_megapix(image, max_megapix)
+        if size and image.shape[1] * image.shape[0] < size[0] * size[1]:
+            print(f"图像{index+1}超过 {max_megapix} 百万像素上限，已从 {size[0]}x{size[1]} 缩小")
+        print(f"图像{index+1}尺寸: {image.shape}")
+        return image
 
-        # 读取图像
+    except StitchError:
+        raise
+    except Exception as e:
+        raise StitchError(400, f"无法解析图像{index+1}: {str(e)}")
+
+# 输出格式 -> (扩展名, 媒体类型)
+OUTPUT_FORMATS = {
+    'jpeg': ('.jpg', 'image/jpeg'),
+    'webp': ('.webp', 'image/webp'),
+    'png': ('.png', 'image/png'),
+}
+WEBP_MAX_DIMENSION = 16383
+STITCH_STREAM_CHUNK_SIZE = int(os.getenv("STITCH_STREAM_CHUNK_KB", "256")) * 1024
+
+@dataclass(frozen=True)
+class OutputSettings:
+    image_format: str = 'jpeg'  # 或 deepzoom：瓦片金字塔
+    quality: int = 90  # jpeg/webp 为画质，png 换算为压缩级别
+    tile_format: str = 'jpeg'  # deepzoom 瓦片格式
+    tile_size: int = 256  # deepzoom 瓦片大小
+
+@dataclass
+class EncodedImage:
+    data: bytes
+    image_format: str
+    width: int
+    height: int
+    timings: dict = field(default_factory=dict)  # 拼接进程中各阶段的耗时汇总（stitch_timing）
+
+    @property
+    def media_type(self):
+        return OUTPUT_FORMATS[self.image_format][1]
+
+    @property
+    def filename(self):
+        return f"stitched{OUTPUT_FORMATS[self.image_format][0]}"
+
+def encode_stitch_result(result, output):
+    """按请求的格式编码拼接结果"""
+    ext, _ = OUTPUT_FORMATS[output.image_format]
+    h, w = result.shape[:2]
+
+    if output.image_format == 'jpeg':
+        params = [cv2.IMWRITE_JPEG_QUALITY, output.quality]
+    elif output.image_format == 'webp':
+        if max(w, h) > WEBP_MAX_DIMENSION:
+            raise StitchError(400, f"拼接结果 {w}x{h} 超过 WebP 最大尺寸 {WEBP_MAX_DIMENSION}，请改用 jpeg 或 png")
+        params = [cv2.IMWRITE_WEBP_QUALITY, output.quality]
+    else:
+        # PNG 无损，画质越低压缩级别越高（0-9）
+        params = [cv2.IMWRITE_PNG_COMPRESSION, min(9, (100 - output.quality) // 10)]
+
+    with span("encode"):
+        success, buffer = cv2.imencode(ext, result, params)
+    if not success:
+        raise StitchError(500, "图像编码失败")
+    return EncodedImage(data=buffer.tobytes(), image_format=output.image_format, width=w, height=h)
+
+def run_stitch_pipeline(uploads, settings, output=OutputSettings(), progress=None, cancel=None, deepzoom_dir=None):
+    """拼接进程中执行的完整流程：解码、拼接、编码，返回 EncodedImage（timings 为各阶段耗时）
+
+    progress 为可选的进度上报器（异步任务接口传入），按阶段上报 (stage, percent)；
+    cancel 为可选的取消标记（/stitch 传入），客户端断开后在下一个检查点抛出 StitchCancelledError；
+    output.image_format 为 deepzoom 时把瓦片金字塔写到 deepzoom_dir，返回 DeepZoomImage
+    """
+    dz_settings = None
+    if output.image_format == 'deepzoom':
+        dz_settings = DeepZoomSettings(deepzoom_dir, tile_size=output.tile_size, image_format=output.tile_format,
+                                       quality=output.quality)
+    settings_token = registration_settings.set(settings)
+    deepzoom_token = deepzoom_output.set(dz_settings)
+    progress_token = set_progress_reporter(progress)
+    cancel_token = set_cancel_token(cancel)
+    timings_token = start_timings()
+    try:
+        # 排队期间客户端可能已经断开
+        check_cancelled('queued')
         images = []
-        for i, file in enumerate(files):
-            print(f"读取第{i+1}张图像: {file.filename}")
-            contents = await file.read()
-
-            # 验证图像数据
-            if len(contents) == 0:
-                raise HTTPException(status_code=400, detail=f"图像{i+1}数据为空")
-
-            try:
-                # 转换图像
-                pil_image = Image.open(io.BytesIO(contents))
-                image = np.array(pil_image)
-
-                # 验证图像有效性
-                if image.size == 0:
-                    raise HTTPException(status_code=400, detail=f"图像{i+1}无效")
-
-                # 确保是BGR格式
-                if len(image.shape) == 3:
-                    if image.shape[2] == 4:  # RGBA
-                        image = cv2.cvtColor(image, cv2.COLOR_RGBA2BGR)
-                    elif image.shape[2] == 3:  # RGB
-                        image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
-                elif len(image.shape) == 2:  # 灰度图
-                    image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
-
-                images.append(image)
-                print(f"图像{i+1}尺寸: {image.shape}")
-
-            except Exception as e:
-                raise HTTPException(status_code=400, detail=f"无法解析图像{i+1}: {str(e)}")
-
+        for i, contents in enumerate(uploads):
+            check_cancelled('decode')
+            with span("decode"):
+                images.append(decode_upload_image(contents, i, settings.max_input_megapix))
+            # 解码后立即释放该图的原始字节
+            uploads[i] = None
+            report_progress('decode', 10 * (i + 1) / len(uploads))
         print(f"成功读取{len(images)}张图像")
 
         # 根据图像数量选择拼接策略
@@ -1614,44 +2176,480 @@ async def stitch_images(files: List[UploadFile] = File(...)):
             result = simple_stitch_two_images(images[0], images[1])
 
             if result is None:
+                check_cancelled('match')
                 print("尝试反向拼接...")
                 result = simple_stitch_two_images(images[1], images[0])
 
             if result is None:
-                raise HTTPException(status_code=400, detail="无法拼接这两张图像，请确保图像有足够的重叠区域或相似的尺寸")
+                raise StitchError(400, "无法拼接这两张图像，请确保图像有足够的重叠区域或相似的尺寸")
 
         else:
             print("多图拼接...")
-            result = advanced_multi_image_stitch(images)
+            # 单次全局配准，失败时回退到逐步拼接的策略链
+            result = global_registration_stitch(images)
+            if result is None:
+                check_cancelled('match')
+                result = advanced_multi_image_stitch(images)
 
             if result is None:
-                raise HTTPException(status_code=400, detail="多图拼接失败，请检查图像质量和重叠区域")
+                raise StitchError(400, "多图拼接失败，请检查图像质量和重叠区域")
 
+        check_cancelled('encode')
         print("开始编码结果图像...")
+        report_progress('encode', 90)
 
         # 验证结果
-        if result is None or result.size == 0:
-            raise HTTPException(status_code=500, detail="拼接结果无效")
+        if result is None or (isinstance(result, np.ndarray) and result.size == 0):
+            raise StitchError(500, "拼接结果无效")
+
+        # 编码结果（分块融合已直接写成金字塔时跳过）
+        if isinstance(result, DeepZoomImage):
+            encoded = result
+        elif dz_settings is not None:
+            encoded = write_deepzoom_image(result, dz_settings)
+        else:
+            encoded = encode_stitch_result(result, output)
+        encoded.timings = current_timings().summary()
+        return encoded
+
+    except MemoryBudgetError as e:
+        # 各拼接策略不会吞掉该错误，避免预算不足时退回到同样放不下的策略
+        raise StitchError(413, str(e))
+    finally:
+        reset_timings(timings_token)
+        reset_cancel_token(cancel_token)
+        reset_progress_reporter(progress_token)
+        deepzoom_output.reset(deepzoom_token)
+        registration_settings.reset(settings_token)
+        # 清理内存
+        gc.collect()
+
+# 拼接计算在独立进程中执行，事件循环只负责收发数据
+stitch_pool = StitchWorkerPool()
+
+def stitch_worker_ready():
+    """工作进程预热：反序列化此函数时会在子进程中导入本模块"""
+    return os.getpid()
+
+@app.on_event("startup")
+async def startup_stitch_pool():
+    asyncio.create_task(stitch_pool.warm_up(stitch_worker_ready))
+
+@app.on_event("shutdown")
+async def shutdown_stitch_pool():
+    stitch_pool.shutdown()
+    cancel_registry.shutdown()
+
+# 客户端断开的 /stitch 请求在共享取消表中标记，工作进程在检查点协作中止
+cancel_registry = CancelRegistry()
+
+# 编码后的拼接结果缓存在磁盘上，拼接代码或 OpenCV 版本变化时缓存键随之变化
+result_cache = ResultCache()
+STITCH_CODE_VERSION = source_version([__file__, stitch_new.__file__, matching.__file__, deepzoom.__file__],
+                                     extra=cv2.__version__)
+
+# format=deepzoom 的瓦片金字塔按缓存键存放，瓦片内容不变，客户端可长期缓存
+pyramid_store = PyramidStore()
+STITCH_TILE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+def build_output_settings(image_format, quality, tile_format='jpeg', tile_size=256):
+    if image_format != 'deepzoom':
+        # 瓦片参数不影响单张图片输出，不计入缓存键
+        return OutputSettings(image_format=image_format, quality=quality)
+    if tile_size not in DEEPZOOM_TILE_SIZES:
+        raise HTTPException(status_code=400, detail=f"瓦片大小只支持 {', '.join(map(str, DEEPZOOM_TILE_SIZES))}")
+    return OutputSettings(image_format=image_format, quality=quality, tile_format=tile_format, tile_size=tile_size)
+
+def deepzoom_payload(pyramid):
+    """金字塔的访问地址（DZI 描述文件可直接交给 OpenSeadragon 等查看器）"""
+    pyramid_id = os.path.basename(pyramid.directory)
+    return {
+        "dzi_url": f"/stitch/tiles/{pyramid_id}/image.dzi",
+        "tiles_url": f"/stitch/tiles/{pyramid_id}/image_files/",
+        "dimensions": {"width": pyramid.width, "height": pyramid.height},
+        "tile_size": pyramid.tile_size,
+        "tile_format": pyramid.image_format,
+        "levels": pyramid.levels,
+    }
 
-        # 编码结果
-        success, buffer = cv2.imencode('.jpg', result, [cv2.IMWRITE_JPEG_QUALITY, 90])
-        if not success:
-            raise HTTPException(status_code=500, detail="图像编码失败")
+def stitch_result_cache_key(uploads, settings, output):
+    # 按上传顺序计键：参考图选择、画布原点和接缝融合顺序都依赖输入顺序，换序后的结果不一定逐像素相同
+    return stitch_cache_key(
+        [content_digest(contents) for contents in uploads],
+        {**asdict(settings), **asdict(output)},
+        STITCH_CODE_VERSION,
+    )
 
-        encoded_image = base64.b64encode(buffer).decode('utf-8')
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    return if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]
+
+@app.get("/stitch/detectors")
+async def stitch_detector_stats():
+    """各图像分桶（分辨率/纹理）下检测器的样本数、成功率、平均耗时和期望耗时，期望耗时小的排在级联前面"""
+    return await asyncio.to_thread(detector_stats.stats)
+
+# 主进程累计的各阶段耗时直方图（各拼接进程随结果返回的计时汇总）
+stage_histograms = StageHistograms()
+
+def record_stitch_timings(route, pool_result):
+    """记录一次拼接的排队时间，输出一行 JSON 日志并计入直方图，返回 Server-Timing 头"""
+    encoded = pool_result.value
+    encoded.timings["queue_wait_ms"] = round(pool_result.queue_wait * 1000, 1)
+    stage_histograms.observe_summary(encoded.timings)
+    print(json.dumps({"event": "stitch_timing", "route": route, "width": encoded.width, "height": encoded.height,
+                      **encoded.timings}, ensure_ascii=False))
+    return server_timing_header(encoded.timings)
+
+@app.get("/stitch/metrics")
+async def stitch_metrics():
+    """各阶段（decode/preprocess/detect/match/ransac/warp/blend/encode、排队和总耗时）墙钟时间的累计直方图，
+    以及客户端断开后的取消统计"""
+    return {**stage_histograms.to_dict(), "cancellations": cancel_registry.stats()}
+
+class ClientDisconnected(Exception):
+    """等待拼接结果期间客户端已断开"""
+
+def release_cancel_token(token, cache_key):
+    """拼接结束后的回调：移除取消标记，统计中止；客户端已断开但拼接已完成时结果仍写入缓存，供重试命中"""
+    def done(future):
+        disconnected = token.cancelled
+        cancel_registry.release(token)
+        if future.cancelled():
+            return
+        error = future.exception()
+        if isinstance(error, StitchCancelledError):
+            cancel_registry.record_aborted(error.stage or "unknown")
+            print(f"客户端已断开，拼接在 {error.stage} 阶段中止")
+        elif error is None and disconnected:
+            cancel_registry.finished_after_disconnect += 1
+            encoded = future.result().value
+            # 金字塔已写入 pyramid_store
+            if isinstance(encoded, EncodedImage):
+                asyncio.create_task(asyncio.to_thread(
+                    result_cache.put, cache_key, encoded.data, encoded.media_type, encoded.width, encoded.height))
+    return done
+
+async def wait_unless_disconnected(request, pool_future, token):
+    """等待拼接结果，期间按间隔检查客户端连接；断开时标记取消并抛出 ClientDisconnected（工作进程随后自行中止）"""
+    while True:
+        done, _ = await asyncio.wait({pool_future}, timeout=STITCH_DISCONNECT_POLL_SECONDS)
+        if done:
+            return pool_future.result()
+        if await request.is_disconnected():
+            cancel_registry.cancel(token)
+            raise ClientDisconnected()
+
+@app.get("/stitch/stats")
+async def stitch_stats():
+    """拼接进程池状态（并发、排队、拒绝数、排队等待时间）和结果缓存命中情况"""
+    return {**stitch_pool.stats(), "result_cache": result_cache.stats()}
+
+def build_registration_settings(work_megapix, refine, detector_mode, max_input_megapix=None, match_window=0):
+    return RegistrationSettings(
+        work_megapix=DEFAULT_WORK_MEGAPIX if work_megapix is None else work_megapix,
+        refine_full_res=refine,
+        detector_mode=detector_mode or DEFAULT_DETECTOR_MODE,
+        max_input_megapix=DEFAULT_MAX_INPUT_MEGAPIX if max_input_megapix is None else max_input_megapix,
+        match_window=match_window,
+    )
 
-        print("拼接任务完成")
-        return {"image": encoded_image}
+async def read_stitch_uploads(files):
+    """读取上传的图像字节（解码在拼接进程中进行）"""
+    print(f"收到拼接请求，图像数量: {len(files)}")
 
+    if len(files) < 2:
+        raise HTTPException(status_code=400, detail="至少需要两张图片")
+
+    print("开始读取图像...")
+
+    # 读取图像
+    uploads = []
+    for i, file in enumerate(files):
+        print(f"读取第{i+1}张图像: {file.filename}")
+        contents = await file.read()
+
+        # 验证图像数据
+        if len(contents) == 0:
+            raise HTTPException(status_code=400, detail=f"图像{i+1}数据为空")
+
+        uploads.append(contents)
+    return uploads
+
+def iter_chunks(data, chunk_size=STITCH_STREAM_CHUNK_SIZE):
+    """按块切片输出（memoryview 切片不复制数据）"""
+    view = memoryview(data)
+    for offset in range(0, len(view), chunk_size):
+        yield view[offset:offset + chunk_size]
+
+def stream_encoded_image(encoded, headers=None):
+    return StreamingResponse(
+        iter_chunks(encoded.data),
+        media_type=encoded.media_type,
+        headers={
+            "Content-Length": str(len(encoded.data)),
+            "Content-Disposition": f'inline; filename="{encoded.filename}"',
+            "X-Stitch-Width": str(encoded.width),
+            "X-Stitch-Height": str(encoded.height),
+            **(headers or {}),
+        },
+    )
+
+def iter_file_chunks(f, chunk_size=STITCH_STREAM_CHUNK_SIZE):
+    """按块读取已打开的文件，读完后关闭"""
+    with f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+def stream_cached_file(cached, f, filename, headers=None):
+    return StreamingResponse(
+        iter_file_chunks(f),
+        media_type=cached.media_type,
+        headers={
+            "Content-Length": str(os.fstat(f.fileno()).st_size),
+            "Content-Disposition": f'inline; filename="{filename}"',
+            "X-Stitch-Width": str(cached.width),
+            "X-Stitch-Height": str(cached.height),
+            **(headers or {}),
+        },
+    )
+
+def stitch_queue_full_error():
+    return HTTPException(
+        status_code=503,
+        detail="拼接任务繁忙，请稍后重试",
+        headers={"Retry-After": str(STITCH_RETRY_AFTER_SECONDS)},
+    )
+
+@app.post("/stitch")
+async def stitch_images(
+    request: Request,
+    response: Response,
+    files: List[UploadFile] = File(...),
+    work_megapix: Optional[float] = Query(None, ge=0, description="配准分辨率（百万像素），0 表示原分辨率"),
+    refine: bool = Query(True, description="配准分辨率模式下用原分辨率内点微调单应性矩阵"),
+    detector_mode: Optional[Literal['sequential', 'race', 'best']] = Query(None, description="两图拼接的检测器级联方式"),
+    max_input_megapix: Optional[float] = Query(None, ge=0, description="输入图像像素上限（百万像素），超出时解码阶段缩小，0 表示不限制"),
+    match_window: int = Query(0, ge=0, description="顺序拍摄：每张图只与上传顺序中后面 k 张匹配并检查首尾闭环，0 表示不限制"),
+    image_format: Literal['jpeg', 'webp', 'png', 'deepzoom'] = Query('jpeg', alias="format", description="输出格式，deepzoom 为瓦片金字塔"),
+    quality: int = Query(90, ge=1, le=100, description="输出画质（png 换算为压缩级别）"),
+    tile_format: Literal['jpeg', 'webp', 'png'] = Query('jpeg', description="deepzoom 瓦片格式"),
+    tile_size: int = Query(256, description="deepzoom 瓦片大小（256 或 512）"),
+    as_json: bool = Query(False, description="兼容模式：返回 {image: base64} 的 JSON"),
+    if_none_match: Optional[str] = Header(None),
+):
+    """返回编码后的图像字节（分块传输）；as_json=true 时保持旧的 base64 JSON 格式
+
+    相同输入和参数的结果从磁盘缓存直接返回，ETag 为缓存键，If-None-Match 命中时返回 304；
+    format=deepzoom 时不生成单张图片，返回瓦片金字塔的 DZI 地址（JSON），瓦片由 /stitch/tiles 提供
+    """
+    settings = build_registration_settings(work_megapix, refine, detector_mode, max_input_megapix, match_window)
+    output = build_output_settings(image_format, quality, tile_format, tile_size)
+    uploads = await read_stitch_uploads(files)
+    try:
+        cache_key = await asyncio.to_thread(stitch_result_cache_key, uploads, settings, output)
+        etag = f'"{cache_key}"'
+        want_deepzoom = output.image_format == 'deepzoom'
+        if want_deepzoom:
+            pyramid = await asyncio.to_thread(pyramid_store.get, cache_key)
+            if pyramid is not None:
+                print("命中 DeepZoom 金字塔")
+                cache_headers = {"ETag": etag, "X-Stitch-Cache": "hit"}
+                if etag_matches(if_none_match, etag):
+                    return Response(status_code=304, headers=cache_headers)
+                response.headers.update(cache_headers)
+                return deepzoom_payload(pyramid)
+        cached = None if want_deepzoom else await asyncio.to_thread(result_cache.get, cache_key)
+        if cached is not None:
+            print("命中拼接结果缓存")
+            cache_headers = {"ETag": etag, "X-Stitch-Cache": "hit"}
+            if etag_matches(if_none_match, etag):
+                return Response(status_code=304, headers=cache_headers)
+            try:
+                # 先打开文件：打开之后即使被并发淘汰删除也能读完
+                cached_file = await asyncio.to_thread(cached.open)
+            except FileNotFoundError:
+                print("缓存文件已被淘汰，重新拼接")
+                await asyncio.to_thread(result_cache.discard, cache_key)
+                cached_file = None
+            if cached_file is not None:
+                if as_json:
+                    with cached_file:
+                        data = await asyncio.to_thread(cached_file.read)
+                    response.headers.update(cache_headers)
+                    return {"image": base64.b64encode(data).decode('utf-8'),
+                            "dimensions": {"width": cached.width, "height": cached.height}}
+                return stream_cached_file(cached, cached_file, f"stitched{OUTPUT_FORMATS[output.image_format][0]}",
+                                          cache_headers)
+
+        token = cancel_registry.token()
+        pool_future = stitch_pool.submit(run_stitch_pipeline, uploads, settings, output, cancel=token,
+                                         deepzoom_dir=pyramid_store.path(cache_key) if want_deepzoom else None)
+        pool_future.add_done_callback(release_cancel_token(token, cache_key))
+        pool_result = await wait_unless_disconnected(request, pool_future, token)
+        print(f"拼接任务完成，排队 {pool_result.queue_wait:.2f}s，计算 {pool_result.run_time:.2f}s")
+
+        encoded = pool_result.value
+        server_timing = record_stitch_timings("/stitch", pool_result)
+        result_headers = {"ETag": etag, "X-Stitch-Cache": "miss",
+                          "X-Stitch-Queue-Wait-Ms": f"{pool_result.queue_wait * 1000:.0f}",
+                          "Server-Timing": server_timing}
+        if want_deepzoom:
+            asyncio.create_task(asyncio.to_thread(pyramid_store.prune))
+            response.headers.update(result_headers)
+            return deepzoom_payload(encoded)
+
+        # 写缓存不阻塞响应
+        asyncio.create_task(asyncio.to_thread(
+            result_cache.put, cache_key, encoded.data, encoded.media_type, encoded.width, encoded.height))
+
+        if as_json:
+            response.headers.update(result_headers)
+            encoded_image = base64.b64encode(encoded.data).decode('utf-8')
+            return {"image": encoded_image, "dimensions": {"width": encoded.width, "height": encoded.height}}
+
+        return stream_encoded_image(encoded, result_headers)
+
+    except StitchQueueFullError:
+        raise stitch_queue_full_error()
+    except ClientDisconnected:
+        print("客户端已断开，已通知拼接进程中止")
+        # 499：客户端关闭连接（响应不会被读取）
+        raise HTTPException(status_code=499, detail="客户端已断开，拼接已取消")
+    except StitchError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
     except HTTPException:
         raise
     except Exception as e:
         print(f"拼接过程发生错误: {e}")
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"服务器内部错误: {str(e)}")
-    finally:
-        # 清理内存
-        gc.collect()
+
+# ─── 异步拼接任务 ────────────────────────────────────────
+
+# 任务状态与结果保存在主进程，工作进程只通过共享进度表上报阶段
+stitch_jobs = JobStore()
+STITCH_JOB_EVENT_INTERVAL = 0.5
+
+@app.on_event("shutdown")
+async def shutdown_stitch_jobs():
+    stitch_jobs.shutdown()
+
+async def watch_stitch_job(job, pool_future):
+    try:
+        pool_result = await pool_future
+        record_stitch_timings("/stitch/jobs", pool_result)
+        stitch_jobs.finish(job, pool_result.value)
+        if isinstance(pool_result.value, DeepZoomImage):
+            await asyncio.to_thread(pyramid_store.prune)
+        print(f"拼接任务 {job.id} 完成，排队 {pool_result.queue_wait:.2f}s，计算 {pool_result.run_time:.2f}s")
+    except StitchError as e:
+        stitch_jobs.fail(job, e.status_code, e.detail)
+    except Exception as e:
+        print(f"拼接任务 {job.id} 发生错误: {e}")
+        traceback.print_exc()
+        stitch_jobs.fail(job, 500, f"服务器内部错误: {str(e)}")
+
+def get_stitch_job_or_404(job_id):
+    job = stitch_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在或已过期")
+    return job
+
+@app.post("/stitch/jobs", status_code=202)
+async def create_stitch_job(
+    files: List[UploadFile] = File(...),
+    work_megapix: Optional[float] = Query(None, ge=0, description="配准分辨率（百万像素），0 表示原分辨率"),
+    refine: bool = Query(True, description="配准分辨率模式下用原分辨率内点微调单应性矩阵"),
+    detector_mode: Optional[Literal['sequential', 'race', 'best']] = Query(None, description="两图拼接的检测器级联方式"),
+    max_input_megapix: Optional[float] = Query(None, ge=0, description="输入图像像素上限（百万像素），超出时解码阶段缩小，0 表示不限制"),
+    match_window: int = Query(0, ge=0, description="顺序拍摄：每张图只与上传顺序中后面 k 张匹配并检查首尾闭环，0 表示不限制"),
+    image_format: Literal['jpeg', 'webp', 'png', 'deepzoom'] = Query('jpeg', alias="format", description="输出格式，deepzoom 为瓦片金字塔"),
+    quality: int = Query(90, ge=1, le=100, description="输出画质（png 换算为压缩级别）"),
+    tile_format: Literal['jpeg', 'webp', 'png'] = Query('jpeg', description="deepzoom 瓦片格式"),
+    tile_size: int = Query(256, description="deepzoom 瓦片大小（256 或 512）"),
+):
+    """提交拼接任务并立即返回任务 id，进度通过轮询或 SSE 获取，结果单独下载"""
+    settings = build_registration_settings(work_megapix, refine, detector_mode, max_input_megapix, match_window)
+    output = build_output_settings(image_format, quality, tile_format, tile_size)
+    uploads = await read_stitch_uploads(files)
+    deepzoom_dir = None
+    if output.image_format == 'deepzoom':
+        cache_key = await asyncio.to_thread(stitch_result_cache_key, uploads, settings, output)
+        deepzoom_dir = pyramid_store.path(cache_key)
+
+    job = stitch_jobs.create(len(uploads))
+    try:
+        pool_future = stitch_pool.submit(run_stitch_pipeline, uploads, settings, output,
+                                         progress=stitch_jobs.reporter(job), deepzoom_dir=deepzoom_dir)
+    except StitchQueueFullError:
+        stitch_jobs.discard(job)
+        raise stitch_queue_full_error()
+    asyncio.create_task(watch_stitch_job(job, pool_future))
+
+    return {
+        **job.to_dict(),
+        "status_url": f"/stitch/jobs/{job.id}",
+        "events_url": f"/stitch/jobs/{job.id}/events",
+        "result_url": f"/stitch/jobs/{job.id}/result",
+    }
+
+@app.get("/stitch/jobs/{job_id}")
+async def get_stitch_job(job_id: str):
+    """任务状态：state、当前阶段（decode/detect/match/warp/blend/encode）、百分比、耗时"""
+    return get_stitch_job_or_404(job_id).to_dict()
+
+@app.get("/stitch/jobs/{job_id}/events")
+async def stitch_job_events(job_id: str):
+    """以 SSE 推送任务进度，任务结束（done/failed）后关闭连接"""
+    job = get_stitch_job_or_404(job_id)
+
+    async def event_stream():
+        last = None
+        while True:
+            stitch_jobs.sync_progress(job)
+            status = job.to_dict()
+            snapshot = (status["state"], status["stage"], status["percent"])
+            if snapshot != last:
+                last = snapshot
+                yield f"event: progress\ndata: {json.dumps(status, ensure_ascii=False)}\n\n"
+            if job.finished:
+                break
+            await asyncio.sleep(STITCH_JOB_EVENT_INTERVAL)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.get("/stitch/jobs/{job_id}/result")
+async def get_stitch_job_result(job_id: str):
+    """下载任务结果图像（二进制；deepzoom 为金字塔地址 JSON），任务未完成时返回 409"""
+    job = get_stitch_job_or_404(job_id)
+    if job.state == "failed":
+        raise HTTPException(status_code=job.status_code or 500, detail=job.error)
+    if job.state != "done":
+        raise HTTPException(status_code=409, detail=f"任务尚未完成（{job.stage} {job.percent:.0f}%）")
+    server_timing = {"Server-Timing": server_timing_header(job.result.timings)}
+    if isinstance(job.result, DeepZoomImage):
+        return JSONResponse(deepzoom_payload(job.result), headers=server_timing)
+    return stream_encoded_image(job.result, server_timing)
+
+@app.get("/stitch/tiles/{pyramid_id}/{path:path}")
+async def get_stitch_tile(pyramid_id: str, path: str):
+    """DeepZoom 金字塔文件（image.dzi 和 image_files/<level>/<col>_<row>.<ext>），按内容寻址，长期缓存"""
+    file_path = pyramid_store.file(pyramid_id, path)
+    if file_path is None:
+        raise HTTPException(status_code=404, detail="瓦片不存在或金字塔已过期")
+    ext = os.path.splitext(file_path)[1]
+    media_type = "application/xml" if ext == ".dzi" else next(
+        (media for e, media in TILE_FORMATS.values() if e == ext), "application/octet-stream")
+    return FileResponse(file_path, media_type=media_type, headers={"Cache-Control": STITCH_TILE_CACHE_CONTROL})
 
 if __name__ == "__main__":
     print("启动图像拼接服务...")
@@ -0,0 +1,266 @@
+"""
+DeepZoom 瓦片金字塔输出
+分块融合（stitch_new.tiled_blend_parallel）每完成一块就直接切成 DeepZoom 瓦片写盘，同时把该块缩小一半放进
+半分辨率画布；全部完成后由半分辨率画布逐级缩小生成其余层级。不分配整张原分辨率画布，也不编码成单个大文件，
+前端（如 OpenSeadragon）只按视口加载瓦片。
+
+目录结构（与 .dzi 约定一致）：
+  <directory>/image.dzi
+  <directory>/image_files/<level>/<col>_<row>.<ext>    level 0 为 1x1，最高层为原分辨率
+"""
+
+import math
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Optional, Tuple
+
+import cv2
+import numpy as np
+
+from stitch_timing import span
+
+STITCH_DEEPZOOM_DIR = os.getenv("STITCH_DEEPZOOM_DIR", os.path.join(tempfile.gettempdir(), "stitch-deepzoom"))
+# 保留的金字塔数量，超出时删除最久未访问的
+STITCH_DEEPZOOM_MAX_PYRAMIDS = int(os.getenv("STITCH_DEEPZOOM_MAX_PYRAMIDS", "32"))
+
+DEEPZOOM_NAME = "image"
+DEEPZOOM_TILE_SIZES = (256, 512)
+# 瓦片格式 -> (扩展名, 媒体类型)
+TILE_FORMATS = {
+    "jpeg": (".jpg", "image/jpeg"),
+    "webp": (".webp", "image/webp"),
+    "png": (".png", "image/png"),
+}
+
+# 写瓦片时每像素的额外内存：半分辨率画布（1/4）及其下各层（再加 1/3）
+DEEPZOOM_CANVAS_BYTES_PER_PIXEL = 3 / 4 * 4 / 3
+
+
+@dataclass(frozen=True)
+class DeepZoomSettings:
+    directory: str
+    tile_size: int = 256
+    image_format: str = "jpeg"
+    quality: int = 90
+    workers: int = max(1, (os.cpu_count() or 2) - 1)  # 生成低层级时的编码线程数
+
+
+@dataclass
+class DeepZoomImage:
+    """写好的金字塔（可跨进程传递）"""
+    directory: str
+    width: int
+    height: int
+    tile_size: int
+    image_format: str
+    levels: int
+    tiles: int
+    timings: dict = field(default_factory=dict)
+
+    @property
+    def dzi_path(self) -> str:
+        return os.path.join(self.directory, f"{DEEPZOOM_NAME}.dzi")
+
+
+def max_level(width: int, height: int) -> int:
+    return max(0, int(math.ceil(math.log2(max(width, height, 1)))))
+
+
+def level_size(width: int, height: int, level: int, top: int) -> Tuple[int, int]:
+    scale = 2 ** (top - level)
+    return max(1, int(math.ceil(width / scale))), max(1, int(math.ceil(height / scale)))
+
+
+def aligned_tile_size(blend_tile_size: int, tile_size: int) -> int:
+    """融合分块尺寸向上取整到瓦片尺寸的倍数，每个融合块恰好覆盖整数个瓦片"""
+    return max(tile_size, int(math.ceil(blend_tile_size / tile_size)) * tile_size)
+
+
+def dzi_descriptor(width: int, height: int, tile_size: int, image_format: str) -> str:
+    ext = TILE_FORMATS[image_format][0].lstrip(".")
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        f'<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" TileSize="{tile_size}" Overlap="0" Format="{ext}">\n'
+        f'  <Size Width="{width}" Height="{height}"/>\n'
+        '</Image>\n'
+    )
+
+
+def encode_params(image_format: str, quality: int):
+    if image_format == "jpeg":
+        return [cv2.IMWRITE_JPEG_QUALITY, quality]
+    if image_format == "webp":
+        return [cv2.IMWRITE_WEBP_QUALITY, quality]
+    return [cv2.IMWRITE_PNG_COMPRESSION, min(9, (100 - quality) // 10)]
+
+
+class DeepZoomWriter:
+    """按块接收原分辨率画布并写出金字塔：write_region 可在多个线程中对互不重叠的块并发调用，最后调用 finish
+
+    先写入临时目录，finish 时改名为目标目录（同一目录已存在时保留已有结果），失败时调用 abandon 清理
+    """
+
+    def __init__(self, settings: DeepZoomSettings, canvas_size: Tuple[int, int]):
+        if settings.tile_size not in DEEPZOOM_TILE_SIZES:
+            raise ValueError(f"瓦片尺寸只支持 {DEEPZOOM_TILE_SIZES}")
+        self.settings = settings
+        self.width, self.height = canvas_size
+        self.top = max_level(self.width, self.height)
+        self.tiles = 0
+        self._lock = threading.Lock()
+        self._ext, _ = TILE_FORMATS[settings.image_format]
+        self._params = encode_params(settings.image_format, settings.quality)
+        self._tmp = f"{settings.directory.rstrip(os.sep)}.tmp-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        for level in range(self.top + 1):
+            os.makedirs(self._level_dir(level), exist_ok=True)
+        half_w, half_h = level_size(self.width, self.height, self.top - 1, self.top) if self.top > 0 else (0, 0)
+        self._half = np.zeros((half_h, half_w, 3), dtype=np.uint8) if self.top > 0 else None
+
+    def _level_dir(self, level: int) -> str:
+        return os.path.join(self._tmp, f"{DEEPZOOM_NAME}_files", str(level))
+
+    def _write_tile(self, level: int, col: int, row: int, tile: np.ndarray):
+        with span("encode"):
+            ok, buffer = cv2.imencode(self._ext, tile, self._params)
+            if not ok:
+                raise RuntimeError(f"瓦片编码失败: {level}/{col}_{row}")
+            buffer.tofile(os.path.join(self._level_dir(level), f"{col}_{row}{self._ext}"))
+        with self._lock:
+            self.tiles += 1
+
+    def _write_tiles(self, level: int, image: np.ndarray, x0: int = 0, y0: int = 0):
+        t = self.settings.tile_size
+        h, w = image.shape[:2]
+        for ty in range(0, h, t):
+            for tx in range(0, w, t):
+                self._write_tile(level, (x0 + tx) // t, (y0 + ty) // t, image[ty:ty + t, tx:tx + t])
+
+    def write_region(self, x0: int, y0: int, patch: np.ndarray):
+        """写入原分辨率画布中 (x0, y0) 起的一块，x0 / y0 须为瓦片尺寸的整数倍"""
+        t = self.settings.tile_size
+        if x0 % t or y0 % t:
+            raise ValueError(f"块起点 ({x0}, {y0}) 未对齐到瓦片尺寸 {t}")
+        self._write_tiles(self.top, patch, x0, y0)
+        if self._half is not None:
+            h, w = patch.shape[:2]
+            half = cv2.resize(patch, (max(1, (w + 1) // 2), max(1, (h + 1) // 2)), interpolation=cv2.INTER_AREA)
+            self._half[y0 // 2:y0 // 2 + half.shape[0], x0 // 2:x0 // 2 + half.shape[1]] = half
+
+    def write_image(self, image: np.ndarray):
+        """整张结果图（非分块融合得到）一次写入"""
+        self.write_region(0, 0, image)
+
+    def finish(self) -> DeepZoomImage:
+        """由半分辨率画布逐级生成低层级，写描述文件并发布到目标目录"""
+        canvas = self._half
+        with span("encode"), ThreadPoolExecutor(max_workers=self.settings.workers) as executor:
+            for level in range(self.top - 1, -1, -1):
+                t = self.settings.tile_size
+                h, w = canvas.shape[:2]
+                jobs = [(level, tx // t, ty // t, canvas[ty:ty + t, tx:tx + t])
+                        for ty in range(0, h, t) for tx in range(0, w, t)]
+                list(executor.map(lambda job: self._write_tile(*job), jobs))
+                if level > 0:
+                    canvas = cv2.resize(canvas, level_size(self.width, self.height, level - 1, self.top),
+                                        interpolation=cv2.INTER_AREA)
+        self._half = None
+
+        with open(os.path.join(self._tmp, f"{DEEPZOOM_NAME}.dzi"), "w", encoding="utf-8") as f:
+            f.write(dzi_descriptor(self.width, self.height, self.settings.tile_size, self.settings.image_format))
+
+        directory = self.settings.directory
+        try:
+            os.replace(self._tmp, directory)
+        except OSError:
+            # 目标已存在（同一结果已由其他进程生成）
+            shutil.rmtree(self._tmp, ignore_errors=True)
+        return DeepZoomImage(directory=directory, width=self.width, height=self.height,
+                             tile_size=self.settings.tile_size, image_format=self.settings.image_format,
+                             levels=self.top + 1, tiles=self.tiles)
+
+    def abandon(self):
+        self._half = None
+        shutil.rmtree(self._tmp, ignore_errors=True)
+
+
+def read_pyramid(directory: str) -> Optional[DeepZoomImage]:
+    """读取已写好的金字塔描述文件，不存在或不完整时返回 None"""
+    try:
+        root = ET.parse(os.path.join(directory, f"{DEEPZOOM_NAME}.dzi")).getroot()
+    except (OSError, ET.ParseError):
+        return None
+    size = root.find("{*}Size")
+    if size is None:
+        return None
+    ext = "." + root.get("Format", "jpg")
+    image_format = next((name for name, (e, _) in TILE_FORMATS.items() if e == ext), "jpeg")
+    width, height = int(size.get("Width")), int(size.get("Height"))
+    return DeepZoomImage(directory=directory, width=width, height=height, tile_size=int(root.get("TileSize")),
+                         image_format=image_format, levels=max_level(width, height) + 1, tiles=0)
+
+
+class PyramidStore:
+    """按拼接结果缓存键存放金字塔目录，最近访问时间记录在目录 mtime 上，超出数量时删除最久未访问的"""
+
+    _KEY = re.compile(r"^[0-9a-f]{16,128}$")
+
+    def __init__(self, directory: str = STITCH_DEEPZOOM_DIR, max_pyramids: int = STITCH_DEEPZOOM_MAX_PYRAMIDS):
+        self.directory = directory
+        self.max_pyramids = max_pyramids
+        self._lock = threading.Lock()
+
+    def path(self, key: str) -> str:
+        if not self._KEY.match(key):
+            raise ValueError(f"无效的金字塔 id: {key}")
+        return os.path.join(self.directory, key)
+
+    def get(self, key: str) -> Optional[DeepZoomImage]:
+        directory = self.path(key)
+        pyramid = read_pyramid(directory)
+        if pyramid is not None:
+            try:
+                now = time.time()
+                os.utime(directory, (now, now))
+            except OSError:
+                pass
+        return pyramid
+
+    def file(self, key: str, relative: str) -> Optional[str]:
+        """金字塔内文件的绝对路径；id 非法、路径越界或文件不存在时返回 None"""
+        if not self._KEY.match(key):
+            return None
+        root = os.path.realpath(os.path.join(self.directory, key))
+        path = os.path.realpath(os.path.join(root, relative))
+        if not path.startswith(root + os.sep) or not os.path.isfile(path):
+            return None
+        return path
+
+    def prune(self):
+        """删除超出数量的金字塔和残留的临时目录（超过一小时）"""
+        with self._lock:
+            try:
+                names = os.listdir(self.directory)
+            except OSError:
+                return
+            pyramids, now = [], time.time()
+            for name in names:
+                path = os.path.join(self.directory, name)
+                try:
+                    mtime = os.stat(path).st_mtime
+                except OSError:
+                    continue
+                if ".tmp-" in name:
+                    if now - mtime > 3600:
+                        shutil.rmtree(path, ignore_errors=True)
+                elif self._KEY.match(name):
+                    pyramids.append((mtime, path))
+            for _, path in sorted(pyramids)[:max(0, len(pyramids) - self.max_pyramids)]:
+                shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,175 @@
+"""
+检测器自适应排序
+按图像类型（分辨率 × 纹理）记录各检测器的匹配成功率和耗时，持久化到 SQLite（多个拼接进程共享、重启后保留），
+顺序级联时把 "平均耗时 / 成功率" 最小的检测器排在前面，即期望耗时最短、最可能成功的先试
+"""
+
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import cv2
+import numpy as np
+
+STITCH_DETECTOR_STATS_PATH = os.getenv(
+    "STITCH_DETECTOR_STATS_PATH", os.path.join(tempfile.gettempdir(), "stitch-detector-stats.sqlite3")
+)
+# 每种检测器在一个分桶内至少作为首选尝试这么多次后才按统计排序
+STITCH_DETECTOR_MIN_SAMPLES = int(os.getenv("STITCH_DETECTOR_MIN_SAMPLES", "5"))
+# 进程内统计快照的刷新间隔（其他拼接进程的记录在此之后可见）
+STITCH_DETECTOR_STATS_REFRESH_SECONDS = float(os.getenv("STITCH_DETECTOR_STATS_REFRESH_SECONDS", "30"))
+
+# 分辨率分桶（较大一张图的百万像素）与纹理分桶（256px 缩略图的拉普拉斯方差）
+RESOLUTION_BUCKETS = ((1.0, "small"), (4.0, "medium"), (12.0, "large"), (float("inf"), "huge"))
+TEXTURE_BUCKETS = ((150.0, "low"), (1500.0, "mid"), (float("inf"), "high"))
+TEXTURE_THUMB_SIZE = 256
+
+
+def texture_score(image: np.ndarray) -> float:
+    """纹理/对比度评分：缩略图灰度的拉普拉斯方差，纯色、模糊、夜空等图像很低"""
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    h, w = gray.shape[:2]
+    scale = min(1.0, TEXTURE_THUMB_SIZE / max(h, w))
+    if scale < 1.0:
+        gray = cv2.resize(gray, (max(1, int(w * scale)), max(1, int(h * scale))), interpolation=cv2.INTER_AREA)
+    return float(cv2.Laplacian(gray, cv2.CV_32F).var())
+
+
+def _label(value: float, buckets) -> str:
+    for limit, label in buckets:
+        if value < limit:
+            return label
+    return buckets[-1][1]
+
+
+def image_bucket(*images: np.ndarray) -> str:
+    """一组待匹配图像的分桶：取最大分辨率和最低纹理（较难的那张决定检测器能否成功）"""
+    megapix = max(img.shape[0] * img.shape[1] for img in images) / 1e6
+    texture = min(texture_score(img) for img in images)
+    return f"{_label(megapix, RESOLUTION_BUCKETS)}/{_label(texture, TEXTURE_BUCKETS)}"
+
+
+class DetectorStats:
+    """(分桶, 检测器) -> 尝试次数、成功次数、总耗时；记录直接写入 SQLite，排序读取定期刷新的内存快照
+
+    每个进程复用一个 SQLite 连接（首次使用时打开，出错后丢弃重连），由 _db_lock 串行化，
+    内存快照由 _lock 保护，读写数据库时不持有 _lock
+    """
+
+    def __init__(self, path: str = STITCH_DETECTOR_STATS_PATH, min_samples: int = STITCH_DETECTOR_MIN_SAMPLES,
+                 refresh_seconds: float = STITCH_DETECTOR_STATS_REFRESH_SECONDS):
+        self.path = path
+        self.min_samples = min_samples
+        self.refresh_seconds = refresh_seconds
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._conn_pid = 0
+        self._snapshot: Dict[Tuple[str, str], List[float]] = {}
+        self._loaded_at = 0.0
+
+    def _connection(self) -> sqlite3.Connection:
+        """当前进程的连接（调用方持有 _db_lock）；fork 出的子进程不沿用父进程的连接"""
+        if self._conn is not None and self._conn_pid == os.getpid():
+            return self._conn
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS detector_stats ("
+            " bucket TEXT NOT NULL, detector TEXT NOT NULL,"
+            " attempts INTEGER NOT NULL, successes INTEGER NOT NULL, total_seconds REAL NOT NULL,"
+            " PRIMARY KEY (bucket, detector))"
+        )
+        self._conn, self._conn_pid = conn, os.getpid()
+        return conn
+
+    def _discard_connection(self):
+        """出错后丢弃连接（调用方持有 _db_lock），下次使用时重连"""
+        if self._conn is not None and self._conn_pid == os.getpid():
+            try:
+                self._conn.close()
+            except sqlite3.Error:
+                pass
+        self._conn = None
+
+    def close(self):
+        with self._db_lock:
+            self._discard_connection()
+
+    def record(self, bucket: str, detector: str, success: bool, seconds: float):
+        """记录一次检测 + 匹配的结果，写入失败只打印日志"""
+        with self._lock:
+            entry = self._snapshot.setdefault((bucket, detector), [0, 0, 0.0])
+            entry[0] += 1
+            entry[1] += int(success)
+            entry[2] += seconds
+        with self._db_lock:
+            try:
+                conn = self._connection()
+                with conn:
+                    conn.execute(
+                        "INSERT INTO detector_stats VALUES (?, ?, 1, ?, ?) "
+                        "ON CONFLICT(bucket, detector) DO UPDATE SET attempts = attempts + 1,"
+                        " successes = successes + excluded.successes, total_seconds = total_seconds + excluded.total_seconds",
+                        (bucket, detector, int(success), seconds),
+                    )
+            except sqlite3.Error as e:
+                self._discard_connection()
+                print(f"写入检测器统计失败: {e}")
+
+    def _refresh(self, force: bool = False):
+        with self._lock:
+            if not force and time.time() - self._loaded_at < self.refresh_seconds:
+                return
+        with self._db_lock:
+            try:
+                rows = self._connection().execute(
+                    "SELECT bucket, detector, attempts, successes, total_seconds FROM detector_stats"
+                ).fetchall()
+            except sqlite3.Error as e:
+                self._discard_connection()
+                print(f"读取检测器统计失败: {e}")
+                rows = None
+        with self._lock:
+            self._loaded_at = time.time()
+            if rows is not None:
+                self._snapshot = {(b, d): [a, s, t] for b, d, a, s, t in rows}
+
+    def order(self, detectors: Sequence[str], bucket: str) -> List[str]:
+        """返回该分桶下的尝试顺序：样本不足的检测器保持默认顺序排在前面（继续积累样本），
+        其余按 平均耗时 / 成功率（拉普拉斯平滑）升序"""
+        self._refresh()
+        with self._lock:
+            entries = {d: self._snapshot.get((bucket, d)) for d in detectors}
+
+        unlearned = [d for d in detectors if entries[d] is None or entries[d][0] < self.min_samples]
+
+        def expected_cost(detector):
+            attempts, successes, seconds = entries[detector]
+            return (seconds / attempts) / ((successes + 1) / (attempts + 2))
+
+        learned = sorted((d for d in detectors if d not in unlearned), key=expected_cost)
+        return unlearned + learned
+
+    def stats(self) -> dict:
+        """按分桶汇总：各检测器的样本数、成功率、平均耗时和期望耗时"""
+        self._refresh(force=True)
+        with self._lock:
+            snapshot = dict(self._snapshot)
+
+        buckets: Dict[str, dict] = {}
+        for (bucket, detector), (attempts, successes, seconds) in sorted(snapshot.items()):
+            success_rate = (successes + 1) / (attempts + 2)
+            buckets.setdefault(bucket, {})[detector] = {
+                "attempts": attempts,
+                "successes": successes,
+                "success_rate": round(successes / attempts, 3) if attempts else 0.0,
+                "avg_ms": round(seconds * 1000 / attempts, 1) if attempts else 0.0,
+                "expected_ms": round(seconds * 1000 / attempts / success_rate, 1) if attempts else None,
+            }
+        return {"path": self.path, "min_samples": self.min_samples, "buckets": buckets}
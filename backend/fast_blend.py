@@ -10,7 +10,7 @@ Fast tiled/patched blending that:
 - For each tile: for each image that intersects tile, warp only the ROI
   using H_tile = T_tile * M_final to get small warped patch.
 - Blend with distance-weighted or multiband (distance default).
-- Save final PNG.
+- Save final PNG, or write a DeepZoom tile pyramid (--deepzoom DIR) tile by tile.
 
 Usage:
   python fast_blend.py --images_dir input_images --hom homographies.npz --out fast_result.png \
@@ -29,6 +29,8 @@ from math import ceil
 from multiprocessing import Pool, cpu_count
 from functools import partial
 
+from deepzoom import DeepZoomSettings, DeepZoomWriter, aligned_tile_size
+
 def load_hom_npz(hom_path):
     data = np.load(hom_path, allow_pickle=True)
     indices = data['indices']        # e.g. [0,1,2,...]
@@ -301,6 +303,9 @@ def main(args):
         Hs = Sdst.dot(H)
         T = np.array([[1,0,-x_min],[0,1,-y_min],[0,0,1]], dtype=np.float64)
         M_final[i] = T.dot(Hs)
+    # DeepZoom 输出时每个 tile 须恰好覆盖整数个瓦片
+    if args.deepzoom:
+        args.tile_size = aligned_tile_size(args.tile_size, args.dz_tile_size)
     # create tile list
     tiles = tile_list(canvas_w, canvas_h, args.tile_size)
     print(f'tiles count = {len(tiles)}')
@@ -312,26 +317,47 @@ def main(args):
     # parallel processing
     workers = args.workers if args.workers>0 else max(1, cpu_count()-1)
     print(f'使用 workers = {workers}')
-    results = []
-    if workers == 1:
-        for t in work_items:
-            results.append(worker(t))
+    # 每个 tile 完成后立即写入画布或 DeepZoom 金字塔，不保留全部结果
+    if args.deepzoom:
+        writer = DeepZoomWriter(DeepZoomSettings(args.deepzoom, tile_size=args.dz_tile_size, image_format=args.dz_format,
+                                                 quality=args.dz_quality, workers=workers),
+                                (canvas_w, canvas_h))
+        out = None
     else:
-        with Pool(processes=workers) as pool:
-            for r in pool.imap_unordered(worker, work_items):
-                results.append(r)
-    # assemble canvas
-    out = np.ones((canvas_h, canvas_w, 3), dtype=np.uint8)*255
-    for tx,ty,patch in results:
-        # find tile coords
+        writer = None
+        out = np.ones((canvas_h, canvas_w, 3), dtype=np.uint8)*255
+
+    def consume(result):
+        tx, ty, patch = result
         x0 = tx*args.tile_size; y0 = ty*args.tile_size
-        h_tile, w_tile = patch.shape[:2]
-        out[y0:y0+h_tile, x0:x0+w_tile] = patch
+        if writer is not None:
+            writer.write_region(x0, y0, patch)
+        else:
+            h_tile, w_tile = patch.shape[:2]
+            out[y0:y0+h_tile, x0:x0+w_tile] = patch
+
+    try:
+        if workers == 1:
+            for t in work_items:
+                consume(worker(t))
+        else:
+            with Pool(processes=workers) as pool:
+                for r in pool.imap_unordered(worker, work_items):
+                    consume(r)
+        if writer is not None:
+            pyramid = writer.finish()
+    except BaseException:
+        if writer is not None:
+            writer.abandon()
+        raise
+    if writer is not None:
+        print(f'saved DeepZoom pyramid ({pyramid.levels} levels, {pyramid.tiles} tiles)', pyramid.dzi_path)
+        return
     # save
     cv2.imencode('.png', out)[1].tofile(args.out)
     print('saved', args.out)
 
-if __name__ == '__main__':
+def build_parser():
     p = argparse.ArgumentParser()
     p.add_argument('--images_dir', required=True, help='图片目录（与 hom 文件中 names 的基名应匹配）')
     p.add_argument('--hom', required=True, help='homographies.npz（indices, mats, names）')
@@ -341,7 +367,14 @@ if __name__ == '__main__':
     p.add_argument('--blend', choices=['distance','multiband'], default='distance', help='融合方法')
     p.add_argument('--pyr_levels', type=int, default=3, help='multiband 金字塔层数')
     p.add_argument('--downsample', type=int, default=1, help='缩小因子用于快速预览（整数 >=1），1 表示不缩小')
-    args = p.parse_args()
+    p.add_argument('--deepzoom', default=None, help='输出 DeepZoom 瓦片金字塔到该目录（image.dzi + image_files/），代替 --out')
+    p.add_argument('--dz_tile_size', type=int, choices=[256, 512], default=256, help='DeepZoom 瓦片大小')
+    p.add_argument('--dz_format', choices=['jpeg', 'webp', 'png'], default='jpeg', help='DeepZoom 瓦片格式')
+    p.add_argument('--dz_quality', type=int, default=90, help='DeepZoom 瓦片质量（jpeg / webp）')
+    return p
+
+if __name__ == '__main__':
+    args = build_parser().parse_args()
     main(args)
 
 
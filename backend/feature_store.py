@@ -0,0 +1,159 @@
+"""
+特征缓存模块
+按 (图像内容哈希, 检测器类型, 预处理配置) 缓存预处理后的灰度图、关键点坐标和描述子，
+在同一次拼接请求的各个策略之间以及跨请求（相同照片换顺序重新提交）复用
+"""
+
+import hashlib
+import os
+import threading
+import weakref
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import numpy as np
+
+from matching import DescriptorIndex
+
+FEATURE_STORE_MAX_BYTES = int(os.getenv("FEATURE_STORE_MAX_MB", "512")) * 1024 * 1024
+
+
+@dataclass
+class FeatureEntry:
+    gray: np.ndarray                      # 预处理后的灰度图（检测器的实际输入）
+    points: np.ndarray                    # (N, 2) float32 关键点坐标
+    descriptors: Optional[np.ndarray]     # (N, D) 描述子，检测失败时为 None
+    scale: float = 1.0                    # 检测时相对原图的缩放比例（配准分辨率），points 位于该分辨率
+    index: Any = field(default=None, repr=False, compare=False)  # 描述子近邻索引，首次被匹配时构建
+    _index_lock: threading.Lock = field(default_factory=threading.Lock, init=False, repr=False, compare=False)
+
+    def __len__(self) -> int:
+        return int(self.points.shape[0])
+
+    @property
+    def nbytes(self) -> int:
+        """占用字节数；近邻索引按估算值预先计入（条目入库后才会构建，大小须保持不变）"""
+        size = self.gray.nbytes + self.points.nbytes
+        if self.descriptors is not None:
+            size += self.descriptors.nbytes
+            if len(self.descriptors) >= 2:
+                size += DescriptorIndex.estimate_nbytes(self.descriptors)
+        return size
+
+    def descriptor_index(self) -> Optional[DescriptorIndex]:
+        """描述子近邻索引，首次调用时构建；锁只在本条目上，不同图像的索引可并发构建"""
+        if self.index is None and self.descriptors is not None and len(self.descriptors) >= 2:
+            with self._index_lock:
+                if self.index is None:
+                    self.index = DescriptorIndex(self.descriptors)
+        return self.index
+
+
+# ─── 内容哈希 ───────────────────────────────────────────
+
+# id(image) -> (弱引用, 哈希)，避免同一个数组在一次请求中被重复哈希
+_digest_memo: Dict[int, Tuple[weakref.ref, str]] = {}
+_digest_lock = threading.Lock()
+
+
+def image_digest(image: np.ndarray) -> str:
+    """计算图像内容哈希（同一数组对象只计算一次，调用方不应原地修改已哈希的图像）"""
+    key = id(image)
+    with _digest_lock:
+        memo = _digest_memo.get(key)
+        if memo is not None and memo[0]() is image:
+            return memo[1]
+
+    hasher = hashlib.blake2b(digest_size=16)
+    hasher.update(f"{image.shape}|{image.dtype.str}".encode("ascii"))
+    hasher.update(np.ascontiguousarray(image).data)
+    digest = hasher.hexdigest()
+
+    try:
+        ref = weakref.ref(image, lambda _ref, k=key: _forget_digest(k, _ref))
+    except TypeError:
+        return digest
+    with _digest_lock:
+        _digest_memo[key] = (ref, digest)
+    return digest
+
+
+def _forget_digest(key: int, ref: weakref.ref):
+    with _digest_lock:
+        memo = _digest_memo.get(key)
+        if memo is not None and memo[0] is ref:
+            del _digest_memo[key]
+
+
+# ─── LRU 特征库 ─────────────────────────────────────────
+
+FeatureKey = Tuple[str, str, str]
+
+
+class FeatureStore:
+    """按字节预算淘汰的线程安全 LRU 特征库"""
+
+    def __init__(self, max_bytes: int = FEATURE_STORE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[FeatureKey, FeatureEntry]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: FeatureKey) -> Optional[FeatureEntry]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key: FeatureKey, entry: FeatureEntry):
+        size = entry.nbytes
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old.nbytes
+            self._entries[key] = entry
+            self._bytes += size
+            while self._bytes > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.nbytes
+
+    def get_or_compute(
+        self,
+        image: np.ndarray,
+        detector_key: str,
+        profile: str,
+        compute: Callable[[np.ndarray], Optional[FeatureEntry]],
+    ) -> Optional[FeatureEntry]:
+        """读取缓存，未命中时调用 compute(image) 计算并写入；compute 返回 None 时不缓存"""
+        key = (image_digest(image), detector_key, profile)
+        entry = self.get(key)
+        if entry is not None:
+            return entry
+        entry = compute(image)
+        if entry is not None:
+            self.put(key, entry)
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
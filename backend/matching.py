@@ -0,0 +1,246 @@
+"""
+特征匹配
+knn 匹配 + Lowe ratio test + 坐标提取 + RANSAC 单应估计，app.py 各匹配函数与 stitch_new.py 共用。
+阈值按命名配置（fast / strict / overlap / registration）集中管理；ratio test 和坐标提取
+直接在 knn 距离数组与 KeyPoint_convert 得到的坐标数组上完成，不逐个遍历 DMatch。
+每张图的描述子索引（DescriptorIndex）构建一次后可被所有配对图像查询
+"""
+
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from stitch_timing import span
+
+FLANN_INDEX_KDTREE = 1
+FLANN_INDEX_LSH = 6
+
+KDTREE_INDEX_PARAMS = dict(algorithm=FLANN_INDEX_KDTREE, trees=5)
+# 二进制描述子：与汉明暴力匹配得到的内点数相当，查询快 3~5 倍
+LSH_INDEX_PARAMS = dict(algorithm=FLANN_INDEX_LSH, table_number=6, key_size=12, multi_probe_level=1)
+# 索引内存估算（OpenCV 4.x 实测）：LSH 每张哈希表 2^key_size 个桶约 48 字节/桶、每个点约 20 字节；
+# KD 树每棵树每个点约 170 字节
+LSH_BUCKET_BYTES = 48
+LSH_POINT_BYTES = 20
+KDTREE_POINT_BYTES = 170
+
+
+@dataclass(frozen=True)
+class MatchProfile:
+    ratio: float                   # Lowe ratio
+    min_matches: int               # ratio test 后至少需要的匹配点数
+    ransac_thresh: float           # RANSAC 重投影阈值（像素）
+    max_iters: int = 5000
+    confidence: float = 0.995
+    min_inlier_ratio: float = 0.0  # RANSAC 后的质量要求
+    min_inliers: int = 0
+    flann_checks: int = 50         # 浮点描述子 KD 树搜索精度
+
+
+MATCH_PROFILES: Dict[str, MatchProfile] = {
+    # 一般两图匹配（advanced_feature_matching、拼接顺序估计）
+    "fast": MatchProfile(ratio=0.7, min_matches=10, ransac_thresh=5.0, min_inlier_ratio=0.3),
+    # 提高透视变换精度（improved_feature_matching）
+    "strict": MatchProfile(ratio=0.65, min_matches=15, ransac_thresh=3.0, max_iters=10000, confidence=0.999,
+                           min_inlier_ratio=0.4, min_inliers=10),
+    # 大面积重叠的照片（robust_feature_matching_for_overlap）
+    "overlap": MatchProfile(ratio=0.6, min_matches=20, ransac_thresh=2.0, max_iters=15000, confidence=0.999,
+                            min_inlier_ratio=0.5, min_inliers=15, flann_checks=100),
+    # 多图全局配准的两两匹配（match_pair_for_registration）
+    "registration": MatchProfile(ratio=0.75, min_matches=20, ransac_thresh=4.0, min_inliers=20),
+}
+
+
+@dataclass
+class Matches:
+    """通过 ratio test 的匹配：query_idx[k] 与 train_idx[k] 是一对，distances 为最近邻距离"""
+    query_idx: np.ndarray
+    train_idx: np.ndarray
+    distances: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.query_idx)
+
+    def points(self, points1: np.ndarray, points2: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """按匹配取出两侧坐标，返回 findHomography 需要的 (n, 1, 2) float32 数组"""
+        src = np.asarray(points1, dtype=np.float32)[self.query_idx].reshape(-1, 1, 2)
+        dst = np.asarray(points2, dtype=np.float32)[self.train_idx].reshape(-1, 1, 2)
+        return src, dst
+
+    def to_dmatches(self, mask: Optional[np.ndarray] = None):
+        """转换为 cv2.DMatch 列表（仅用于 drawMatches 可视化），mask 不为空时只保留内点"""
+        keep = np.arange(len(self)) if mask is None else np.flatnonzero(mask.ravel())
+        return [cv2.DMatch(int(self.query_idx[k]), int(self.train_idx[k]), float(self.distances[k])) for k in keep]
+
+
+def keypoint_array(keypoints) -> np.ndarray:
+    """cv2.KeyPoint 列表转为 (n, 2) float32 坐标数组"""
+    if not keypoints:
+        return np.empty((0, 2), dtype=np.float32)
+    return cv2.KeyPoint_convert(keypoints).reshape(-1, 2)
+
+
+def empty_matches() -> Matches:
+    return Matches(np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32))
+
+
+class DescriptorIndex:
+    """一张图描述子的 FLANN 近邻索引：二进制描述子（ORB / AKAZE / BRISK）用 LSH，浮点描述子（SIFT）用 KD 树
+
+    构建后只读，可被多个配对图像（包括多个线程）查询
+    """
+
+    def __init__(self, descriptors: np.ndarray):
+        self.binary = descriptors.dtype == np.uint8
+        if self.binary:
+            self.descriptors = np.ascontiguousarray(descriptors)
+            params = LSH_INDEX_PARAMS
+        else:
+            self.descriptors = np.ascontiguousarray(descriptors, dtype=np.float32)
+            params = KDTREE_INDEX_PARAMS
+        with span("match"):
+            self._index = cv2.flann_Index(self.descriptors, params)
+
+    def __len__(self) -> int:
+        return len(self.descriptors)
+
+    @staticmethod
+    def estimate_nbytes(descriptors: np.ndarray) -> int:
+        """为这些描述子构建索引的内存估算（不含描述子本身；浮点转换产生的副本计入）"""
+        n = len(descriptors)
+        if descriptors.dtype == np.uint8:
+            tables = LSH_INDEX_PARAMS["table_number"]
+            return tables * (2 ** LSH_INDEX_PARAMS["key_size"] * LSH_BUCKET_BYTES + n * LSH_POINT_BYTES)
+        size = KDTREE_INDEX_PARAMS["trees"] * n * KDTREE_POINT_BYTES
+        if descriptors.dtype != np.float32:
+            size += n * descriptors.shape[1] * 4
+        return size
+
+    @property
+    def nbytes(self) -> int:
+        return self.estimate_nbytes(self.descriptors)
+
+    def knn(self, query: np.ndarray, k: int = 2, flann_checks: int = 50) -> Tuple[np.ndarray, np.ndarray]:
+        """返回 (indices, distances)，形状均为 (len(query), k)；LSH 找不到的近邻 index 为 -1"""
+        if not self.binary:
+            query = np.ascontiguousarray(query, dtype=np.float32)
+        idx, dist = self._index.knnSearch(query, k, params=dict(checks=flann_checks))
+        if self.binary:
+            return idx, dist.astype(np.float32)
+        # FLANN 的 L2 返回距离平方
+        return idx, np.sqrt(dist)
+
+
+def knn_search(query: np.ndarray, train: np.ndarray, k: int = 2, flann_checks: int = 50,
+               exact: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+    """返回 (indices, distances)，形状均为 (len(query), k)。调用方保证 len(train) >= k
+
+    默认为 train 临时构建 DescriptorIndex；exact=True 时暴力匹配（二进制描述子用汉明距离，浮点用 L2）
+    """
+    if not exact:
+        return DescriptorIndex(train).knn(query, k, flann_checks)
+    if query.dtype == np.uint8:
+        dist, idx = cv2.batchDistance(query, train, cv2.CV_32S, normType=cv2.NORM_HAMMING, K=k)
+        return idx, dist.astype(np.float32)
+    dist, idx = cv2.batchDistance(np.ascontiguousarray(query, dtype=np.float32),
+                                  np.ascontiguousarray(train, dtype=np.float32),
+                                  cv2.CV_32F, normType=cv2.NORM_L2, K=k)
+    return idx, dist
+
+
+def ratio_test(indices: np.ndarray, distances: np.ndarray, ratio: float) -> Matches:
+    """Lowe ratio test：最近邻距离 < ratio × 次近邻距离"""
+    keep = (indices[:, 0] >= 0) & (indices[:, 1] >= 0) & (distances[:, 0] < ratio * distances[:, 1])
+    query_idx = np.flatnonzero(keep).astype(np.int32)
+    return Matches(query_idx, indices[query_idx, 0].astype(np.int32), distances[query_idx, 0])
+
+
+def match_descriptors(des1: Optional[np.ndarray], des2: Optional[np.ndarray], ratio: float = 0.75,
+                      flann_checks: int = 50, index: Optional[DescriptorIndex] = None) -> Matches:
+    """des1 中每个描述子在 des2 中找两个近邻并做 ratio test；index 为 des2 预先构建的索引（可选）"""
+    if des1 is None or des2 is None or len(des1) == 0 or len(des2) < 2:
+        return empty_matches()
+    with span("match"):
+        if index is None:
+            index = DescriptorIndex(des2)
+        indices, distances = index.knn(des1, 2, flann_checks)
+        return ratio_test(indices, distances, ratio)
+
+
+def match_with_profile(des1, des2, profile: MatchProfile, index: Optional[DescriptorIndex] = None) -> Matches:
+    return match_descriptors(des1, des2, profile.ratio, profile.flann_checks, index)
+
+
+def estimate_homography(src_pts: np.ndarray, dst_pts: np.ndarray, profile: MatchProfile):
+    """RANSAC 估计把 src 映射到 dst 的单应，返回 (H, mask)"""
+    with span("ransac"):
+        return cv2.findHomography(src_pts, dst_pts, cv2.RANSAC,
+                                  ransacReprojThreshold=profile.ransac_thresh,
+                                  maxIters=profile.max_iters,
+                                  confidence=profile.confidence)
+
+
+class GlobalDescriptorIndex:
+    """所有图像的描述子放进同一个近邻索引（每个描述子记录所属图像），每张图查询一次即可得到它与所有图像的匹配
+
+    ratio test 在同一目标图像内做：对每个查询描述子，取落在图像 j 的第一个近邻，与 j 中的下一个近邻比较；
+    j 的第二个近邻不在前 k 个结果中时用第 k 个距离代替（真实次近邻只会更远，检验更保守）
+    """
+
+    def __init__(self, des_list):
+        self.num_images = len(des_list)
+        valid = [(i, d) for i, d in enumerate(des_list) if d is not None and len(d) > 0]
+        self.image_ids = np.concatenate([np.full(len(d), i, dtype=np.int32) for i, d in valid]) if valid else None
+        self.local_idx = np.concatenate([np.arange(len(d), dtype=np.int32) for _, d in valid]) if valid else None
+        self.index = DescriptorIndex(np.vstack([d for _, d in valid])) if valid else None
+
+    def query(self, image_id: int, descriptors: Optional[np.ndarray], k: int = 8, ratio: float = 0.75,
+              flann_checks: int = 50) -> Dict[int, Matches]:
+        """返回 {j: 图像 image_id -> 图像 j 的匹配}"""
+        if self.index is None or descriptors is None or len(descriptors) == 0:
+            return {}
+        k = min(k, len(self.index))
+        if k < 2:
+            return {}
+        idx, dist = self.index.knn(descriptors, k, flann_checks)
+        img = np.where(idx >= 0, self.image_ids[np.maximum(idx, 0)], -1)
+
+        # first[:, c]：第 c 个近邻是该行中落在这张图像的第一个近邻
+        first = (img >= 0) & (img != image_id)
+        for c in range(1, k):
+            for e in range(c):
+                first[:, c] &= img[:, c] != img[:, e]
+
+        # second[:, c]：同一图像中的下一个近邻距离，找不到时为第 k 个距离
+        keep = np.zeros_like(first)
+        for c in range(k - 1):
+            second = dist[:, k - 1].copy()
+            for c2 in range(k - 1, c, -1):
+                same = img[:, c2] == img[:, c]
+                second[same] = dist[same, c2]
+            keep[:, c] = first[:, c] & (dist[:, c] < ratio * second)
+
+        rows, cols = np.nonzero(keep)
+        targets = img[rows, cols]
+        train = self.local_idx[idx[rows, cols]]
+        distances = dist[rows, cols]
+        result = {}
+        for j in np.unique(targets):
+            sel = targets == j
+            result[int(j)] = Matches(rows[sel].astype(np.int32), train[sel], distances[sel])
+        return result
+
+
+def global_correspondences(des_list, k: int = 8, ratio: float = 0.75, flann_checks: int = 50,
+                           min_matches: int = 1) -> Dict[Tuple[int, int], Matches]:
+    """N 次查询得到所有图像对的原始匹配：返回 {(i, j): i -> j 的匹配}（i < j，只保留匹配数 >= min_matches 的图像对）"""
+    with span("match"):
+        index = GlobalDescriptorIndex(des_list)
+        pairs = {}
+        for i, des in enumerate(des_list):
+            for j, matches in index.query(i, des, k, ratio, flann_checks).items():
+                if j > i and len(matches) >= min_matches:
+                    pairs[(i, j)] = matches
+        return pairs
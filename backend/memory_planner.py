@@ -0,0 +1,122 @@
+"""
+拼接内存规划
+在分配输出画布之前，根据投影后的画布尺寸估算峰值内存，并按单个请求的内存预算选择：
+整图内存融合、分块融合（stitch_new.tiled_blend_parallel）、缩小输出，或者直接拒绝
+"""
+
+import math
+import os
+from dataclasses import dataclass
+from typing import Iterable, Tuple
+
+STITCH_MEMORY_BUDGET_BYTES = int(os.getenv("STITCH_MEMORY_BUDGET_MB", "1536")) * 1024 * 1024
+# 预算不足时输出允许缩小到的最小比例，再小则拒绝
+STITCH_MIN_OUTPUT_SCALE = float(os.getenv("STITCH_MIN_OUTPUT_SCALE", "0.25"))
+
+TILE_SIZES = (2048, 1024, 512)
+
+# 每像素字节数（估算值，偏保守）
+CANVAS_BYTES_PER_PIXEL = 3 * 1.5   # 输出画布 + 编码缓冲
+ROI_BYTES_PER_PIXEL = 10           # 变换后的图2、alpha、各类掩码
+OVERLAP_BYTES_PER_PIXEL = 60       # 重叠区的浮点权重与融合临时数组
+TILE_BYTES_PER_PIXEL = 40          # 每块的累加器、距离图
+TILE_IMAGE_BYTES_PER_PIXEL = 13    # 每块中每张图的 float32 变换结果和掩码
+
+
+class MemoryBudgetError(Exception):
+    """即使分块并缩小输出也无法满足内存预算"""
+
+    def __init__(self, estimated_bytes: int, budget_bytes: int, canvas_size: Tuple[int, int]):
+        self.estimated_bytes = estimated_bytes
+        self.budget_bytes = budget_bytes
+        self.canvas_size = canvas_size
+        super().__init__(
+            f"输出画布 {canvas_size[0]}x{canvas_size[1]} 预计需要 {to_mb(estimated_bytes)} MB 内存，"
+            f"超过单个请求的预算 {to_mb(budget_bytes)} MB，请减少图像数量或降低输入分辨率"
+        )
+
+
+@dataclass
+class BlendPlan:
+    mode: str                        # memory / tiled / downscale
+    canvas_size: Tuple[int, int]     # 实际输出尺寸（downscale 时已缩小）
+    estimated_bytes: int
+    scale: float = 1.0               # 输出相对原画布的比例
+    tile_size: int = TILE_SIZES[0]
+    workers: int = 1
+
+    def describe(self) -> str:
+        w, h = self.canvas_size
+        text = f"{self.mode} {w}x{h}，预计 {to_mb(self.estimated_bytes)} MB"
+        if self.mode != "memory":
+            text += f"，分块 {self.tile_size}，线程 {self.workers}"
+        if self.scale < 1.0:
+            text += f"，缩放 {self.scale:.2f}"
+        return text
+
+
+def to_mb(num_bytes: float) -> int:
+    return int(math.ceil(num_bytes / (1024 * 1024)))
+
+
+def images_nbytes(images: Iterable) -> int:
+    return sum(int(img.nbytes) for img in images)
+
+
+def estimate_in_memory_bytes(canvas_size, roi_size, overlap_size, input_bytes=0) -> int:
+    """两图整图融合（stitch_with_homography / enhanced_stitch_with_perspective）的峰值估算"""
+    canvas_pixels = canvas_size[0] * canvas_size[1]
+    roi_pixels = roi_size[0] * roi_size[1]
+    overlap_pixels = overlap_size[0] * overlap_size[1]
+    return int(input_bytes + canvas_pixels * CANVAS_BYTES_PER_PIXEL
+               + roi_pixels * ROI_BYTES_PER_PIXEL + overlap_pixels * OVERLAP_BYTES_PER_PIXEL)
+
+
+def estimate_tiled_bytes(canvas_size, tile_size, workers, images_per_tile=2, input_bytes=0,
+                         canvas_bytes_per_pixel=CANVAS_BYTES_PER_PIXEL) -> int:
+    """分块融合的峰值估算：输出画布 + 每个线程一块的临时数组"""
+    canvas_pixels = canvas_size[0] * canvas_size[1]
+    tile_pixels = min(tile_size * tile_size, canvas_pixels)
+    per_tile = tile_pixels * (TILE_BYTES_PER_PIXEL + TILE_IMAGE_BYTES_PER_PIXEL * images_per_tile)
+    return int(input_bytes + canvas_pixels * canvas_bytes_per_pixel + max(1, workers) * per_tile)
+
+
+def plan_blend(canvas_size, input_bytes=0, roi_size=None, overlap_size=None, images_per_tile=2,
+               workers=None, budget_bytes=STITCH_MEMORY_BUDGET_BYTES,
+               min_scale=STITCH_MIN_OUTPUT_SCALE, canvas_bytes_per_pixel=CANVAS_BYTES_PER_PIXEL) -> BlendPlan:
+    """按内存预算选择融合方式；roi_size 为空表示调用方只支持分块融合。无法满足时抛出 MemoryBudgetError
+
+    canvas_bytes_per_pixel：分块融合时输出画布每像素的内存（分块直接写成瓦片时远小于整张画布）
+    """
+    workers = max(1, workers or os.cpu_count() or 1)
+
+    if roi_size is not None:
+        estimated = estimate_in_memory_bytes(canvas_size, roi_size, overlap_size or (0, 0), input_bytes)
+        if estimated <= budget_bytes:
+            return BlendPlan("memory", canvas_size, estimated)
+
+    # 分块融合：优先大块多线程，不够时减小块和线程数
+    for tile_size in TILE_SIZES:
+        for tile_workers in sorted({workers, max(1, workers // 2), 1}, reverse=True):
+            estimated = estimate_tiled_bytes(canvas_size, tile_size, tile_workers, images_per_tile, input_bytes,
+                                             canvas_bytes_per_pixel)
+            if estimated <= budget_bytes:
+                return BlendPlan("tiled", canvas_size, estimated, tile_size=tile_size, workers=tile_workers)
+
+    # 缩小输出：画布相关的部分按比例平方缩小，块的临时数组不变
+    tile_size = TILE_SIZES[-1]
+    fixed = input_bytes + tile_size * tile_size * (TILE_BYTES_PER_PIXEL + TILE_IMAGE_BYTES_PER_PIXEL * images_per_tile)
+    canvas_pixels = canvas_size[0] * canvas_size[1]
+    available = budget_bytes - fixed
+    if available > 0 and canvas_pixels > 0:
+        scale = math.sqrt(available / (canvas_pixels * canvas_bytes_per_pixel))
+        if scale >= min_scale:
+            scale = min(scale, 1.0)
+            scaled = (max(1, int(canvas_size[0] * scale)), max(1, int(canvas_size[1] * scale)))
+            estimated = estimate_tiled_bytes(scaled, tile_size, 1, images_per_tile, input_bytes, canvas_bytes_per_pixel)
+            return BlendPlan("downscale", scaled, estimated, scale=scale, tile_size=tile_size, workers=1)
+
+    raise MemoryBudgetError(
+        estimate_tiled_bytes(canvas_size, tile_size, 1, images_per_tile, input_bytes, canvas_bytes_per_pixel),
+        budget_bytes, canvas_size
+    )
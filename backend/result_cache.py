@@ -0,0 +1,209 @@
+"""
+拼接结果缓存
+把编码后的拼接结果按 (输入内容哈希, 拼接参数, 代码版本) 存到磁盘，按总字节数做 LRU 淘汰，
+用户重复提交同一组照片（前端重试、切回之前的结果）时直接返回，无需重新拼接
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import BinaryIO, Dict, Iterable, Optional
+
+STITCH_RESULT_CACHE_DIR = os.getenv(
+    "STITCH_RESULT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "stitch-result-cache")
+)
+# 0 表示关闭缓存
+STITCH_RESULT_CACHE_MAX_BYTES = int(os.getenv("STITCH_RESULT_CACHE_MAX_MB", "1024")) * 1024 * 1024
+
+
+def source_version(paths: Iterable[str], extra: str = "") -> str:
+    """根据源码内容生成版本号，拼接代码变化后旧缓存自动失效"""
+    hasher = hashlib.blake2b(digest_size=8)
+    for path in paths:
+        with open(path, "rb") as f:
+            hasher.update(f.read())
+    hasher.update(extra.encode("utf-8"))
+    return hasher.hexdigest()
+
+
+def content_digest(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def stitch_cache_key(input_digests: Iterable[str], params: dict, version: str, ordered: bool = True) -> str:
+    """缓存键：输入哈希（ordered=False 时与提交顺序无关）+ 参数 + 代码版本"""
+    digests = list(input_digests)
+    if not ordered:
+        digests.sort()
+    payload = json.dumps(
+        {"inputs": digests, "ordered": ordered, "params": params, "version": version},
+        sort_keys=True,
+    )
+    return hashlib.blake2b(payload.encode("utf-8"), digest_size=16).hexdigest()
+
+
+@dataclass
+class CachedResult:
+    path: str        # 编码后图像文件
+    media_type: str
+    width: int
+    height: int
+    size: int
+
+    def read(self) -> bytes:
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    def open(self) -> BinaryIO:
+        """打开数据文件；打开后即使文件被淘汰删除也能读完（文件已不存在时抛出 FileNotFoundError）"""
+        return open(self.path, "rb")
+
+
+class ResultCache:
+    """磁盘 LRU：每个结果一个数据文件和一个元数据 JSON，最近访问时间记录在文件 mtime 上，重启后可恢复"""
+
+    def __init__(self, directory: str = STITCH_RESULT_CACHE_DIR, max_bytes: int = STITCH_RESULT_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, Dict]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._loaded = False
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def _data_path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.bin")
+
+    def _meta_path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _ensure_loaded(self):
+        """首次使用时扫描缓存目录，按 mtime 重建 LRU 顺序（调用方持有锁）"""
+        if self._loaded:
+            return
+        self._loaded = True
+        os.makedirs(self.directory, exist_ok=True)
+
+        found = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            key = name[:-5]
+            try:
+                with open(self._meta_path(key), "r", encoding="utf-8") as f:
+                    meta = json.load(f)
+                stat = os.stat(self._data_path(key))
+            except (OSError, ValueError):
+                continue
+            meta["size"] = stat.st_size
+            found.append((stat.st_mtime, key, meta))
+
+        for _, key, meta in sorted(found):
+            self._entries[key] = meta
+            self._bytes += meta["size"]
+        self._evict()
+
+    def get(self, key: str) -> Optional[CachedResult]:
+        if not self.enabled:
+            return None
+        with self._lock:
+            self._ensure_loaded()
+            meta = self._entries.get(key)
+            if meta is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            path = self._data_path(key)
+        try:
+            now = time.time()
+            os.utime(path, (now, now))
+        except FileNotFoundError:
+            # 数据文件已被并发的淘汰（或其他进程的缓存实例）删除
+            self.discard(key)
+            with self._lock:
+                self.misses += 1
+            return None
+        except OSError:
+            pass
+        with self._lock:
+            self.hits += 1
+        return CachedResult(path=path, media_type=meta["media_type"], width=meta["width"],
+                            height=meta["height"], size=meta["size"])
+
+    def discard(self, key: str):
+        """从索引中移除并删除文件（数据文件已丢失或读取失败时调用）"""
+        with self._lock:
+            meta = self._entries.pop(key, None)
+            if meta is not None:
+                self._bytes -= meta["size"]
+        for path in (self._meta_path(key), self._data_path(key)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def put(self, key: str, data: bytes, media_type: str, width: int, height: int):
+        """原子写入（临时文件 + 替换），超过预算时淘汰最久未访问的结果"""
+        if not self.enabled or len(data) > self.max_bytes:
+            return
+        with self._lock:
+            self._ensure_loaded()
+
+        meta = {"media_type": media_type, "width": width, "height": height}
+        try:
+            for path, content in ((self._data_path(key), data),
+                                  (self._meta_path(key), json.dumps(meta).encode("utf-8"))):
+                fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+                with os.fdopen(fd, "wb") as f:
+                    f.write(content)
+                os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"写入拼接结果缓存失败: {e}")
+            return
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old["size"]
+            self._entries[key] = {**meta, "size": len(data)}
+            self._bytes += len(data)
+            self.stores += 1
+            self._evict()
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and self._entries:
+            key, meta = self._entries.popitem(last=False)
+            self._bytes -= meta["size"]
+            self.evictions += 1
+            for path in (self._meta_path(key), self._data_path(key)):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "stores": self.stores,
+                "evictions": self.evictions,
+            }
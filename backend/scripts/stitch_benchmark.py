@@ -0,0 +1,380 @@
+"""
+拼接基准与精度测试
+
+在程序生成的大纹理上按已知单应截取相互重叠的图像（可叠加噪声、曝光差异和旋转），分别运行
+app.simple_stitch_two_images、app.advanced_multi_image_stitch、stitch_new.py 流水线和 fast_blend.py（用真值单应，只测融合），
+记录耗时、峰值内存和重投影误差，结果写入 JSON，便于对比不同提交。
+
+每个用例在独立的子进程中运行，峰值内存互不影响。重投影误差与拼接方法无关：把每张输入图重新配准到输出图上，
+得到它们在输出中的相对位置，与真值单应比较输入图四个角点的偏差（像素）。
+
+用法：
+  python scripts/stitch_benchmark.py --sizes 800x600,1600x1200 --counts 2,4,8 --out bench.json
+  python scripts/stitch_benchmark.py --methods stitch_new --compare bench.json --out bench_new.json
+"""
+
+import argparse
+import contextlib
+import json
+import math
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+BASE_DIR = Path(__file__).resolve().parents[1]
+if str(BASE_DIR) not in sys.path:
+    sys.path.insert(0, str(BASE_DIR))
+
+import matching
+from stitch_timing import current_timings, peak_rss_mb, reset_timings, start_timings
+
+METHODS = ("simple_two", "advanced_multi", "stitch_new", "fast_blend")
+VARIATIONS = ("clean", "noise", "exposure", "rotation")
+
+# 输出图上重新定位输入图时的检测尺寸上限与最少内点
+LOCATE_MAX_SIDE = 3000
+LOCATE_MIN_INLIERS = 15
+
+
+# ─── 合成数据 ────────────────────────────────────────────
+
+def procedural_texture(width, height, seed=0):
+    """多尺度噪声 + 随机几何图形，各尺度都有可检测的特征点，没有重复纹理"""
+    rng = np.random.default_rng(seed)
+    texture = np.zeros((height, width, 3), dtype=np.float32)
+    for cell, weight in ((256, 90.0), (64, 60.0), (16, 40.0), (4, 20.0)):
+        small = rng.random((height // cell + 2, width // cell + 2, 3), dtype=np.float32)
+        texture += weight * cv2.resize(small, (width, height), interpolation=cv2.INTER_CUBIC)
+    texture = np.clip(texture, 0, 255).astype(np.uint8)
+
+    for _ in range(width * height // 15000):
+        color = tuple(int(c) for c in rng.integers(0, 256, 3))
+        x, y = int(rng.integers(0, width)), int(rng.integers(0, height))
+        size = int(rng.integers(4, 60))
+        kind = rng.integers(0, 3)
+        if kind == 0:
+            cv2.circle(texture, (x, y), size, color, int(rng.choice([-1, 2])), cv2.LINE_AA)
+        elif kind == 1:
+            cv2.rectangle(texture, (x, y), (x + size, y + int(rng.integers(4, 60))), color, int(rng.choice([-1, 2])))
+        else:
+            end = (x + int(rng.integers(-80, 80)), y + int(rng.integers(-80, 80)))
+            cv2.line(texture, (x, y), end, color, int(rng.integers(1, 4)), cv2.LINE_AA)
+    return texture
+
+
+def view_transform(x, y, w, h, angle_deg):
+    """输入图坐标 -> 纹理坐标：绕图像中心旋转 angle 后平移到 (x, y)"""
+    c, s = math.cos(math.radians(angle_deg)), math.sin(math.radians(angle_deg))
+    to_center = np.array([[1, 0, -w / 2], [0, 1, -h / 2], [0, 0, 1]], dtype=np.float64)
+    rotate = np.array([[c, -s, 0], [s, c, 0], [0, 0, 1]], dtype=np.float64)
+    place = np.array([[1, 0, x + w / 2], [0, 1, y + h / 2], [0, 0, 1]], dtype=np.float64)
+    return place @ rotate @ to_center
+
+
+def synthesize_panorama(count, size, variation, overlap=0.4, max_angle=5.0, seed=0):
+    """返回 (crops, H_to_ref)：count 张横向排列的重叠图像，H_to_ref[i] 把图 i 的坐标映射到图 0"""
+    w, h = size
+    rng = np.random.default_rng(seed)
+    step = w * (1 - overlap)
+    margin = int(0.2 * max(w, h))
+    texture = procedural_texture(int(w + step * (count - 1)) + 2 * margin, h + 2 * margin, seed)
+
+    transforms, crops = [], []
+    for i in range(count):
+        angle = float(rng.uniform(-max_angle, max_angle)) if variation == "rotation" else 0.0
+        G = view_transform(margin + i * step, margin + rng.uniform(-0.03, 0.03) * h, w, h, angle)
+        crop = cv2.warpPerspective(texture, G, (w, h), flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP)
+        if variation == "noise":
+            crop = np.clip(crop + rng.normal(0, 8, crop.shape), 0, 255).astype(np.uint8)
+        elif variation == "exposure":
+            gain, bias = rng.uniform(0.75, 1.25), rng.uniform(-15, 15)
+            crop = np.clip(crop.astype(np.float32) * gain + bias, 0, 255).astype(np.uint8)
+        transforms.append(G)
+        crops.append(crop)
+
+    G0_inv = np.linalg.inv(transforms[0])
+    return crops, [G0_inv @ G for G in transforms]
+
+
+# ─── 精度 ───────────────────────────────────────────────
+
+def create_locator():
+    return cv2.SIFT_create(nfeatures=8000) if hasattr(cv2, "SIFT_create") else cv2.ORB_create(nfeatures=10000)
+
+
+def detect(detector, image, scale):
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    if scale < 1.0:
+        gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    kps, des = detector.detectAndCompute(gray, None)
+    return matching.keypoint_array(kps), des
+
+
+def locate_crops(output, crops):
+    """把每张输入图配准到输出图上，返回 {i: H（输入图 -> 输出图）}，找不到的图不在结果中"""
+    scale = min(1.0, LOCATE_MAX_SIDE / max(output.shape[:2]))
+    detector = create_locator()
+    out_pts, out_des = detect(detector, output, scale)
+    if out_des is None or len(out_des) < 2:
+        return {}
+    index = matching.DescriptorIndex(out_des)
+    S = np.diag([scale, scale, 1.0])
+
+    placed = {}
+    for i, crop in enumerate(crops):
+        pts, des = detect(detector, crop, scale)
+        found = matching.match_descriptors(des, out_des, ratio=0.75, index=index)
+        if len(found) < LOCATE_MIN_INLIERS:
+            continue
+        src, dst = found.points(pts, out_pts)
+        H, mask = cv2.findHomography(src, dst, cv2.RANSAC, 3.0)
+        if H is None or mask.sum() < LOCATE_MIN_INLIERS:
+            continue
+        placed[i] = np.linalg.inv(S) @ H @ S
+    return placed
+
+
+def reprojection_errors(output, crops, H_to_ref):
+    """各输入图四个角点在输出中相对于第一张能定位的图的位置，与真值的偏差（RMS，像素）"""
+    placed = locate_crops(output, crops)
+    if not placed:
+        return placed, {}
+    ref = min(placed)
+    to_ref = np.linalg.inv(placed[ref])
+    truth_to_ref = np.linalg.inv(H_to_ref[ref])
+    errors = {}
+    for i, P in placed.items():
+        if i == ref:
+            continue
+        h, w = crops[i].shape[:2]
+        corners = np.float32([[0, 0], [w, 0], [w, h], [0, h]]).reshape(-1, 1, 2)
+        estimated = cv2.perspectiveTransform(corners, to_ref @ P)
+        expected = cv2.perspectiveTransform(corners, truth_to_ref @ H_to_ref[i])
+        errors[i] = float(np.sqrt(np.mean(np.sum((estimated - expected) ** 2, axis=2))))
+    return placed, errors
+
+
+# ─── 用例（子进程中运行）─────────────────────────────────────
+
+def run_method(method, crops, case_dir, workers):
+    """运行一种拼接方法，返回输出图（失败时为 None）"""
+    if method == "simple_two":
+        import app
+        return app.simple_stitch_two_images(crops[0], crops[1])
+    if method == "advanced_multi":
+        import app
+        return app.advanced_multi_image_stitch(crops)
+
+    out_path = os.path.join(case_dir, f"{method}.png")
+    if method == "stitch_new":
+        import stitch_new
+        stitch_new.main(stitch_new.build_parser().parse_args([
+            "--input_dir", os.path.join(case_dir, "crops"), "--out", out_path,
+            "--hom_out", os.path.join(case_dir, "stitch_new.npz"), "--tile", "--workers", str(workers),
+        ]))
+    else:
+        import fast_blend
+        fast_blend.main(fast_blend.build_parser().parse_args([
+            "--images_dir", os.path.join(case_dir, "crops"), "--hom", os.path.join(case_dir, "truth.npz"),
+            "--out", out_path, "--workers", str(workers),
+        ]))
+    return cv2.imread(out_path, cv2.IMREAD_COLOR) if os.path.exists(out_path) else None
+
+
+def run_case(method, case_dir, workers, verbose, queue):
+    # 检测器统计写到用例目录，避免影响服务的检测器排序
+    os.environ["STITCH_DETECTOR_STATS_PATH"] = os.path.join(case_dir, "detector-stats.sqlite3")
+    record = {"method": method}
+    log = None
+    try:
+        with contextlib.ExitStack() as stack:
+            if not verbose:
+                log = stack.enter_context(open(os.path.join(case_dir, f"{method}.log"), "w", encoding="utf-8"))
+                stack.enter_context(contextlib.redirect_stdout(log))
+                stack.enter_context(contextlib.redirect_stderr(log))
+
+            truth = np.load(os.path.join(case_dir, "truth.npz"))
+            crops = [cv2.imread(os.path.join(case_dir, "crops", name), cv2.IMREAD_COLOR) for name in truth["names"]]
+            # 先导入被测模块，基线内存不计入导入开销
+            import app, stitch_new, fast_blend  # noqa: F401
+
+            baseline = peak_rss_mb()
+            token = start_timings()
+            started = time.perf_counter()
+            try:
+                output = run_method(method, crops, case_dir, workers)
+            finally:
+                record["seconds"] = round(time.perf_counter() - started, 3)
+                record["stages"] = current_timings().summary()["stages"]
+                reset_timings(token)
+            peak = peak_rss_mb()
+            record["peak_rss_mb"] = round(peak, 1) if peak is not None else None
+            record["rss_delta_mb"] = round(peak - baseline, 1) if peak is not None else None
+
+            record["ok"] = output is not None and output.size > 0
+            if record["ok"]:
+                record["output_size"] = [int(output.shape[1]), int(output.shape[0])]
+                placed, errors = reprojection_errors(output, crops, list(truth["mats"]))
+                record["placed"] = len(placed)
+                record["reproj_error_px"] = {
+                    "mean": round(float(np.mean(list(errors.values()))), 2) if errors else None,
+                    "max": round(float(np.max(list(errors.values()))), 2) if errors else None,
+                    "per_image": {str(i): round(e, 2) for i, e in sorted(errors.items())},
+                }
+    except Exception as e:
+        record["ok"] = False
+        record["error"] = f"{type(e).__name__}: {e}"
+        if log is None:
+            traceback.print_exc()
+    queue.put(record)
+
+
+def run_isolated(method, case_dir, workers, timeout, verbose):
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    process = ctx.Process(target=run_case, args=(method, case_dir, workers, verbose, queue))
+    process.start()
+    try:
+        return queue.get(timeout=timeout)
+    except Exception:
+        return {"method": method, "ok": False, "error": f"超时（{timeout}s）或子进程异常退出"}
+    finally:
+        process.join(timeout=5)
+        if process.is_alive():
+            process.kill()
+
+
+# ─── 主流程 ─────────────────────────────────────────────
+
+def write_case(case_dir, crops, H_to_ref):
+    """输入图写成 JPEG（质量 95），真值单应写成 fast_blend 使用的 npz 格式（indices, mats, names）"""
+    os.makedirs(os.path.join(case_dir, "crops"), exist_ok=True)
+    names = [f"{i:03d}.jpg" for i in range(len(crops))]
+    for name, crop in zip(names, crops):
+        cv2.imwrite(os.path.join(case_dir, "crops", name), crop, [cv2.IMWRITE_JPEG_QUALITY, 95])
+    np.savez(os.path.join(case_dir, "truth.npz"), indices=np.arange(len(crops), dtype=np.int32),
+             mats=np.stack(H_to_ref), names=np.array(names))
+
+
+def methods_for(count, methods):
+    # 两图方法只跑两张图，逐步多图拼接只跑三张及以上
+    return [m for m in methods if (m != "simple_two" or count == 2) and (m != "advanced_multi" or count >= 3)]
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BASE_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def result_key(r):
+    return (r["method"], r["variation"], r["count"], r["size"])
+
+
+def print_result(r):
+    error = (r.get("reproj_error_px") or {}).get("mean")
+    status = "ok" if r.get("ok") else f"失败 {r.get('error', '')}"
+    print(f"  {r['method']:<15} {r['seconds'] if 'seconds' in r else '-':>8}s  "
+          f"峰值 {r.get('peak_rss_mb') or '-':>7}MB (+{r.get('rss_delta_mb') or '-'})  "
+          f"误差 {error if error is not None else '-':>6}px  定位 {r.get('placed', '-')}/{r['count']}  {status}")
+
+
+def print_comparison(results, baseline_path):
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+    previous = {result_key(r): r for r in baseline["results"]}
+    print(f"\n与 {baseline_path}（提交 {baseline.get('commit')}）对比：")
+    for r in results:
+        old = previous.get(result_key(r))
+        if old is None or not old.get("ok") or not r.get("ok"):
+            continue
+        old_error = (old.get("reproj_error_px") or {}).get("mean")
+        new_error = (r.get("reproj_error_px") or {}).get("mean")
+        error_delta = f"{new_error - old_error:+.2f}px" if old_error is not None and new_error is not None else "-"
+        print(f"  {r['method']:<15} {r['variation']:<9} n={r['count']:<3} {r['size']:<10} "
+              f"耗时 x{r['seconds'] / max(old['seconds'], 1e-6):.2f}  "
+              f"内存 {(r.get('rss_delta_mb') or 0) - (old.get('rss_delta_mb') or 0):+.1f}MB  误差 {error_delta}")
+
+
+def parse_size(text):
+    w, h = text.lower().split("x")
+    return int(w), int(h)
+
+
+def main(args):
+    sizes = [parse_size(s) for s in args.sizes.split(",")]
+    counts = [int(c) for c in args.counts.split(",")]
+    variations = args.variations.split(",")
+    methods = args.methods.split(",")
+    for name in methods:
+        if name not in METHODS:
+            raise SystemExit(f"未知方法 {name}，可选: {', '.join(METHODS)}")
+    for name in variations:
+        if name not in VARIATIONS:
+            raise SystemExit(f"未知变化 {name}，可选: {', '.join(VARIATIONS)}")
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="stitch-bench-")
+    results = []
+    for size in sizes:
+        for count in counts:
+            for variation in variations:
+                case = f"{size[0]}x{size[1]}-n{count}-{variation}"
+                case_dir = os.path.join(work_dir, case)
+                crops, H_to_ref = synthesize_panorama(count, size, variation, overlap=args.overlap, seed=args.seed)
+                write_case(case_dir, crops, H_to_ref)
+                del crops
+                print(f"{case}:")
+                for method in methods_for(count, methods):
+                    record = run_isolated(method, case_dir, args.workers, args.timeout, args.verbose)
+                    record.update(size=f"{size[0]}x{size[1]}", count=count, variation=variation)
+                    results.append(record)
+                    print_result(record)
+
+    report = {
+        "commit": git_commit(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "opencv": cv2.__version__,
+        "cpu_count": os.cpu_count(),
+        "config": {"sizes": args.sizes, "counts": args.counts, "variations": args.variations,
+                   "methods": args.methods, "overlap": args.overlap, "seed": args.seed, "workers": args.workers},
+        "results": results,
+    }
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\n结果已写入 {args.out}，用例目录 {work_dir}")
+
+    if args.compare:
+        print_comparison(results, args.compare)
+
+
+def build_parser():
+    p = argparse.ArgumentParser(description="合成全景图拼接基准与精度测试")
+    p.add_argument("--sizes", default="800x600,1600x1200", help="输入图尺寸列表，如 800x600,1600x1200")
+    p.add_argument("--counts", default="2,4,8", help="图像数量列表")
+    p.add_argument("--variations", default=",".join(VARIATIONS), help=f"图像变化: {', '.join(VARIATIONS)}")
+    p.add_argument("--methods", default=",".join(METHODS), help=f"拼接方法: {', '.join(METHODS)}")
+    p.add_argument("--overlap", type=float, default=0.4, help="相邻图像的重叠比例")
+    p.add_argument("--seed", type=int, default=0, help="纹理与变化的随机种子")
+    p.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) - 1), help="stitch_new / fast_blend 的并行数")
+    p.add_argument("--timeout", type=float, default=900, help="单个用例的超时（秒）")
+    p.add_argument("--work_dir", default=None, help="用例目录（输入图、输出图和日志），默认新建临时目录")
+    p.add_argument("--out", default="stitch_benchmark.json", help="结果 JSON")
+    p.add_argument("--compare", default=None, help="与之前的结果 JSON 对比耗时、内存和误差")
+    p.add_argument("--verbose", action="store_true", help="显示拼接过程输出（默认写入用例目录下的日志）")
+    return p
+
+
+if __name__ == "__main__":
+    main(build_parser().parse_args())
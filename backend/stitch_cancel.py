@@ -0,0 +1,112 @@
+"""
+拼接取消
+/stitch 等待拼接结果时轮询客户端连接，断开后在共享取消表中标记该请求；工作进程在流程阶段之间、
+检测器和拼接策略的尝试之间调用 check_cancelled()，发现标记后抛出 StitchCancelledError 协作式中止，尽早释放进程池名额
+"""
+
+import contextvars
+import multiprocessing
+import os
+import uuid
+from typing import Dict, Optional
+
+from stitch_pool import STITCH_START_METHOD, StitchCancelledError
+
+# 等待拼接结果期间检查客户端连接的间隔（秒）
+STITCH_DISCONNECT_POLL_SECONDS = float(os.getenv("STITCH_DISCONNECT_POLL_SECONDS", "0.5"))
+
+
+# ─── 取消检查（工作进程侧） ─────────────────────────────
+
+class CancelToken:
+    """可随任务参数传到工作进程的取消标记，读取主进程创建的共享取消表"""
+
+    def __init__(self, board, request_id: str):
+        self.board = board
+        self.request_id = request_id
+
+    @property
+    def cancelled(self) -> bool:
+        try:
+            return bool(self.board.get(self.request_id, False))
+        except Exception as e:
+            # 取消表不可用时继续拼接
+            print(f"读取取消标记失败: {e}")
+            return False
+
+
+# 当前拼接流程的取消标记，未设置时（异步任务、命令行）检查为空操作
+_cancel_token: contextvars.ContextVar[Optional[CancelToken]] = contextvars.ContextVar(
+    "stitch_cancel_token", default=None
+)
+
+
+def set_cancel_token(token: Optional[CancelToken]):
+    return _cancel_token.set(token)
+
+
+def reset_cancel_token(token):
+    _cancel_token.reset(token)
+
+
+def check_cancelled(stage: str):
+    """请求已取消时抛出 StitchCancelledError（不是 Exception 的子类，各拼接策略的 except Exception 不会吞掉）"""
+    token = _cancel_token.get()
+    if token is not None and token.cancelled:
+        raise StitchCancelledError(stage)
+
+
+# ─── 取消表（主进程侧） ─────────────────────────────────
+
+class CancelRegistry:
+    """共享取消表 request_id -> True 及取消统计（统计只在事件循环线程中修改，无需加锁）"""
+
+    def __init__(self):
+        self._manager = None
+        self._board = None
+        self.disconnects = 0              # 等待期间检测到客户端断开的请求数
+        self.aborted = 0                  # 工作进程协作中止的次数
+        self.finished_after_disconnect = 0  # 中止前已拼接完成（结果仍写入缓存）
+        self.aborted_by_stage: Dict[str, int] = {}
+
+    @property
+    def board(self):
+        if self._board is None:
+            self._manager = multiprocessing.get_context(STITCH_START_METHOD).Manager()
+            self._board = self._manager.dict()
+        return self._board
+
+    def token(self) -> CancelToken:
+        return CancelToken(self.board, uuid.uuid4().hex)
+
+    def cancel(self, token: CancelToken):
+        self.disconnects += 1
+        try:
+            token.board[token.request_id] = True
+        except Exception as e:
+            print(f"写入取消标记失败: {e}")
+
+    def release(self, token: CancelToken):
+        """拼接结束（完成、失败或中止）后移除标记"""
+        try:
+            token.board.pop(token.request_id, None)
+        except Exception:
+            pass
+
+    def record_aborted(self, stage: str):
+        self.aborted += 1
+        self.aborted_by_stage[stage] = self.aborted_by_stage.get(stage, 0) + 1
+
+    def stats(self) -> dict:
+        return {
+            "disconnects": self.disconnects,
+            "aborted": self.aborted,
+            "finished_after_disconnect": self.finished_after_disconnect,
+            "aborted_by_stage": dict(self.aborted_by_stage),
+        }
+
+    def shutdown(self):
+        if self._manager is not None:
+            self._manager.shutdown()
+            self._manager = None
+            self._board = None
@@ -0,0 +1,183 @@
+"""
+异步拼接任务
+POST /stitch/jobs 立即返回任务 id，拼接在进程池中执行；工作进程通过共享的进度表上报阶段和百分比，
+主进程按需同步到任务状态，供轮询、SSE 推送和结果下载使用。任务结果按 TTL 保留在内存中
+"""
+
+import contextvars
+import multiprocessing
+import os
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Optional
+
+STITCH_JOB_TTL_SECONDS = int(os.getenv("STITCH_JOB_TTL_SECONDS", "1800"))
+STITCH_JOB_MAX = max(1, int(os.getenv("STITCH_JOB_MAX", "50")))
+
+# 拼接阶段（按执行顺序）
+STITCH_STAGES = ("queued", "decode", "detect", "match", "warp", "blend", "encode", "done")
+
+
+# ─── 进度上报（工作进程侧） ─────────────────────────────
+
+class ProgressReporter:
+    """可随任务参数传到工作进程的进度上报器，写入主进程创建的共享进度表"""
+
+    def __init__(self, board, job_id: str):
+        self.board = board
+        self.job_id = job_id
+
+    def __call__(self, stage: str, percent: float):
+        self.board[self.job_id] = (stage, float(percent))
+
+
+# 当前拼接流程的进度上报器，未设置时（同步 /stitch 接口）上报为空操作
+_progress_reporter: contextvars.ContextVar[Optional[Callable[[str, float], None]]] = contextvars.ContextVar(
+    "stitch_progress_reporter", default=None
+)
+
+
+def set_progress_reporter(reporter: Optional[Callable[[str, float], None]]):
+    return _progress_reporter.set(reporter)
+
+
+def reset_progress_reporter(token):
+    _progress_reporter.reset(token)
+
+
+def report_progress(stage: str, percent: float):
+    """上报当前阶段和总体百分比（0-100），上报失败不影响拼接本身"""
+    reporter = _progress_reporter.get()
+    if reporter is None:
+        return
+    try:
+        reporter(stage, max(0.0, min(100.0, percent)))
+    except Exception as e:
+        print(f"进度上报失败: {e}")
+
+
+# ─── 任务存储（主进程侧） ───────────────────────────────
+
+@dataclass
+class StitchJob:
+    id: str
+    num_images: int
+    created_at: float = field(default_factory=time.time)
+    state: str = "queued"  # queued / running / done / failed
+    stage: str = "queued"
+    percent: float = 0.0
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    status_code: Optional[int] = None
+    error: Optional[str] = None
+    result: Optional[Any] = None  # 编码后的拼接结果（由接口层定义类型）
+
+    @property
+    def finished(self) -> bool:
+        return self.state in ("done", "failed")
+
+    def to_dict(self) -> dict:
+        end = self.finished_at or time.time()
+        return {
+            "job_id": self.id,
+            "state": self.state,
+            "stage": self.stage,
+            "percent": round(self.percent, 1),
+            "num_images": self.num_images,
+            "elapsed": round(end - self.created_at, 2),
+            "run_time": round(end - self.started_at, 2) if self.started_at else None,
+            "error": self.error,
+        }
+
+
+class JobStore:
+    """内存中的任务表：已结束的任务超过 TTL 后清除，总数超过上限时先清除最早结束的"""
+
+    def __init__(self, ttl_seconds: int = STITCH_JOB_TTL_SECONDS, max_jobs: int = STITCH_JOB_MAX):
+        self.ttl_seconds = ttl_seconds
+        self.max_jobs = max_jobs
+        self._jobs: Dict[str, StitchJob] = {}
+        self._manager = None
+        self._board = None
+
+    @property
+    def board(self):
+        """工作进程写入的共享进度表 job_id -> (stage, percent)，首次使用时创建"""
+        if self._board is None:
+            from stitch_pool import STITCH_START_METHOD
+            self._manager = multiprocessing.get_context(STITCH_START_METHOD).Manager()
+            self._board = self._manager.dict()
+        return self._board
+
+    def create(self, num_images: int) -> StitchJob:
+        self.purge_expired()
+        job = StitchJob(id=uuid.uuid4().hex, num_images=num_images)
+        self._jobs[job.id] = job
+        return job
+
+    def discard(self, job: StitchJob):
+        self._jobs.pop(job.id, None)
+
+    def reporter(self, job: StitchJob) -> ProgressReporter:
+        return ProgressReporter(self.board, job.id)
+
+    def get(self, job_id: str) -> Optional[StitchJob]:
+        self.purge_expired()
+        job = self._jobs.get(job_id)
+        if job is not None:
+            self.sync_progress(job)
+        return job
+
+    def sync_progress(self, job: StitchJob):
+        if job.finished or self._board is None:
+            return
+        try:
+            progress = self._board.get(job.id)
+        except Exception as e:
+            print(f"读取任务进度失败: {e}")
+            return
+        if progress is None:
+            return
+        job.stage, job.percent = progress
+        if job.state == "queued":
+            job.state = "running"
+            job.started_at = time.time()
+
+    def finish(self, job: StitchJob, result: Any):
+        job.result = result
+        job.state = "done"
+        job.stage = "done"
+        job.percent = 100.0
+        self._close(job)
+
+    def fail(self, job: StitchJob, status_code: int, error: str):
+        job.status_code = status_code
+        job.error = error
+        job.state = "failed"
+        self._close(job)
+
+    def _close(self, job: StitchJob):
+        job.finished_at = time.time()
+        if job.started_at is None:
+            job.started_at = job.finished_at
+        if self._board is not None:
+            try:
+                self._board.pop(job.id, None)
+            except Exception:
+                pass
+
+    def purge_expired(self):
+        now = time.time()
+        for job_id in [j.id for j in self._jobs.values() if j.finished and now - j.finished_at > self.ttl_seconds]:
+            del self._jobs[job_id]
+
+        finished = sorted((j for j in self._jobs.values() if j.finished), key=lambda j: j.finished_at)
+        while len(self._jobs) > self.max_jobs and finished:
+            del self._jobs[finished.pop(0).id]
+
+    def shutdown(self):
+        if self._manager is not None:
+            self._manager.shutdown()
+            self._manager = None
+            self._board = None
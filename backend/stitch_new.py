@@ -4,7 +4,7 @@
 stitch_accelerated.py
 
 完整拼接流水线（集成快速并行 tiled 融合 + multiband tile 内优化）：
-- 特征检测 (ORB / 可选 SIFT)
+- 特征检测 (ORB / 可选 SIFT)，多线程并行，结果写入磁盘特征缓存供重跑复用
 - 特征匹配 + Lowe ratio + RANSAC 单应估计
 - SIFT fallback（可选）
 - 构建变换图，自动或手动选择参考图，Dijkstra 合成 H_{i->ref}
@@ -26,6 +26,9 @@ stitch_accelerated.py
 作者: ChatGPT 自动生成（整合你的需求）
 """
 import os
+import contextvars
+import hashlib
+import threading
 import cv2
 import numpy as np
 from glob import glob
@@ -36,6 +39,12 @@ import json
 from math import ceil
 from multiprocessing.dummy import Pool as ThreadPool
 from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+
+from deepzoom import DeepZoomSettings, DeepZoomWriter, aligned_tile_size
+from matching import DescriptorIndex, empty_matches, global_correspondences, keypoint_array, knn_search, match_descriptors
+from stitch_timing import current_timings, reset_timings, span, start_timings
 
 # -------------------------
 # I/O / 加载图片
@@ -69,92 +78,428 @@ def create_detectors(nfeatures_orb=5000, use_sift=False):
             sift = None
     return orb, sift
 
-def detect_and_compute_both(images, orb, sift=None):
+def detect_and_compute_both(images, nfeatures_orb=5000, use_sift=False, work_megapix=0, workers=1,
+                            paths=None, cache_dir=None):
+    # work_megapix > 0 时在缩小的代理图上检测，关键点坐标保持代理分辨率，scales 记录缩放比例
+    # 各图在线程池中并行检测（每个线程一组检测器实例）；cache_dir 与 paths 给定时读写磁盘特征缓存
     N = len(images)
     kps_orb = [None]*N
     des_orb = [None]*N
     kps_sift = [None]*N
     des_sift = [None]*N
-    for idx, img in enumerate(tqdm(images, desc='Detect & Compute')):
-        kp_o, des_o = orb.detectAndCompute(img, None)
-        kps_orb[idx] = kp_o
-        des_orb[idx] = des_o
-        if sift is not None:
-            kp_s, des_s = sift.detectAndCompute(img, None)
-            kps_sift[idx] = kp_s
-            des_sift[idx] = des_s
-    return {'kps_orb': kps_orb, 'des_orb': des_orb, 'kps_sift': kps_sift, 'des_sift': des_sift}
+    scales = [1.0]*N
+    params = {'nfeatures_orb': nfeatures_orb, 'use_sift': bool(use_sift), 'work_megapix': work_megapix}
+    local = threading.local()
+
+    def detect_one(idx):
+        cache_path = feature_cache_path(cache_dir, paths[idx], params) if cache_dir and paths else None
+        if cache_path is not None:
+            cached = load_features(cache_path)
+            if cached is not None:
+                return cached, True
+        if not hasattr(local, 'orb'):
+            local.orb, local.sift = create_detectors(nfeatures_orb=nfeatures_orb, use_sift=use_sift)
+        scale = compute_work_scale(images[idx].shape, work_megapix)
+        with span('preprocess'):
+            work = resize_to_work(images[idx], scale)
+        with span('detect'):
+            kp_o, des_o = local.orb.detectAndCompute(work, None)
+            kp_s = des_s = None
+            if local.sift is not None:
+                kp_s, des_s = local.sift.detectAndCompute(work, None)
+        feats = (kp_o, des_o, kp_s, des_s, scale)
+        if cache_path is not None:
+            save_features(cache_path, *feats)
+        return feats, False
+
+    # 每张图在调用方上下文的副本中运行，检测耗时计入阶段计时
+    ctx = contextvars.copy_context()
+    hits = 0
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        results = executor.map(lambda idx: ctx.copy().run(detect_one, idx), range(N))
+        for idx, (feats, hit) in enumerate(tqdm(results, total=N, desc='Detect & Compute')):
+            kps_orb[idx], des_orb[idx], kps_sift[idx], des_sift[idx], scales[idx] = feats
+            hits += hit
+    if cache_dir and paths:
+        print(f'特征缓存命中 {hits}/{N}（{cache_dir}）')
+    return {'kps_orb': kps_orb, 'des_orb': des_orb, 'kps_sift': kps_sift, 'des_sift': des_sift, 'scales': scales}
 
 # -------------------------
-# 匹配 + Lowe ratio
+# 磁盘特征缓存：每张图一个 .npz（关键点属性 + 描述子），文件名由路径、大小、mtime 和检测参数哈希得到，
+# 只改融合参数重跑同一目录时跳过检测
 # -------------------------
-def match_knn(desc1, desc2, use_sift=False):
-    if desc1 is None or desc2 is None:
-        return []
-    if not use_sift:
-        bf = cv2.BFMatcher(cv2.NORM_HAMMING)
-        matches = bf.knnMatch(desc1, desc2, k=2)
-    else:
-        FLANN_INDEX_KDTREE = 1
-        index_params = dict(algorithm=FLANN_INDEX_KDTREE, trees=5)
-        search_params = dict(checks=50)
-        flann = cv2.FlannBasedMatcher(index_params, search_params)
-        if desc1.dtype != np.float32:
-            desc1 = desc1.astype(np.float32)
-        if desc2.dtype != np.float32:
-            desc2 = desc2.astype(np.float32)
-        matches = flann.knnMatch(desc1, desc2, k=2)
-    return matches
-
-def lowe_ratio_filter(knn_matches, ratio=0.75):
-    good = []
-    for m_n in knn_matches:
-        if len(m_n) < 2:
+FEATURE_CACHE_VERSION = 1
+
+def feature_cache_path(cache_dir, path, params):
+    st = os.stat(path)
+    key = json.dumps({'path': os.path.abspath(path), 'size': st.st_size, 'mtime_ns': st.st_mtime_ns,
+                      'params': params, 'version': FEATURE_CACHE_VERSION, 'opencv': cv2.__version__},
+                     sort_keys=True)
+    digest = hashlib.blake2b(key.encode('utf-8'), digest_size=12).hexdigest()
+    return os.path.join(cache_dir, f'{os.path.splitext(os.path.basename(path))[0]}-{digest}.npz')
+
+def pack_keypoints(kps):
+    # (n, 5) float32: x, y, size, angle, response；octave 按位打包了层号，单独存 int32
+    if not kps:
+        return np.empty((0, 5), dtype=np.float32), np.empty(0, dtype=np.int32)
+    attrs = np.array([(k.pt[0], k.pt[1], k.size, k.angle, k.response) for k in kps], dtype=np.float32)
+    octaves = np.array([k.octave for k in kps], dtype=np.int32)
+    return attrs, octaves
+
+def unpack_keypoints(attrs, octaves):
+    return tuple(cv2.KeyPoint(float(x), float(y), float(size), float(angle), float(response), int(octave))
+                 for (x, y, size, angle, response), octave in zip(attrs.tolist(), octaves.tolist()))
+
+def save_features(cache_path, kp_o, des_o, kp_s, des_s, scale):
+    arrays = {'scale': np.float64(scale), 'has_sift': np.bool_(kp_s is not None)}
+    for name, kps, des in (('orb', kp_o, des_o), ('sift', kp_s, des_s)):
+        arrays[f'{name}_kp'], arrays[f'{name}_octave'] = pack_keypoints(kps)
+        arrays[f'{name}_has_des'] = np.bool_(des is not None)
+        if des is not None:
+            arrays[f'{name}_des'] = des
+    try:
+        os.makedirs(os.path.dirname(cache_path) or '.', exist_ok=True)
+        tmp_path = f'{cache_path[:-4]}.{os.getpid()}.{threading.get_ident()}.tmp.npz'
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f'写入特征缓存失败: {e}')
+
+def load_features(cache_path):
+    # 返回 (kp_orb, des_orb, kp_sift, des_sift, scale)；文件不存在或损坏时返回 None
+    try:
+        with np.load(cache_path) as data:
+            feats = []
+            for name in ('orb', 'sift'):
+                if name == 'sift' and not bool(data['has_sift']):
+                    feats += [None, None]
+                    continue
+                feats.append(unpack_keypoints(data[f'{name}_kp'], data[f'{name}_octave']))
+                feats.append(data[f'{name}_des'] if bool(data[f'{name}_has_des']) else None)
+            return (*feats, float(data['scale']))
+    except (OSError, KeyError, ValueError):
+        return None
+
+# -------------------------
+# 配准分辨率：在缩小的代理图上检测/匹配，再把 H 换算回原分辨率
+# -------------------------
+def compute_work_scale(shape, work_megapix):
+    # 返回 <=1 的缩放比例，使代理图约为 work_megapix 百万像素；<=0 表示原分辨率
+    if work_megapix is None or work_megapix <= 0:
+        return 1.0
+    h, w = shape[:2]
+    return min(1.0, float(np.sqrt(work_megapix * 1e6 / float(h * w))))
+
+def resize_to_work(img, scale):
+    if scale >= 1.0:
+        return img
+    size = (max(1, int(round(img.shape[1]*scale))), max(1, int(round(img.shape[0]*scale))))
+    return cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+
+def lift_homography(H, src_scale, dst_scale):
+    # H 把 src 代理坐标映射到 dst 代理坐标；H_full = S_dst^-1 * H * S_src
+    S_src = np.diag([src_scale, src_scale, 1.0])
+    S_dst_inv = np.diag([1.0/dst_scale, 1.0/dst_scale, 1.0])
+    H_full = S_dst_inv.dot(H).dot(S_src)
+    return H_full / H_full[2,2]
+
+def _gray_patch(img, y0, y1, x0, x1):
+    patch = img[y0:y1, x0:x1]
+    return cv2.cvtColor(patch, cv2.COLOR_BGR2GRAY) if patch.ndim == 3 else patch
+
+def refine_homography_full_res(H, src_pts, src_img, dst_img, max_points=60,
+                               patch_radius=12, search_radius=6, min_score=0.8):
+    # 取少量原分辨率内点：在 dst 原图中 H 预测位置附近做模板匹配，用校正后的对应点重估 H
+    # 只在小窗口内取灰度，不做整图灰度转换；校正点不足时返回原 H
+    pts = np.asarray(src_pts, dtype=np.float32).reshape(-1, 2)
+    if len(pts) < 8:
+        return H
+    if len(pts) > max_points:
+        pts = pts[np.linspace(0, len(pts)-1, max_points).astype(int)]
+    proj = cv2.perspectiveTransform(pts.reshape(-1,1,2), H).reshape(-1,2)
+    r = patch_radius; s = search_radius
+    sh, sw = src_img.shape[:2]; dh, dw = dst_img.shape[:2]
+    src_ok = []; dst_ok = []
+    for (x, y), (u, v) in zip(pts, proj):
+        xi, yi, ui, vi = int(round(x)), int(round(y)), int(round(u)), int(round(v))
+        if xi-r < 0 or yi-r < 0 or xi+r >= sw or yi+r >= sh:
+            continue
+        if ui-r-s < 0 or vi-r-s < 0 or ui+r+s >= dw or vi+r+s >= dh:
+            continue
+        patch = _gray_patch(src_img, yi-r, yi+r+1, xi-r, xi+r+1)
+        if patch.std() < 2.0:
             continue
-        m, n = m_n
-        if m.distance < ratio * n.distance:
-            good.append(m)
-    return good
+        window = _gray_patch(dst_img, vi-r-s, vi+r+s+1, ui-r-s, ui+r+s+1)
+        res = cv2.matchTemplate(window, patch, cv2.TM_CCOEFF_NORMED)
+        _, score, _, loc = cv2.minMaxLoc(res)
+        if score < min_score:
+            continue
+        src_ok.append((xi, yi)); dst_ok.append((ui - s + loc[0], vi - s + loc[1]))
+    if len(src_ok) < 8:
+        return H
+    H_ref, mask = cv2.findHomography(np.float32(src_ok), np.float32(dst_ok), cv2.RANSAC, 1.5)
+    if H_ref is None or mask is None or int(mask.sum()) < 8:
+        return H
+    return H_ref
+
+# -------------------------
+# 候选图像对预筛选：已算好的描述子做词袋（TF-IDF）全局签名，每张图只保留最相似的 top_k 个邻居
+# -------------------------
+def assign_words(des, vocab):
+    # 最近视觉词：二进制描述子（ORB/AKAZE/BRISK）用汉明距离，浮点描述子（SIFT）用 L2，均为暴力匹配
+    indices, _ = knn_search(des, vocab, k=1, exact=True)
+    return indices[:, 0]
+
+def bow_signatures(des_list, vocab_size=2048, seed=0):
+    """返回 (N, vocab_size) 的 L2 归一化 TF-IDF 签名；描述子不足时返回 None
+
+    视觉词直接从所有图像的描述子中随机抽取，不做 k-means：
+    只需区分"有没有拍到同一处内容"，大词表 + 真实描述子作为词中心已足够，且只需一次最近邻分配
+    """
+    valid = [d for d in des_list if d is not None and len(d) > 0]
+    if len(valid) < 2:
+        return None
+    pool = np.vstack(valid)
+    if len(pool) < vocab_size:
+        return None
+    rng = np.random.default_rng(seed)
+    vocab = pool[rng.choice(len(pool), vocab_size, replace=False)]
+
+    hist = np.zeros((len(des_list), vocab_size), dtype=np.float32)
+    for i, d in enumerate(des_list):
+        if d is not None and len(d) > 0:
+            hist[i] = np.bincount(assign_words(d, vocab), minlength=vocab_size)
+    tf = hist / np.maximum(hist.sum(axis=1, keepdims=True), 1.0)
+    # 所有图像都出现的词 idf 为 0，不参与相似度
+    idf = np.log(len(des_list) / np.maximum((hist > 0).sum(axis=0), 1))
+    sig = tf * idf[None, :]
+    return sig / (np.linalg.norm(sig, axis=1, keepdims=True) + 1e-12)
+
+def select_candidate_pairs(des_list, top_k=8, vocab_size=2048):
+    """返回需要完整匹配的图像对 [(i, j), ...]（i < j）
+
+    每张图取签名余弦相似度最高的 top_k 个邻居（任一方向入选即保留），
+    图像数不超过 top_k + 1、top_k <= 0 或签名不可用时返回全部图像对
+    """
+    N = len(des_list)
+    all_pairs = [(i, j) for i in range(N) for j in range(i+1, N)]
+    if top_k <= 0 or N <= top_k + 1:
+        return all_pairs
+    sig = bow_signatures(des_list, vocab_size=vocab_size)
+    if sig is None:
+        return all_pairs
+    sim = sig.dot(sig.T)
+    np.fill_diagonal(sim, -np.inf)
+    neighbours = np.argsort(-sim, axis=1)[:, :top_k]
+    pairs = set()
+    for i in range(N):
+        for j in neighbours[i]:
+            pairs.add((min(i, int(j)), max(i, int(j))))
+    return sorted(pairs)
+
+def window_pairs(N, window, loop_closure=True):
+    """顺序拍摄（连拍扫视、扫描条带、滚动截图）：图 i 只与 i+1..i+window 匹配，
+    loop_closure 时额外匹配首尾两张，由 verify_loop_closure 检查是否与链式结果一致"""
+    pairs = [(i, j) for i in range(N) for j in range(i+1, min(N, i+window+1))]
+    if loop_closure and N > window + 1:
+        pairs.append((0, N-1))
+    return pairs
+
+def verify_loop_closure(edges, N, shape, max_drift_ratio=0.05):
+    """比较首尾直接配准的 H 与沿序列链式合成的 H，返回图 0 角点的平均偏差（像素）
+
+    偏差超过图像对角线的 max_drift_ratio 时认为首尾匹配是误匹配，从 edges 中删除；
+    首尾未直接配准或序列本身不连通时返回 None
+    """
+    direct = edges.get((0, N-1))
+    if direct is None or N < 3:
+        return None
+    chain_edges = {k: v for k, v in edges.items() if k not in ((0, N-1), (N-1, 0))}
+    H_to_last, _, _ = dijkstra_paths(chain_edges, N, N-1)
+    if 0 not in H_to_last:
+        return None
+    drift = float(np.linalg.norm(warp_corners(shape, direct['H']) - warp_corners(shape, H_to_last[0]), axis=1).mean())
+    h, w = shape[:2]
+    if drift > max_drift_ratio * np.hypot(w, h):
+        edges.pop((0, N-1), None)
+        edges.pop((N-1, 0), None)
+    return drift
 
 # -------------------------
 # pairwise H（先 ORB，失败时可选 SIFT）
 # -------------------------
+# compute_pairwise_homographies 中 ORB 匹配不足、待尝试 SIFT 的图像对
+SIFT_FALLBACK = object()
+
+def ordered_map(executor, fn, items, max_pending):
+    # 按输入顺序逐个产出 fn(item)，在途任务最多 max_pending 个（消费慢时不再继续提交）
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
 def compute_pairwise_homographies(kps_orb, des_orb, kps_sift, des_sift,
                                   use_sift_fallback=False,
-                                  ratio=0.75, ransac_thresh=5.0, min_inliers=20):
+                                  ratio=0.75, ransac_thresh=5.0, min_inliers=20,
+                                  scales=None, images=None, refine_full_res=True, pairs=None,
+                                  correspondences=None, workers=1):
+    # scales 不为空时关键点位于代理分辨率：RANSAC 在代理坐标上做，得到的 H 换算回原分辨率
+    # refine_full_res 需要 images（原图），用少量原分辨率内点微调 H
+    # pairs 为空时匹配全部图像对，否则只匹配给定的 (i, j)
+    # correspondences 为全局索引得到的 ORB 匹配 {(i, j): Matches}，给定时直接使用，不再逐对匹配 ORB
+    # workers > 1 时各图像对在线程池中并行匹配和 RANSAC，结果按 pairs 顺序收集
     N = len(kps_orb)
-    edges = {}
-    for i in tqdm(range(N), desc='Pairwise H outer'):
-        for j in range(i+1, N):
-            knn = match_knn(des_orb[i], des_orb[j], use_sift=False)
-            good = lowe_ratio_filter(knn, ratio=ratio)
-            method = 'ORB'
-            if len(good) < min_inliers and use_sift_fallback and (des_sift[i] is not None and des_sift[j] is not None):
-                knn2 = match_knn(des_sift[i], des_sift[j], use_sift=True)
-                good2 = lowe_ratio_filter(knn2, ratio=ratio)
-                if len(good2) >= min_inliers:
-                    good = good2
-                    method = 'SIFT'
-            if len(good) < min_inliers:
-                continue
-            if method == 'ORB':
-                src_pts = np.float32([kps_orb[i][m.queryIdx].pt for m in good]).reshape(-1,1,2)
-                dst_pts = np.float32([kps_orb[j][m.trainIdx].pt for m in good]).reshape(-1,1,2)
-            else:
-                src_pts = np.float32([kps_sift[i][m.queryIdx].pt for m in good]).reshape(-1,1,2)
-                dst_pts = np.float32([kps_sift[j][m.trainIdx].pt for m in good]).reshape(-1,1,2)
+    if pairs is None:
+        pairs = sorted(correspondences) if correspondences is not None else [(i, j) for i in range(N) for j in range(i+1, N)]
+    pts_orb = [keypoint_array(k) for k in kps_orb]
+    pts_sift = [keypoint_array(k) for k in kps_sift]
+
+    # 每张图的描述子索引（ORB: LSH，SIFT: KD 树）作为被查询方时复用。FLANN 建索引使用进程全局的 rand()，
+    # 在主线程按固定顺序预先构建，结果才与线程数无关
+    def build_indexes(des, targets):
+        return {j: DescriptorIndex(des[j]) if des[j] is not None and len(des[j]) >= 2 else None
+                for j in sorted(set(targets))}
+
+    def estimate_edge(i, j, good, method):
+        if method == 'ORB':
+            src_pts, dst_pts = good.points(pts_orb[i], pts_orb[j])
+        else:
+            src_pts, dst_pts = good.points(pts_sift[i], pts_sift[j])
+        with span('ransac'):
             H, mask = cv2.findHomography(src_pts, dst_pts, cv2.RANSAC, ransac_thresh)
-            if H is None or mask is None:
-                continue
-            inliers = int(mask.sum())
-            if inliers < min_inliers:
-                continue
-            edges[(i,j)] = {'H': H, 'inliers': inliers, 'matches': good, 'mask': mask, 'method': method}
-            try:
-                Hinv = np.linalg.inv(H)
-                edges[(j,i)] = {'H': Hinv, 'inliers': inliers, 'matches': good, 'mask': mask, 'method': method}
-            except np.linalg.LinAlgError:
-                pass
+        if H is None or mask is None:
+            return None
+        inliers = int(mask.sum())
+        if inliers < min_inliers:
+            return None
+        scale_i, scale_j = (scales[i], scales[j]) if scales is not None else (1.0, 1.0)
+        inlier_src, inlier_dst = inlier_points(src_pts, dst_pts, mask, scale_i, scale_j)
+        if scale_i != 1.0 or scale_j != 1.0:
+            H = lift_homography(H, scale_i, scale_j)
+            if refine_full_res and images is not None:
+                H = refine_homography_full_res(H, inlier_src, images[i], images[j],
+                                               search_radius=int(ceil(2.0/scale_j)) + 2)
+        return make_edge(H, inlier_src, inlier_dst, method)
+
+    orb_indexes = build_indexes(des_orb, [j for _, j in pairs]) if correspondences is None else {}
+
+    def orb_pair(pair):
+        i, j = pair
+        if correspondences is not None:
+            good = correspondences.get((i, j), empty_matches())
+        else:
+            good = match_descriptors(des_orb[i], des_orb[j], ratio=ratio, index=orb_indexes[j])
+        if len(good) >= min_inliers:
+            return estimate_edge(i, j, good, 'ORB')
+        if use_sift_fallback and des_sift[i] is not None and des_sift[j] is not None:
+            return SIFT_FALLBACK
+        return None
+
+    def sift_pair(pair):
+        i, j = pair
+        good = match_descriptors(des_sift[i], des_sift[j], ratio=ratio, index=sift_indexes[j])
+        return estimate_edge(i, j, good, 'SIFT') if len(good) >= min_inliers else None
+
+    # 每对在调用方上下文的副本中运行，匹配和 RANSAC 耗时计入阶段计时
+    ctx = contextvars.copy_context()
+    workers = max(1, workers)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(tqdm(ordered_map(executor, lambda pair: ctx.copy().run(orb_pair, pair), pairs, workers * 4),
+                            total=len(pairs), desc='Pairwise H'))
+        # ORB 匹配不足的图像对逐对尝试 SIFT
+        fallback = [k for k, r in enumerate(results) if r is SIFT_FALLBACK]
+        if fallback:
+            sift_indexes = build_indexes(des_sift, [pairs[k][1] for k in fallback])
+            sift_results = ordered_map(executor, lambda k: ctx.copy().run(sift_pair, pairs[k]), fallback, workers * 4)
+            for k, result in zip(fallback, tqdm(sift_results, total=len(fallback), desc='SIFT fallback')):
+                results[k] = result
+
+    edges = {}
+    for (i, j), edge in zip(pairs, results):
+        if edge is not None:
+            add_edge(edges, i, j, edge)
+    return edges
+
+# -------------------------
+# 紧凑匹配边与可恢复的匹配图
+# -------------------------
+MATCH_GRAPH_VERSION = 1
+
+def inlier_points(src_pts, dst_pts, mask, src_scale=1.0, dst_scale=1.0):
+    # RANSAC 内点坐标换算到原分辨率，返回两个 (k, 2) float32 数组
+    keep = mask.ravel() > 0
+    return src_pts.reshape(-1, 2)[keep] / src_scale, dst_pts.reshape(-1, 2)[keep] / dst_scale
+
+def make_edge(H, inlier_src, inlier_dst, method):
+    # 匹配边只保留 H、内点数、方法和原分辨率内点坐标，不保留全部匹配与 RANSAC 掩码
+    inlier_src = np.ascontiguousarray(inlier_src, dtype=np.float32).reshape(-1, 2)
+    inlier_dst = np.ascontiguousarray(inlier_dst, dtype=np.float32).reshape(-1, 2)
+    return {'H': H, 'inliers': len(inlier_src), 'method': method, 'src_pts': inlier_src, 'dst_pts': inlier_dst}
+
+def add_edge(edges, i, j, edge):
+    # 同时加入反向边：H 取逆，内点坐标与正向边共用数组（两侧互换）
+    edges[(i,j)] = edge
+    try:
+        Hinv = np.linalg.inv(edge['H'])
+    except np.linalg.LinAlgError:
+        return
+    edges[(j,i)] = {**edge, 'H': Hinv, 'src_pts': edge['dst_pts'], 'dst_pts': edge['src_pts']}
+
+def file_signatures(filenames):
+    stats = [os.stat(f) for f in filenames]
+    return np.array([st.st_size for st in stats], dtype=np.int64), np.array([st.st_mtime_ns for st in stats], dtype=np.int64)
+
+def save_match_graph(path, edges, filenames, params):
+    # 只写每对图像的一个方向（反向边加载时由 add_edge 重建），内点坐标拼接成两个大数组，按 offsets 切分
+    forward = [k for k in edges if k[0] < k[1] or (k[1], k[0]) not in edges]
+    sizes, mtimes = file_signatures(filenames)
+    arrays = {
+        'version': np.int32(MATCH_GRAPH_VERSION),
+        'files': np.array([os.path.abspath(f) for f in filenames]),
+        'file_sizes': sizes,
+        'file_mtimes': mtimes,
+        'params': np.array(json.dumps(params, sort_keys=True)),
+        'pairs': np.array(forward, dtype=np.int32).reshape(-1, 2),
+        'H': np.array([edges[k]['H'] for k in forward], dtype=np.float64).reshape(-1, 3, 3),
+        'inliers': np.array([edges[k]['inliers'] for k in forward], dtype=np.int32),
+        'methods': np.array([edges[k]['method'] for k in forward]).astype('U8'),
+        'offsets': np.cumsum([0] + [len(edges[k]['src_pts']) for k in forward]).astype(np.int64),
+        'src_pts': np.concatenate([edges[k]['src_pts'] for k in forward] or [np.empty((0, 2), np.float32)]),
+        'dst_pts': np.concatenate([edges[k]['dst_pts'] for k in forward] or [np.empty((0, 2), np.float32)]),
+    }
+    tmp_path = f'{os.path.splitext(path)[0]}.{os.getpid()}.tmp.npz'
+    np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, path)
+    print(f'匹配图已写入 {path}（{len(forward)} 对）')
+
+def load_match_graph(path, filenames, params):
+    # 版本、输入文件（路径、大小、mtime）和匹配参数都一致时返回 edges，否则返回 None
+    try:
+        data = np.load(path)
+    except (OSError, ValueError):
+        return None
+    with data:
+        if int(data['version']) != MATCH_GRAPH_VERSION:
+            print(f'匹配图 {path} 版本不同，重新匹配')
+            return None
+        sizes, mtimes = file_signatures(filenames)
+        if (data['files'].tolist() != [os.path.abspath(f) for f in filenames]
+                or not np.array_equal(data['file_sizes'], sizes) or not np.array_equal(data['file_mtimes'], mtimes)):
+            print(f'输入图片与匹配图 {path} 不一致，重新匹配')
+            return None
+        if json.loads(str(data['params'])) != json.loads(json.dumps(params, sort_keys=True)):
+            print(f'匹配参数与匹配图 {path} 不一致，重新匹配')
+            return None
+        offsets = data['offsets']; src_all = data['src_pts']; dst_all = data['dst_pts']
+        edges = {}
+        for k, (i, j) in enumerate(data['pairs'].tolist()):
+            a, b = offsets[k], offsets[k+1]
+            edge = make_edge(data['H'][k], src_all[a:b], dst_all[a:b], str(data['methods'][k]))
+            edge['inliers'] = int(data['inliers'][k])
+            add_edge(edges, i, j, edge)
     return edges
 
 # -------------------------
@@ -375,7 +720,7 @@ def reconstruct_from_laplacian(lp):
 
 # process single tile (function for threads)
 def process_tile_worker(tile, images_dict, M_final, image_bboxes, canvas_size,
-                        blend_method='distance', pyr_levels=3, max_images_per_tile=6):
+                        blend_method='distance', pyr_levels=3, max_images_per_tile=6, fill_value=255):
     tx,ty,x0,y0,x1,y1 = tile
     w_tile = x1 - x0; h_tile = y1 - y0
     tile_bbox = (x0,y0,x1,y1)
@@ -391,7 +736,7 @@ def process_tile_worker(tile, images_dict, M_final, image_bboxes, canvas_size,
             if area>0:
                 candidates.append((idx, area))
     if len(candidates) == 0:
-        return (tx,ty, np.ones((h_tile, w_tile, 3), dtype=np.uint8)*255)
+        return (tx,ty, np.full((h_tile, w_tile, 3), fill_value, dtype=np.uint8))
     # sort by overlap area desc
     candidates.sort(key=lambda x: x[1], reverse=True)
     # limit number of images per tile (important for multiband)
@@ -402,13 +747,14 @@ def process_tile_worker(tile, images_dict, M_final, image_bboxes, canvas_size,
     for idx, area in candidates:
         img = images_dict[idx]
         M = M_final[idx]
-        warped, warped_mask = warp_patch_for_tile(img, M, tile_bbox)
+        with span('warp'):
+            warped, warped_mask = warp_patch_for_tile(img, M, tile_bbox)
         if warped_mask.sum() == 0:
             continue
         warped_imgs.append(warped.astype(np.float32))
         warped_masks.append(warped_mask)
     if len(warped_imgs) == 0:
-        return (tx,ty, np.ones((h_tile, w_tile, 3), dtype=np.uint8)*255)
+        return (tx,ty, np.full((h_tile, w_tile, 3), fill_value, dtype=np.uint8))
     if blend_method == 'distance' or len(warped_imgs) == 1:
         num = np.zeros((h_tile,w_tile,3), dtype=np.float32)
         den = np.zeros((h_tile,w_tile,1), dtype=np.float32)
@@ -421,7 +767,7 @@ def process_tile_worker(tile, images_dict, M_final, image_bboxes, canvas_size,
         den_safe = den.copy(); den_safe[den_safe==0] = 1.0
         sub_res = (num / den_safe).astype(np.uint8)
         empty = (den[:,:,0]==0)
-        sub_res[empty] = 255
+        sub_res[empty] = fill_value
         return (tx,ty, sub_res)
     else:
         # multiband: adapt pyramid levels by number of images
@@ -433,17 +779,25 @@ def process_tile_worker(tile, images_dict, M_final, image_bboxes, canvas_size,
         return (tx,ty, tile_res)
 
 # assemble canvas from tile results
-def assemble_tiles_to_canvas(tile_results, canvas_w, canvas_h, tile_size):
-    out = np.ones((canvas_h, canvas_w, 3), dtype=np.uint8)*255
-    for tx,ty,patch in tile_results:
-        x0 = tx * tile_size; y0 = ty * tile_size
-        h_tile, w_tile = patch.shape[:2]
-        out[y0:y0+h_tile, x0:x0+w_tile] = patch
+def place_tile(out, tile_result, tile_size):
+    tx,ty,patch = tile_result
+    x0 = tx * tile_size; y0 = ty * tile_size
+    h_tile, w_tile = patch.shape[:2]
+    out[y0:y0+h_tile, x0:x0+w_tile] = patch
+
+def assemble_tiles_to_canvas(tile_results, canvas_w, canvas_h, tile_size, fill_value=255):
+    out = np.full((canvas_h, canvas_w, 3), fill_value, dtype=np.uint8)
+    for res in tile_results:
+        place_tile(out, res, tile_size)
     return out
 
 # top-level tiled blending orchestrator (uses thread pool)
-def tiled_blend_parallel(images, M_final, canvas_size, out_path, tile_size=2048, workers=8,
-                         blend_method='distance', pyr_levels=3, max_images_per_tile=6):
+def tiled_blend_parallel(images, M_final, canvas_size, out_path=None, tile_size=2048, workers=8,
+                         blend_method='distance', pyr_levels=3, max_images_per_tile=6, fill_value=255,
+                         progress=None, tile_sink=None):
+    # progress: 可选回调 progress(完成块数, 总块数)，用于向调用方上报融合进度
+    # tile_sink: 可选回调 tile_sink(x0, y0, patch)，在工作线程中接收每块融合结果（如 deepzoom.DeepZoomWriter.write_region），
+    #            此时不分配输出画布，返回 None
     canvas_w, canvas_h = canvas_size
     # precompute image bboxes in canvas coords
     image_bboxes = {}
@@ -473,19 +827,40 @@ def tiled_blend_parallel(images, M_final, canvas_size, out_path, tile_size=2048,
     worker = partial(process_tile_worker,
                      images_dict=images, M_final=M_final, image_bboxes=image_bboxes,
                      canvas_size=(canvas_w, canvas_h),
-                     blend_method=blend_method, pyr_levels=pyr_levels, max_images_per_tile=max_images_per_tile)
+                     blend_method=blend_method, pyr_levels=pyr_levels, max_images_per_tile=max_images_per_tile,
+                     fill_value=fill_value)
+    # 每块在调用方上下文的副本中运行，块内 warp 计入调用方的阶段计时（各线程累加）
+    ctx = contextvars.copy_context()
+
+    def blend_tile(tile):
+        res = worker(tile)
+        if tile_sink is None:
+            return res
+        tx, ty, patch = res
+        tile_sink(tx * tile_size, ty * tile_size, patch)
+        return None
+
+    run_tile = lambda tile: ctx.copy().run(blend_tile, tile)
     # use ThreadPool to avoid heavy image pickling overhead
     workers = max(1, workers)
     pool = ThreadPool(workers)
-    results = []
+    # 每块完成后直接写入画布，不再保留全部分块结果（峰值内存约为一张画布 + 每线程一块）
+    out = np.full((canvas_h, canvas_w, 3), fill_value, dtype=np.uint8) if tile_sink is None else None
+    done = 0
     try:
-        for res in tqdm(pool.imap_unordered(worker, tiles), total=len(tiles), desc='Blending tiles'):
-            results.append(res)
+        with span('blend'):
+            for res in tqdm(pool.imap_unordered(run_tile, tiles), total=len(tiles), desc='Blending tiles'):
+                if res is not None:
+                    place_tile(out, res, tile_size)
+                done += 1
+                if progress is not None:
+                    progress(done, len(tiles))
     finally:
         pool.close(); pool.join()
-    # assemble
-    out = assemble_tiles_to_canvas(results, canvas_w, canvas_h, tile_size)
-    cv2.imencode('.png', out)[1].tofile(out_path)
+    # out_path 为空时只返回画布（供 app.py 在内存中继续编码）
+    if out_path and out is not None:
+        with span('encode'):
+            cv2.imencode('.png', out)[1].tofile(out_path)
     return out
 
 # -------------------------
@@ -500,18 +875,14 @@ def save_homographies(H_to_ref, filenames, out_npz):
     print(f'保存 {len(keys)} 个 H 到 {out_npz}')
 
 # optional match drawing for diagnostics
-def draw_and_save_matches(img1, img2, kps1, kps2, matches, mask, out_file, max_draw=80):
-    inliers = []
-    if mask is not None:
-        mask1d = mask.ravel().tolist()
-        for idx, m in enumerate(matches):
-            if idx < len(mask1d) and mask1d[idx]:
-                inliers.append(m)
-    else:
-        inliers = matches
-    sel = inliers[:max_draw]
-    if len(sel) == 0:
+def draw_and_save_matches(img1, img2, src_pts, dst_pts, out_file, max_draw=80, scale1=1.0, scale2=1.0):
+    # src_pts / dst_pts 为匹配边中的原分辨率内点坐标，img1 / img2 为按 scale 缩小的代理图
+    n = min(len(src_pts), max_draw)
+    if n == 0:
         return
+    kps1 = [cv2.KeyPoint(x, y, 1.0) for x, y in (src_pts[:n] * scale1).tolist()]
+    kps2 = [cv2.KeyPoint(x, y, 1.0) for x, y in (dst_pts[:n] * scale2).tolist()]
+    sel = [cv2.DMatch(k, k, 0.0) for k in range(n)]
     vis = cv2.drawMatches(img1, kps1, img2, kps2, sel, None, flags=cv2.DrawMatchesFlags_NOT_DRAW_SINGLE_POINTS)
     dirname = os.path.dirname(out_file)
     if dirname and not os.path.exists(dirname):
@@ -522,19 +893,82 @@ def draw_and_save_matches(img1, img2, kps1, kps2, matches, mask, out_file, max_d
 # 主流程
 # -------------------------
 def main(args):
-    images_list, filenames = load_images(args.input_dir)
-    N = len(images_list)
-    print(f'加载 {N} 张图片')
+    timings_token = start_timings() if args.profile else None
+    try:
+        run_pipeline(args)
+    finally:
+        if timings_token is not None:
+            report = current_timings().summary()
+            reset_timings(timings_token)
+            with open(args.profile, 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+            print('阶段耗时已写入', args.profile)
+            for name, stage in report['stages'].items():
+                print(f"  {name:<10} {stage['wall_ms']:>10.1f} ms  cpu {stage['cpu_ms']:>10.1f} ms  x{stage['count']}")
 
-    orb, sift = create_detectors(nfeatures_orb=args.nfeatures, use_sift=args.use_sift)
-    descs = detect_and_compute_both(images_list, orb, sift)
+def match_graph_params(args):
+    # 影响匹配图的参数（线程数、缓存位置等不影响结果，不计入）；原分辨率配准时微调不起作用
+    return {'nfeatures': args.nfeatures, 'use_sift': args.use_sift, 'sift_fallback': args.sift_fallback,
+            'ratio': args.ratio, 'ransac_thresh': args.ransac_thresh, 'min_matches': args.min_matches,
+            'work_megapix': args.work_megapix, 'refine_full_res': bool(args.refine_full_res and args.work_megapix > 0),
+            'pair_top_k': args.pair_top_k, 'match_window': args.match_window, 'global_index': args.global_index}
+
+def build_match_graph(args, images_list, filenames):
+    # 特征检测 + 候选图像对 + 两两单应；特征只在此函数内使用，返回后即释放，之后只保留紧凑的匹配边
+    N = len(images_list)
+    descs = detect_and_compute_both(images_list, nfeatures_orb=args.nfeatures, use_sift=args.use_sift,
+                                    work_megapix=args.work_megapix, workers=args.detect_workers or args.workers,
+                                    paths=filenames, cache_dir=args.feature_cache)
     kps_orb = descs['kps_orb']; des_orb = descs['des_orb']
     kps_sift = descs['kps_sift']; des_sift = descs['des_sift']
+    scales = descs['scales']
+    if args.work_megapix > 0:
+        print(f'配准分辨率 {args.work_megapix} MP，缩放比例 {min(scales):.3f}~{max(scales):.3f}')
+
+    correspondences = None
+    if args.match_window > 0:
+        pairs = window_pairs(N, args.match_window)
+        print(f'顺序匹配 {len(pairs)}/{N*(N-1)//2} 对（窗口 {args.match_window}，含首尾闭环检查）')
+    elif args.global_index:
+        correspondences = global_correspondences(des_orb, ratio=args.ratio, min_matches=args.min_matches)
+        pairs = sorted(correspondences)
+        print(f'全局描述子索引: {N} 次查询得到 {len(pairs)}/{N*(N-1)//2} 对候选图像')
+    else:
+        pairs = select_candidate_pairs(des_orb, top_k=args.pair_top_k)
+        print(f'候选图像对 {len(pairs)}/{N*(N-1)//2}（每张图 top_k={args.pair_top_k} 个相似邻居）')
 
     print('计算两两单应（先 ORB，必要时尝试 SIFT）...')
     edges = compute_pairwise_homographies(kps_orb, des_orb, kps_sift, des_sift,
                                          use_sift_fallback=args.sift_fallback,
-                                         ratio=args.ratio, ransac_thresh=args.ransac_thresh, min_inliers=args.min_matches)
+                                         ratio=args.ratio, ransac_thresh=args.ransac_thresh, min_inliers=args.min_matches,
+                                         scales=scales, images=images_list, refine_full_res=args.refine_full_res,
+                                         pairs=pairs, correspondences=correspondences,
+                                         workers=args.match_workers or args.workers)
+    if args.match_window > 0:
+        drift = verify_loop_closure(edges, N, images_list[0].shape)
+        if drift is not None:
+            closed = (0, N-1) in edges
+            print(f'首尾闭环偏差 {drift:.1f}px，{"保留首尾连接" if closed else "偏差过大，丢弃首尾匹配"}')
+    return edges
+
+def run_pipeline(args):
+    with span('decode'):
+        images_list, filenames = load_images(args.input_dir)
+    N = len(images_list)
+    print(f'加载 {N} 张图片')
+
+    # 匹配图（两两单应与内点）按需写入 npz，--resume 时参数和输入未变则直接读取，跳过检测与匹配
+    graph_path = args.graph_out or os.path.splitext(args.out)[0] + '_graph.npz'
+    graph_params = match_graph_params(args)
+    edges = load_match_graph(graph_path, filenames, graph_params) if args.resume else None
+    if edges is not None:
+        print(f'从 {graph_path} 恢复匹配图，跳过特征检测与匹配')
+    else:
+        if args.resume and not os.path.exists(graph_path):
+            print(f'没有找到匹配图 {graph_path}，重新检测与匹配')
+        edges = build_match_graph(args, images_list, filenames)
+        if args.save_graph or args.graph_out or args.resume:
+            save_match_graph(graph_path, edges, filenames, graph_params)
     print(f'找到 {len(edges)//2} 对可靠单应')
 
     adj, degrees = build_adjacency(edges, N)
@@ -557,14 +991,15 @@ def main(args):
     if args.save_matches:
         os.makedirs(args.matches_dir, exist_ok=True)
         saved = 0
-        for (i,j), info in edges.items():
+        for (i,j), edge in edges.items():
             if i >= j: continue
-            matches = info['matches']; mask = info.get('mask', None)
-            method = info.get('method','ORB')
-            if method == 'SIFT' and kps_sift[j] is not None:
-                draw_and_save_matches(images_list[i], images_list[j], kps_sift[i], kps_sift[j], matches, mask, os.path.join(args.matches_dir, f'matches_{i:03d}_{j:03d}.png'), max_draw=args.max_match_draw)
-            else:
-                draw_and_save_matches(images_list[i], images_list[j], kps_orb[i], kps_orb[j], matches, mask, os.path.join(args.matches_dir, f'matches_{i:03d}_{j:03d}.png'), max_draw=args.max_match_draw)
+            # 内点坐标为原分辨率，在配准分辨率的代理图上绘制
+            scale_i = compute_work_scale(images_list[i].shape, args.work_megapix)
+            scale_j = compute_work_scale(images_list[j].shape, args.work_megapix)
+            img_i = resize_to_work(images_list[i], scale_i); img_j = resize_to_work(images_list[j], scale_j)
+            draw_and_save_matches(img_i, img_j, edge['src_pts'], edge['dst_pts'],
+                                  os.path.join(args.matches_dir, f'matches_{i:03d}_{j:03d}.png'),
+                                  max_draw=args.max_match_draw, scale1=scale_i, scale2=scale_j)
             saved += 1
         print(f'已保存匹配可视化到 {args.matches_dir}, count={saved}')
 
@@ -598,6 +1033,22 @@ def main(args):
 
     # blending
     print('开始融合（tile 并行）...')
+    if args.deepzoom:
+        # 分块融合结果直接切成瓦片写入金字塔，不生成整张输出图
+        writer = DeepZoomWriter(DeepZoomSettings(args.deepzoom, tile_size=args.dz_tile_size, image_format=args.dz_format,
+                                                 quality=args.dz_quality, workers=args.workers),
+                                (canvas_w, canvas_h))
+        try:
+            tiled_blend_parallel(images_dict, M_final, (canvas_w, canvas_h),
+                                 tile_size=aligned_tile_size(args.tile_size, args.dz_tile_size), workers=args.workers,
+                                 blend_method=args.blend, pyr_levels=args.pyr_levels,
+                                 max_images_per_tile=args.max_images_per_tile, tile_sink=writer.write_region)
+            pyramid = writer.finish()
+        except BaseException:
+            writer.abandon()
+            raise
+        print(f'完成，DeepZoom 金字塔（{pyramid.levels} 层，{pyramid.tiles} 块瓦片）保存到', pyramid.dzi_path)
+        return
     if args.tile:
         tiled_blend_parallel(images_dict, M_final, (canvas_w, canvas_h), args.out,
                              tile_size=args.tile_size, workers=args.workers,
@@ -627,7 +1078,8 @@ def main(args):
             den_safe = den.copy(); den_safe[den_safe==0] = 1.0
             res = (num / den_safe).astype(np.uint8)
             empty = (den[:,:,0]==0); res[empty]=255
-            cv2.imencode('.png', res)[1].tofile(args.out)
+            with span('encode'):
+                cv2.imencode('.png', res)[1].tofile(args.out)
         else:
             # multiband non-tiled - memory heavy
             warped_imgs = []; warped_masks = []
@@ -642,17 +1094,20 @@ def main(args):
             if len(warped_imgs)==0:
                 raise RuntimeError('没有可融合的图像')
             if len(warped_imgs)==1:
-                cv2.imencode('.png', warped_imgs[0].astype(np.uint8))[1].tofile(args.out)
+                with span('encode'):
+                    cv2.imencode('.png', warped_imgs[0].astype(np.uint8))[1].tofile(args.out)
             else:
-                res = multiband_blend_images(warped_imgs, warped_masks, levels=args.pyr_levels)
-                cv2.imencode('.png', res)[1].tofile(args.out)
+                with span('blend'):
+                    res = multiband_blend_images(warped_imgs, warped_masks, levels=args.pyr_levels)
+                with span('encode'):
+                    cv2.imencode('.png', res)[1].tofile(args.out)
 
     print('完成，结果保存到', args.out)
 
 # -------------------------
 # CLI 参数
 # -------------------------
-if __name__ == '__main__':
+def build_parser():
     p = argparse.ArgumentParser()
     p.add_argument('--input_dir', required=True, help='输入图片文件夹')
     p.add_argument('--out', default='result.png', help='输出拼接图')
@@ -662,6 +1117,19 @@ if __name__ == '__main__':
     p.add_argument('--ratio', type=float, default=0.75, help='Lowe ratio')
     p.add_argument('--ransac_thresh', type=float, default=5.0, help='RANSAC reproj threshold (px)')
     p.add_argument('--min_matches', type=int, default=20, help='最小 inliers 阈值用于接收 pairwise H')
+    p.add_argument('--work_megapix', type=float, default=0, help='配准分辨率（百万像素），在缩小图上检测匹配后换算 H；0 表示原分辨率')
+    p.add_argument('--refine_full_res', action='store_true', default=True,
+                   help='配准分辨率模式下用少量原分辨率内点微调 H（默认开启，与 /stitch 的 refine 一致）')
+    p.add_argument('--no_refine_full_res', dest='refine_full_res', action='store_false', help='不做原分辨率微调')
+    p.add_argument('--pair_top_k', type=int, default=8, help='全局签名预筛选：每张图只与最相似的 k 张做完整匹配；0 表示匹配全部图像对')
+    p.add_argument('--match_window', type=int, default=0, help='顺序匹配：按文件名顺序只匹配后面 k 张并检查首尾闭环，>0 时不做全局签名预筛选')
+    p.add_argument('--global_index', action='store_true', help='所有图像的 ORB 描述子放进同一个近邻索引，每张图查询一次得到候选图像对和匹配（适合大量图像）')
+    p.add_argument('--detect_workers', type=int, default=0, help='并行检测特征的线程数，0 表示与 --workers 相同')
+    p.add_argument('--match_workers', type=int, default=0, help='并行估计两两单应的线程数，0 表示与 --workers 相同')
+    p.add_argument('--feature_cache', default=None, help='磁盘特征缓存目录（默认不缓存），按路径、大小、mtime 和检测参数复用')
+    p.add_argument('--save_graph', action='store_true', help='保存匹配图 npz（两两单应、内点数、内点坐标），供 --resume 复用')
+    p.add_argument('--graph_out', default=None, help='匹配图 npz 路径（指定时即保存），默认 <out>_graph.npz')
+    p.add_argument('--resume', action='store_true', help='匹配图存在且输入图片与匹配参数未变时直接读取，跳过特征检测与匹配；否则重新匹配并保存')
     p.add_argument('--ref_index', type=int, default=None, help='手动指定参考图索引')
     p.add_argument('--blend', choices=['distance','multiband'], default='distance', help='融合方法')
     p.add_argument('--pyr_levels', type=int, default=4, help='拉普拉斯金字塔层数（multiband 模式上限）')
@@ -679,7 +1147,15 @@ if __name__ == '__main__':
     p.add_argument('--comp_a_max', type=float, default=1.6, help='曝光补偿 a 上界')
     p.add_argument('--comp_b_min', type=float, default=-50.0, help='曝光补偿 b 下界')
     p.add_argument('--comp_b_max', type=float, default=50.0, help='曝光补偿 b 上界')
-    args = p.parse_args()
+    p.add_argument('--deepzoom', default=None, help='输出 DeepZoom 瓦片金字塔到该目录（image.dzi + image_files/），代替 --out 的单张图片；总是分块融合')
+    p.add_argument('--dz_tile_size', type=int, choices=[256, 512], default=256, help='DeepZoom 瓦片大小')
+    p.add_argument('--dz_format', choices=['jpeg', 'webp', 'png'], default='jpeg', help='DeepZoom 瓦片格式')
+    p.add_argument('--dz_quality', type=int, default=90, help='DeepZoom 瓦片质量（jpeg / webp）')
+    p.add_argument('--profile', default=None, help='把各阶段（decode/detect/match/ransac/warp/blend/encode）的耗时和内存增量写入该 JSON 文件')
+    return p
+
+if __name__ == '__main__':
+    args = build_parser().parse_args()
 
     # ensure SIFT flags consistent
     if args.method == 'SIFT' and not args.use_sift:
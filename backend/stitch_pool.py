@@ -0,0 +1,159 @@
+"""
+拼接任务进程池
+把 /stitch 的 OpenCV 计算（解码、匹配、融合、编码）放到独立进程中执行，
+限制并发数和排队深度，避免阻塞事件循环上的博物馆、健康检查等接口
+"""
+
+import asyncio
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from typing import Any, Callable, Optional
+
+STITCH_WORKERS = max(1, int(os.getenv("STITCH_WORKERS", "2")))
+STITCH_QUEUE_DEPTH = max(0, int(os.getenv("STITCH_QUEUE_DEPTH", "4")))
+STITCH_RETRY_AFTER_SECONDS = max(1, int(os.getenv("STITCH_RETRY_AFTER_SECONDS", "15")))
+# spawn 不继承父进程的线程与锁，比 fork 更安全
+STITCH_START_METHOD = os.getenv("STITCH_START_METHOD", "spawn")
+
+
+class StitchError(Exception):
+    """拼接流程中的业务错误，可跨进程传递，由接口层转换为 HTTP 错误"""
+
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(status_code, detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+class StitchCancelledError(BaseException):
+    """客户端已断开，工作进程协作中止拼接
+
+    与 asyncio.CancelledError 一样继承 BaseException，拼接策略中的 except Exception 回退逻辑不会吞掉它
+    """
+
+    def __init__(self, stage: str = ""):
+        super().__init__(stage)
+        self.stage = stage
+
+
+class StitchQueueFullError(Exception):
+    """运行中 + 排队中的任务已达上限"""
+
+
+@dataclass
+class PoolResult:
+    value: Any
+    queue_wait: float  # 提交到开始执行的等待时间（秒）
+    run_time: float    # 进程内执行时间（秒）
+
+
+def _timed_call(fn: Callable, submitted_at: float, args: tuple, kwargs: dict):
+    started_at = time.time()
+    value = fn(*args, **kwargs)
+    return value, started_at - submitted_at, time.time() - started_at
+
+
+class StitchWorkerPool:
+    """有界进程池：超过 workers + queue_depth 的请求直接拒绝而不是无限排队"""
+
+    def __init__(self, workers: int = STITCH_WORKERS, queue_depth: int = STITCH_QUEUE_DEPTH):
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self._executor: Optional[ProcessPoolExecutor] = None
+        # 只在事件循环线程中修改，无需加锁
+        self._in_flight = 0
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.total_queue_wait = 0.0
+        self.max_queue_wait = 0.0
+
+    @property
+    def capacity(self) -> int:
+        return self.workers + self.queue_depth
+
+    @property
+    def queued(self) -> int:
+        return max(0, self._in_flight - self.workers)
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context(STITCH_START_METHOD),
+            )
+        return self._executor
+
+    async def run(self, fn: Callable, *args, **kwargs) -> PoolResult:
+        """在进程池中执行 fn(*args, **kwargs)，队列已满时抛出 StitchQueueFullError"""
+        return await self.submit(fn, *args, **kwargs)
+
+    def submit(self, fn: Callable, *args, **kwargs) -> "asyncio.Future[PoolResult]":
+        """同步占用一个名额并返回执行中的 Future，供后台任务使用；队列已满时立即抛出 StitchQueueFullError"""
+        if self._in_flight >= self.capacity:
+            self.rejected += 1
+            raise StitchQueueFullError()
+
+        self._in_flight += 1
+        self.submitted += 1
+        return asyncio.ensure_future(self._execute(fn, args, kwargs))
+
+    async def _execute(self, fn: Callable, args: tuple, kwargs: dict) -> PoolResult:
+        try:
+            loop = asyncio.get_running_loop()
+            value, queue_wait, run_time = await loop.run_in_executor(
+                self._get_executor(), _timed_call, fn, time.time(), args, kwargs
+            )
+        except BrokenProcessPool:
+            # 工作进程被杀（如 OOM）后进程池不可再用，下次提交时重建
+            self.failed += 1
+            self._executor = None
+            raise
+        except StitchCancelledError:
+            self.cancelled += 1
+            raise
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self._in_flight -= 1
+
+        self.completed += 1
+        self.total_queue_wait += queue_wait
+        self.max_queue_wait = max(self.max_queue_wait, queue_wait)
+        return PoolResult(value=value, queue_wait=queue_wait, run_time=run_time)
+
+    async def warm_up(self, fn: Callable = os.getpid):
+        """预先启动工作进程并执行一次 fn（通常用来完成模块导入），避免首个请求承担进程启动耗时"""
+        loop = asyncio.get_running_loop()
+        executor = self._get_executor()
+        await asyncio.gather(
+            *(loop.run_in_executor(executor, fn) for _ in range(self.workers)),
+            return_exceptions=True,
+        )
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "queue_depth": self.queue_depth,
+            "in_flight": self._in_flight,
+            "queued": self.queued,
+            "submitted": self.submitted,
+            "rejected": self.rejected,
+            "completed": self.completed,
+            "failed": self.failed,
+            "cancelled": self.cancelled,
+            "avg_queue_wait_ms": round(self.total_queue_wait * 1000 / self.completed, 1) if self.completed else 0.0,
+            "max_queue_wait_ms": round(self.max_queue_wait * 1000, 1),
+        }
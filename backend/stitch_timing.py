@@ -0,0 +1,178 @@
+"""
+拼接阶段计时
+span("detect") 等上下文管理器记录各阶段的墙钟时间、CPU 时间和峰值 RSS 增量，写入当前请求（contextvar）的
+StageTimings；拼接进程把汇总结果随拼接结果返回，接口层输出 Server-Timing 头、结构化日志，并累计到直方图。
+未设置 StageTimings 时 span 只做一次 contextvar 读取
+"""
+
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+try:
+    import resource
+except ImportError:  # Windows 没有 resource 模块，不统计 RSS
+    resource = None
+
+# 直方图分桶上限（毫秒）
+HISTOGRAM_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+
+
+def peak_rss_mb() -> Optional[float]:
+    """进程峰值常驻内存（MB）"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 单位为 KB，macOS 为字节
+    return peak / (1024 * 1024) if peak > 1 << 32 else peak / 1024
+
+
+class StageTimings:
+    """一次拼接中各阶段的累计耗时：同名阶段多次出现时时间累加、RSS 增量取最大值，同一线程中嵌套的同名阶段只算最外层"""
+
+    def __init__(self):
+        self.started_wall = time.perf_counter()
+        self.started_cpu = time.process_time()
+        self.started_rss = peak_rss_mb()
+        self._stages: Dict[str, Dict[str, float]] = {}
+        self._lock = threading.Lock()
+        self._active = threading.local()
+
+    def _active_names(self) -> List[str]:
+        names = getattr(self._active, "names", None)
+        if names is None:
+            names = self._active.names = []
+        return names
+
+    def add(self, name: str, wall: float, cpu: float, rss_delta: Optional[float]):
+        with self._lock:
+            stage = self._stages.setdefault(name, {"count": 0, "wall": 0.0, "cpu": 0.0, "rss_delta_mb": 0.0})
+            stage["count"] += 1
+            stage["wall"] += wall
+            stage["cpu"] += cpu
+            if rss_delta is not None:
+                stage["rss_delta_mb"] = max(stage["rss_delta_mb"], rss_delta)
+
+    def summary(self) -> dict:
+        """{"total": {...}, "stages": {name: {count, wall_ms, cpu_ms, rss_delta_mb}}}，可跨进程传递"""
+        rss = peak_rss_mb()
+        with self._lock:
+            stages = {
+                name: {
+                    "count": int(s["count"]),
+                    "wall_ms": round(s["wall"] * 1000, 1),
+                    "cpu_ms": round(s["cpu"] * 1000, 1),
+                    "rss_delta_mb": round(s["rss_delta_mb"], 1),
+                }
+                for name, s in self._stages.items()
+            }
+        return {
+            "total": {
+                "wall_ms": round((time.perf_counter() - self.started_wall) * 1000, 1),
+                "cpu_ms": round((time.process_time() - self.started_cpu) * 1000, 1),
+                "peak_rss_mb": round(rss, 1) if rss is not None else None,
+                "rss_delta_mb": round(rss - self.started_rss, 1) if rss is not None else None,
+            },
+            "stages": stages,
+        }
+
+
+_timings: contextvars.ContextVar[Optional[StageTimings]] = contextvars.ContextVar("stitch_stage_timings", default=None)
+
+
+def start_timings() -> "contextvars.Token":
+    return _timings.set(StageTimings())
+
+
+def current_timings() -> Optional[StageTimings]:
+    return _timings.get()
+
+
+def reset_timings(token):
+    _timings.reset(token)
+
+
+@contextmanager
+def span(name: str):
+    """记录 with 块的墙钟时间、CPU 时间（进程内所有线程）和峰值 RSS 增量
+
+    线程池中的任务需在复制的上下文中运行（contextvars.copy_context）才会记录；并行线程中同名阶段的墙钟时间累加
+    """
+    timings = _timings.get()
+    if timings is None or name in timings._active_names():
+        yield
+        return
+
+    active = timings._active_names()
+    active.append(name)
+    rss_before = peak_rss_mb()
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    try:
+        yield
+    finally:
+        active.pop()
+        rss_after = peak_rss_mb()
+        timings.add(name, time.perf_counter() - wall, time.process_time() - cpu,
+                    rss_after - rss_before if rss_after is not None else None)
+
+
+def server_timing_header(summary: dict) -> str:
+    """Server-Timing 头：各阶段墙钟时间（毫秒），接口层记录了排队时间（queue_wait_ms）时一并输出"""
+    parts = [f"{name};dur={stage['wall_ms']}" for name, stage in summary.get("stages", {}).items()]
+    if "queue_wait_ms" in summary:
+        parts.append(f"queue;dur={summary['queue_wait_ms']}")
+    if "total" in summary:
+        parts.append(f"total;dur={summary['total']['wall_ms']}")
+    return ", ".join(parts)
+
+
+class StageHistograms:
+    """各阶段墙钟时间的累计直方图（主进程内），供指标接口查看"""
+
+    def __init__(self, buckets_ms=HISTOGRAM_BUCKETS_MS):
+        self.buckets_ms = tuple(buckets_ms)
+        self._stages: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name: str, ms: float):
+        with self._lock:
+            stage = self._stages.get(name)
+            if stage is None:
+                stage = self._stages[name] = {"count": 0, "sum_ms": 0.0, "counts": [0] * (len(self.buckets_ms) + 1)}
+            stage["count"] += 1
+            stage["sum_ms"] += ms
+            for k, limit in enumerate(self.buckets_ms):
+                if ms <= limit:
+                    stage["counts"][k] += 1
+                    break
+            else:
+                stage["counts"][-1] += 1
+
+    def observe_summary(self, summary: dict):
+        for name, stage in summary.get("stages", {}).items():
+            self.observe(name, stage["wall_ms"])
+        if "queue_wait_ms" in summary:
+            self.observe("queue", summary["queue_wait_ms"])
+        if "total" in summary:
+            self.observe("total", summary["total"]["wall_ms"])
+
+    def to_dict(self) -> dict:
+        """每个阶段：次数、总耗时、平均耗时和各分桶（le 为上限毫秒，inf 为其余）的累计次数"""
+        labels = [str(b) for b in self.buckets_ms] + ["inf"]
+        with self._lock:
+            result = {}
+            for name, stage in sorted(self._stages.items()):
+                cumulative, running = {}, 0
+                for label, count in zip(labels, stage["counts"]):
+                    running += count
+                    cumulative[label] = running
+                result[name] = {
+                    "count": stage["count"],
+                    "sum_ms": round(stage["sum_ms"], 1),
+                    "avg_ms": round(stage["sum_ms"] / stage["count"], 1) if stage["count"] else 0.0,
+                    "le_ms": cumulative,
+                }
+            return {"buckets_ms": list(self.buckets_ms), "stages": result}
@@ -0,0 +1,103 @@
+"""DeepZoom 金字塔层级计算、写出与瓦片访问的测试"""
+
+import os
+
+import cv2
+import numpy as np
+import pytest
+
+from deepzoom import (DeepZoomSettings, DeepZoomWriter, PyramidStore, aligned_tile_size, level_size, max_level,
+                      read_pyramid)
+
+KEY = "0123456789abcdef0123456789abcdef"
+
+
+def test_max_level():
+    assert max_level(1, 1) == 0
+    assert max_level(2, 1) == 1
+    assert max_level(256, 256) == 8
+    assert max_level(257, 100) == 9
+    assert max_level(1000, 3000) == 12
+
+
+def test_level_size():
+    top = max_level(1000, 600)
+    assert level_size(1000, 600, top, top) == (1000, 600)
+    assert level_size(1000, 600, top - 1, top) == (500, 300)
+    assert level_size(1000, 600, top - 3, top) == (125, 75)
+    # 向上取整，最小为 1
+    assert level_size(1001, 601, top - 1, top) == (501, 301)
+    assert level_size(1000, 600, 0, top) == (1, 1)
+
+
+def test_aligned_tile_size():
+    assert aligned_tile_size(1024, 256) == 1024
+    assert aligned_tile_size(1000, 256) == 1024
+    assert aligned_tile_size(100, 256) == 256
+    assert aligned_tile_size(1300, 512) == 1536
+
+
+def test_writer_round_trip(tmp_path):
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 256, (300, 520, 3), dtype=np.uint8)
+    directory = str(tmp_path / KEY)
+    writer = DeepZoomWriter(DeepZoomSettings(directory, tile_size=256, image_format="png", workers=2), (520, 300))
+    # 分两块写入（块起点对齐到瓦片）
+    writer.write_region(0, 0, image[:, :256])
+    writer.write_region(256, 0, image[:, 256:])
+    pyramid = writer.finish()
+
+    top = max_level(520, 300)
+    assert pyramid.levels == top + 1
+    assert os.path.isfile(pyramid.dzi_path)
+    files = os.path.join(directory, "image_files")
+    assert sorted(os.listdir(os.path.join(files, str(top)))) == ["0_0.png", "0_1.png", "1_0.png", "1_1.png",
+                                                                 "2_0.png", "2_1.png"]
+    assert os.listdir(os.path.join(files, "0")) == ["0_0.png"]
+
+    # 最高层瓦片拼回原图（png 无损）
+    rebuilt = np.zeros_like(image)
+    for name in os.listdir(os.path.join(files, str(top))):
+        col, row = map(int, os.path.splitext(name)[0].split("_"))
+        tile = cv2.imread(os.path.join(files, str(top), name))
+        rebuilt[row * 256:row * 256 + tile.shape[0], col * 256:col * 256 + tile.shape[1]] = tile
+    assert np.array_equal(rebuilt, image)
+
+    # 临时目录已改名为目标目录
+    assert os.listdir(tmp_path) == [KEY]
+    loaded = read_pyramid(directory)
+    assert (loaded.width, loaded.height, loaded.tile_size, loaded.image_format) == (520, 300, 256, "png")
+
+
+def test_writer_rejects_unaligned_region(tmp_path):
+    writer = DeepZoomWriter(DeepZoomSettings(str(tmp_path / KEY)), (512, 512))
+    with pytest.raises(ValueError):
+        writer.write_region(100, 0, np.zeros((256, 256, 3), np.uint8))
+    writer.abandon()
+    assert os.listdir(tmp_path) == []
+
+
+def test_store_file_guards_paths(tmp_path):
+    store = PyramidStore(directory=str(tmp_path))
+    pyramid_dir = tmp_path / KEY
+    (pyramid_dir / "image_files" / "0").mkdir(parents=True)
+    (pyramid_dir / "image.dzi").write_text("<Image/>")
+    (pyramid_dir / "image_files" / "0" / "0_0.jpg").write_bytes(b"tile")
+    (tmp_path / "secret.txt").write_text("secret")
+
+    assert store.file(KEY, "image.dzi") == os.path.realpath(pyramid_dir / "image.dzi")
+    assert store.file(KEY, "image_files/0/0_0.jpg") is not None
+    assert store.file(KEY, "../secret.txt") is None
+    assert store.file(KEY, "image_files/../../secret.txt") is None
+    assert store.file(KEY, str(tmp_path / "secret.txt")) is None
+    assert store.file(KEY, "image_files/0/missing.jpg") is None
+    assert store.file(KEY, "image_files") is None
+
+
+def test_store_rejects_invalid_key(tmp_path):
+    store = PyramidStore(directory=str(tmp_path))
+    for key in ("..", "zz", "ABCDEF0123456789", "0123456789abcde", "../0123456789abcdef"):
+        assert store.file(key, "image.dzi") is None
+        with pytest.raises(ValueError):
+            store.path(key)
+    assert store.path(KEY) == os.path.join(str(tmp_path), KEY)
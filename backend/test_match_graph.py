@@ -0,0 +1,84 @@
+"""stitch_new 匹配图保存与恢复的测试"""
+
+import os
+
+import numpy as np
+
+from stitch_new import add_edge, load_match_graph, make_edge, save_match_graph
+
+PARAMS = {"nfeatures": 5000, "ratio": 0.75, "work_megapix": 0.6, "refine_full_res": True}
+
+
+def make_inputs(tmp_path, count=3):
+    filenames = []
+    for k in range(count):
+        path = tmp_path / f"{k:02d}.jpg"
+        path.write_bytes(bytes([k]) * (100 + k))
+        filenames.append(str(path))
+    return filenames
+
+
+def make_edges():
+    rng = np.random.default_rng(0)
+    edges = {}
+    for i, j, method in ((0, 1, "ORB"), (1, 2, "SIFT")):
+        H = np.array([[1.0, 0.01, 300.0 * (j - i)], [-0.01, 1.0, 5.0], [1e-5, 0.0, 1.0]])
+        src = rng.random((12 + i, 2), dtype=np.float32) * 500
+        dst = rng.random((12 + i, 2), dtype=np.float32) * 500
+        add_edge(edges, i, j, make_edge(H, src, dst, method))
+    return edges
+
+
+def test_round_trip(tmp_path):
+    filenames = make_inputs(tmp_path)
+    edges = make_edges()
+    path = str(tmp_path / "graph.npz")
+    save_match_graph(path, edges, filenames, PARAMS)
+
+    loaded = load_match_graph(path, filenames, PARAMS)
+    assert loaded is not None
+    assert sorted(loaded) == sorted(edges)
+    for key, edge in edges.items():
+        assert np.allclose(loaded[key]["H"], edge["H"])
+        assert loaded[key]["inliers"] == edge["inliers"]
+        assert loaded[key]["method"] == edge["method"]
+        assert np.array_equal(loaded[key]["src_pts"], edge["src_pts"])
+        assert np.array_equal(loaded[key]["dst_pts"], edge["dst_pts"])
+    # 临时文件已改名
+    assert sorted(os.listdir(tmp_path)) == ["00.jpg", "01.jpg", "02.jpg", "graph.npz"]
+
+
+def test_reverse_edge_shares_points():
+    edges = make_edges()
+    assert np.allclose(edges[(1, 0)]["H"] @ edges[(0, 1)]["H"], np.eye(3))
+    assert edges[(1, 0)]["src_pts"] is edges[(0, 1)]["dst_pts"]
+
+
+def test_param_mismatch_returns_none(tmp_path):
+    filenames = make_inputs(tmp_path)
+    path = str(tmp_path / "graph.npz")
+    save_match_graph(path, make_edges(), filenames, PARAMS)
+    assert load_match_graph(path, filenames, {**PARAMS, "ratio": 0.8}) is None
+
+
+def test_changed_file_returns_none(tmp_path):
+    filenames = make_inputs(tmp_path)
+    path = str(tmp_path / "graph.npz")
+    save_match_graph(path, make_edges(), filenames, PARAMS)
+
+    with open(filenames[1], "ab") as f:
+        f.write(b"edited")
+    assert load_match_graph(path, filenames, PARAMS) is None
+
+
+def test_different_file_list_returns_none(tmp_path):
+    filenames = make_inputs(tmp_path, count=4)
+    path = str(tmp_path / "graph.npz")
+    save_match_graph(path, make_edges(), filenames[:3], PARAMS)
+    assert load_match_graph(path, filenames, PARAMS) is None
+    assert load_match_graph(path, filenames[1:], PARAMS) is None
+
+
+def test_missing_graph_returns_none(tmp_path):
+    filenames = make_inputs(tmp_path)
+    assert load_match_graph(str(tmp_path / "missing.npz"), filenames, PARAMS) is None
@@ -0,0 +1,55 @@
+"""拼接结果缓存键与磁盘缓存的测试"""
+
+from result_cache import ResultCache, content_digest, stitch_cache_key
+
+DIGESTS = [content_digest(b"image-a"), content_digest(b"image-b"), content_digest(b"image-c")]
+PARAMS = {"work_megapix": 0.6, "refine_full_res": True, "image_format": "jpeg", "quality": 90}
+
+
+def test_key_is_stable():
+    assert stitch_cache_key(DIGESTS, PARAMS, "v1") == stitch_cache_key(list(DIGESTS), dict(PARAMS), "v1")
+
+
+def test_key_depends_on_upload_order():
+    assert stitch_cache_key(DIGESTS, PARAMS, "v1") != stitch_cache_key(DIGESTS[::-1], PARAMS, "v1")
+
+
+def test_unordered_key_ignores_upload_order():
+    assert (stitch_cache_key(DIGESTS, PARAMS, "v1", ordered=False)
+            == stitch_cache_key(DIGESTS[::-1], PARAMS, "v1", ordered=False))
+    assert stitch_cache_key(DIGESTS, PARAMS, "v1", ordered=False) != stitch_cache_key(DIGESTS, PARAMS, "v1")
+
+
+def test_key_depends_on_params():
+    assert stitch_cache_key(DIGESTS, PARAMS, "v1") != stitch_cache_key(DIGESTS, {**PARAMS, "quality": 80}, "v1")
+    # 参数顺序不影响键
+    assert stitch_cache_key(DIGESTS, PARAMS, "v1") == stitch_cache_key(DIGESTS, dict(reversed(PARAMS.items())), "v1")
+
+
+def test_key_depends_on_version():
+    assert stitch_cache_key(DIGESTS, PARAMS, "v1") != stitch_cache_key(DIGESTS, PARAMS, "v2")
+
+
+def test_put_get_round_trip(tmp_path):
+    cache = ResultCache(directory=str(tmp_path), max_bytes=1024 * 1024)
+    key = stitch_cache_key(DIGESTS, PARAMS, "v1")
+    assert cache.get(key) is None
+
+    cache.put(key, b"encoded", "image/jpeg", 640, 480)
+    cached = cache.get(key)
+    assert cached is not None
+    assert (cached.media_type, cached.width, cached.height) == ("image/jpeg", 640, 480)
+    assert cached.read() == b"encoded"
+
+
+def test_get_drops_entry_when_data_file_is_gone(tmp_path):
+    cache = ResultCache(directory=str(tmp_path), max_bytes=1024 * 1024)
+    key = stitch_cache_key(DIGESTS, PARAMS, "v1")
+    cache.put(key, b"encoded", "image/jpeg", 640, 480)
+    # 模拟被并发淘汰或其他进程删除
+    (tmp_path / f"{key}.bin").unlink()
+
+    assert cache.get(key) is None
+    stats = cache.stats()
+    assert (stats["entries"], stats["bytes"], stats["hits"], stats["misses"]) == (0, 0, 0, 1)
+    assert list(tmp_path.iterdir()) == []
@@ -2,8 +2,26 @@ import React, { useState, useEffect, useRef } from "react";
 import { useDropzone } from "react-dropzone";
 import { Progress } from "@/components/ui/progress";
 
+// 后端按 format 参数返回 jpeg / webp / png，下载文件名的扩展名跟随响应类型
+const EXTENSIONS: Record<string, string> = {
+    "image/jpeg": "jpg",
+    "image/webp": "webp",
+    "image/png": "png",
+};
+
+const downloadFilename = (response: Response, blob: Blob) => {
+    const disposition = response.headers.get("Content-Disposition");
+    const match = disposition?.match(/filename="?([^";]+)"?/);
+    if (match) {
+        return match[1];
+    }
+    const contentType = (response.headers.get("Content-Type") || blob.type).split(";")[0].trim();
+    return `stitched_image.${EXTENSIONS[contentType] || "jpg"}`;
+};
+
 const ImageStitching: React.FC = () => {
     const [stitchedImage, setStitchedImage] = useState<string | null>(null);
+    const [stitchedFilename, setStitchedFilename] = useState<string>("stitched_image.jpg");
     const [isProcessing, setIsProcessing] = useState<boolean>(false);
     const [originalImages, setOriginalImages] = useState<string[]>([]);
     const [progressStep, setProgressStep] = useState<string>("");
@@ -12,10 +30,23 @@ const ImageStitching: React.FC = () => {
     // 添加图像尺寸状态
     const [imageDimensions, setImageDimensions] = useState<{width: number, height: number} | null>(null);
 
-    const handleStitchedImage = (base64Image: string, dimensions?: {width: number, height: number}) => {
+    // 结果图是 object URL，会一直占住整张拼接图的 Blob；被替换、清除或组件卸载时释放
+    useEffect(() => {
+        if (!stitchedImage) {
+            return;
+        }
+        return () => URL.revokeObjectURL(stitchedImage);
+    }, [stitchedImage]);
+
+    // 原始图片预览同样是 object URL
+    useEffect(() => {
+        return () => originalImages.forEach((url) => URL.revokeObjectURL(url));
+    }, [originalImages]);
+
+    const handleStitchedImage = (imageUrl: string, dimensions?: {width: number, height: number}) => {
         setProgressStep("完成");
         setProgressPercent(100);
-        setStitchedImage(`data:image/png;base64,${base64Image}`);
+        setStitchedImage(imageUrl);
         if (dimensions) {
             setImageDimensions(dimensions);
         }
@@ -65,8 +96,15 @@ const ImageStitching: React.FC = () => {
             setProgressStep("处理拼接结果");
             setProgressPercent(80);
 
-            const data = await response.json();
-            handleStitchedImage(data.image, data.dimensions);
+            // 后端直接返回图像字节，尺寸放在响应头中
+            const blob = await response.blob();
+            const width = Number(response.headers.get("X-Stitch-Width"));
+            const height = Number(response.headers.get("X-Stitch-Height"));
+            setStitchedFilename(downloadFilename(response, blob));
+            handleStitchedImage(
+                URL.createObjectURL(blob),
+                width && height ? { width, height } : undefined
+            );
         } catch (error: any) {
             console.error("图像拼接过程中出错:", error);
             let errorMessage = error.message || "请尝试使用更相似的图片";
@@ -173,7 +211,7 @@ const ImageStitching: React.FC = () => {
                     <div className="mt-4 flex gap-2">
                         <a
                             href={stitchedImage}
-                            download="stitched_image.png"
+                            download={stitchedFilename}
                             className="inline-block px-4 py-2 bg-blue-500 text-white rounded hover:bg-blue-600 transition-colors cursor-pointer"
                         >
                             下载拼接图像